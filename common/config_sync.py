@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Config Sync - coalescing writer for users.json / config.json
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/config_sync.py
+
+The web panel, bot and cleanup.py only call request_sync(), which bumps a counter
+in the `config_sync` table. The zivpn-sync.service worker (this file run as a script)
+waits for a quiet window, regenerates the files once for the whole burst, and only
+restarts zivpn.service when the generated config actually changed.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+import time
+
+import dbpool
+import metrics
+import migrations
+
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "/etc/zivpn/zivpn.db")
+USERS_FILE = "/etc/zivpn/users.json"
+CONFIG_FILE = "/etc/zivpn/config.json"
+
+# Wait this long after the last request before syncing, but never longer than MAX_DELAY
+SYNC_WINDOW_SECONDS = float(os.environ.get("SYNC_WINDOW_SECONDS", "2"))
+SYNC_MAX_DELAY_SECONDS = float(os.environ.get("SYNC_MAX_DELAY_SECONDS", "10"))
+SYNC_POLL_SECONDS = 0.5
+
+SYNC_REQUESTS = metrics.counter('zivpn_config_sync_requests_total', 'Config syncs requested by user mutations.')
+SYNCS = metrics.counter('zivpn_config_syncs_total', 'Config syncs run by the worker, by outcome.', ('result',))
+SYNC_SECONDS = metrics.histogram('zivpn_config_sync_seconds', 'Time to render, compare and write the config files.')
+RESTARTS = metrics.counter('zivpn_service_restarts_total', 'zivpn.service restarts after a config change.')
+RESTART_SECONDS = metrics.histogram('zivpn_service_restart_seconds', 'Time spent in systemctl restart zivpn.service.')
+
+
+def get_db():
+    return dbpool.get_db(DATABASE_PATH)
+
+
+# --- Producer side ---
+def request_sync(db=None):
+    """Mark the generated config dirty. Cheap enough to call from every mutation."""
+    own = db is None
+    if own:
+        db = get_db()
+    try:
+        now = time.time()
+        db.execute('''
+            UPDATE config_sync
+            SET requested_version = requested_version + 1,
+                pending_since = CASE WHEN requested_version > synced_version THEN pending_since ELSE ? END,
+                last_requested_at = ?
+            WHERE id = 1
+        ''', (now, now))
+        db.commit()
+        SYNC_REQUESTS.inc()
+    finally:
+        if own:
+            db.close()
+
+
+def sync_status(db=None):
+    """Return the queue state and how far the generated files lag behind the database."""
+    own = db is None
+    if own:
+        db = get_db()
+    try:
+        row = db.execute('SELECT * FROM config_sync WHERE id = 1').fetchone()
+        pending = row['requested_version'] > row['synced_version']
+        return {
+            "pending": pending,
+            "requested_version": row['requested_version'],
+            "synced_version": row['synced_version'],
+            "synced_at": row['synced_at'],
+            "last_restart_at": row['last_restart_at'],
+            "last_error": row['last_error'],
+            "lag_seconds": round(time.time() - row['pending_since'], 3) if pending and row['pending_since'] else 0,
+        }
+    finally:
+        if own:
+            db.close()
+
+
+# --- Worker side ---
+def _write_text_atomic(path, text):
+    dirn = os.path.dirname(path)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=dirn)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+
+def _read_text(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest() if text is not None else None
+
+
+def build_files(db):
+    """Render users.json and config.json from the users table. Returns {path: text}."""
+    users = db.execute("SELECT username, password, status, expiry_date, data_limit_bytes, used_bytes FROM users WHERE status != 'deleted' ORDER BY username").fetchall()
+    now = time.strftime('%Y-%m-%d %H:%M:%S')
+
+    user_data = {}
+    passwords = set()
+    for user in users:
+        user_data[user['username']] = {
+            'password': user['password'],
+            'status': user['status'],
+            'expiry_date': user['expiry_date'],
+            'data_limit_bytes': user['data_limit_bytes'],
+            'used_bytes': user['used_bytes'],
+        }
+        if user['status'] == 'active' and user['password'] and (not user['expiry_date'] or user['expiry_date'] >= now):
+            passwords.add(str(user['password']))
+
+    try:
+        cfg = json.loads(_read_text(CONFIG_FILE) or '{}')
+    except ValueError:
+        cfg = {}
+    if not isinstance(cfg.get("auth"), dict):
+        cfg["auth"] = {}
+    cfg["auth"]["mode"] = "passwords"
+    cfg["auth"]["config"] = sorted(passwords)
+
+    return {
+        USERS_FILE: json.dumps(user_data, ensure_ascii=False, indent=2),
+        CONFIG_FILE: json.dumps(cfg, ensure_ascii=False, indent=2),
+    }
+
+
+def sync_once(db):
+    """Regenerate the files; write only what changed and restart only if config.json changed."""
+    version = db.execute('SELECT requested_version FROM config_sync WHERE id = 1').fetchone()[0]
+    with SYNC_SECONDS.time():
+        files = build_files(db)
+        changed = [path for path, text in files.items() if _digest(text) != _digest(_read_text(path))]
+        for path in changed:
+            _write_text_atomic(path, files[path])
+
+    restarted = CONFIG_FILE in changed
+    if restarted:
+        with RESTART_SECONDS.time():
+            subprocess.run(["systemctl", "restart", "zivpn.service"], check=False)
+        RESTARTS.inc()
+    SYNCS.inc('written' if changed else 'unchanged')
+
+    now = time.time()
+    db.execute('''
+        UPDATE config_sync
+        SET synced_version = ?, synced_at = ?, last_error = NULL,
+            last_restart_at = CASE WHEN ? THEN ? ELSE last_restart_at END
+        WHERE id = 1
+    ''', (version, now, restarted, now))
+    db.commit()
+    print(f"Config sync v{version}: {len(changed)} file(s) written{', zivpn service restarted' if restarted else ''}.")
+
+
+def run_worker():
+    """Poll the dirty counter and sync once per burst of mutations."""
+    migrations.migrate(DATABASE_PATH)
+    metrics.start_textfile_writer('sync')
+    db = get_db()
+    while True:
+        try:
+            row = db.execute('SELECT * FROM config_sync WHERE id = 1').fetchone()
+            if row['requested_version'] > row['synced_version']:
+                now = time.time()
+                quiet = now - (row['last_requested_at'] or 0) >= SYNC_WINDOW_SECONDS
+                overdue = now - (row['pending_since'] or now) >= SYNC_MAX_DELAY_SECONDS
+                if quiet or overdue:
+                    sync_once(db)
+                    continue
+        except Exception as e:
+            print(f"Config sync error: {e}")
+            SYNCS.inc('error')
+            try:
+                db.execute('UPDATE config_sync SET last_error = ? WHERE id = 1', (str(e),))
+                db.commit()
+            except sqlite3.Error:
+                pass
+        time.sleep(SYNC_POLL_SECONDS)
+
+
+if __name__ == '__main__':
+    print("Starting Config Sync worker...")
+    try:
+        run_worker()
+    except KeyboardInterrupt:
+        print("Stopping Config Sync worker...")
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Conntrack Snapshot - parsed, indexed view of the kernel's UDP connection table
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/conntrack.py
+
+Reads /proc/net/nf_conntrack when the kernel exposes it, otherwise `conntrack -L`
+run without a shell, and indexes ZIVPN entries by destination port and source IP so
+the connection manager does one dictionary lookup per user instead of scanning every
+connection for every user.
+
+LiveTable keeps the same indexes up to date from the `conntrack -E` NEW/DESTROY event
+stream; iter_events() accepts any line iterable, so a recorded event file replays the
+same way as the live stream. Run this file directly to print a summary of the table,
+or with --replay FILE to replay a recorded event file.
+"""
+
+import os
+import subprocess
+import sys
+from collections import namedtuple
+
+PROC_CONNTRACK = "/proc/net/nf_conntrack"
+ZIVPN_PORT = 5667
+# udp.sh DNATs this range to ZIVPN_PORT, so original-direction dports fall in it too
+ZIVPN_PORT_RANGE = (6000, 19999)
+
+# One conntrack entry, original direction only; timeout is the seconds it has left
+# (None for DESTROY events, which carry no timeout)
+Connection = namedtuple('Connection', 'proto src dst sport dport timeout assured')
+EVENT_TYPES = ('[NEW]', '[UPDATE]', '[DESTROY]')
+
+
+def connection_key(conn):
+    """Identity of a flow across snapshot lines and NEW/DESTROY events."""
+    return (conn.src, conn.sport, conn.dst, conn.dport)
+
+
+def is_zivpn_port(port):
+    return port == ZIVPN_PORT or ZIVPN_PORT_RANGE[0] <= port <= ZIVPN_PORT_RANGE[1]
+
+
+def parse_line(line):
+    """Parse one line of /proc/net/nf_conntrack, `conntrack -L` or `conntrack -E` output;
+    None if not a UDP entry.
+
+    /proc lines carry two extra leading fields ("ipv4 2") and event lines an "[EVENT]"
+    tag (plus a "[timestamp]" with -o timestamp); all formats then read
+    "udp 17 <timeout> src=.. dst=.. sport=.. dport=.." followed by the reply tuple,
+    whose keys repeat and are ignored here. DESTROY events have no timeout field.
+    """
+    fields = line.split()
+    try:
+        start = fields.index('udp')
+    except ValueError:
+        return None
+    values = {}
+    for field in fields[start + 2:]:
+        key, sep, value = field.partition('=')
+        if sep and key not in values:
+            values[key] = value
+    try:
+        return Connection(
+            proto='udp',
+            src=values['src'],
+            dst=values['dst'],
+            sport=int(values['sport']),
+            dport=int(values['dport']),
+            timeout=int(fields[start + 2]) if fields[start + 2].isdigit() else None,
+            assured='[ASSURED]' in fields,
+        )
+    except (KeyError, ValueError, IndexError):
+        return None
+
+
+def read_lines():
+    """Raw conntrack lines, from /proc if readable, else from the conntrack tool."""
+    if os.access(PROC_CONNTRACK, os.R_OK):
+        with open(PROC_CONNTRACK, 'r') as f:
+            return f.readlines()
+    result = subprocess.run(
+        ['conntrack', '-L', '-p', 'udp'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    return result.stdout.splitlines()
+
+
+class Snapshot:
+    """ZIVPN connections at one point in time, indexed by dport and by source IP."""
+
+    def __init__(self, connections, taken_at=None):
+        self.taken_at = taken_at
+        self.by_dport = {}
+        self.by_src = {}
+        for conn in connections:
+            if conn is None or not is_zivpn_port(conn.dport):
+                continue
+            self.by_dport.setdefault(conn.dport, []).append(conn)
+            self.by_src.setdefault(conn.src, []).append(conn)
+
+    @classmethod
+    def from_lines(cls, lines, taken_at=None):
+        return cls((parse_line(line) for line in lines), taken_at)
+
+    def for_port(self, port):
+        return self.by_dport.get(port, [])
+
+    def for_src(self, src):
+        return self.by_src.get(src, [])
+
+    def __len__(self):
+        return sum(len(conns) for conns in self.by_dport.values())
+
+
+def snapshot(taken_at=None):
+    return Snapshot.from_lines(read_lines(), taken_at)
+
+
+def parse_event(line):
+    """(event, Connection) for a `conntrack -E` line, event being NEW/UPDATE/DESTROY; else None."""
+    event = next((tag for tag in EVENT_TYPES if tag in line), None)
+    if event is None:
+        return None
+    conn = parse_line(line)
+    return (event[1:-1], conn) if conn is not None else None
+
+
+def iter_events(lines):
+    """Parsed ZIVPN events from the live stream or a recorded file (any iterable of lines)."""
+    for line in lines:
+        parsed = parse_event(line)
+        if parsed is not None and is_zivpn_port(parsed[1].dport):
+            yield parsed
+
+
+def event_stream():
+    """Lines of `conntrack -E` for UDP NEW/DESTROY events; ends if the tool exits."""
+    proc = subprocess.Popen(
+        ['conntrack', '-E', '-p', 'udp', '-e', 'NEW,DESTROY'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, bufsize=1
+    )
+    try:
+        yield from proc.stdout
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+class LiveTable:
+    """Snapshot-compatible connection index kept current by NEW/DESTROY events.
+
+    Per-port entries are dicts in insertion order, so for_port() lists flows oldest first.
+    Not thread-safe on its own; the connection manager serialises access.
+    """
+
+    def __init__(self):
+        self.by_dport = {}
+        self.by_src = {}
+
+    def reset(self, snap):
+        """Replace the contents with a full snapshot (periodic resync against drift).
+
+        Flows present before and after keep their position, so ages survive a resync.
+        """
+        fresh = {connection_key(c): c for conns in snap.by_dport.values() for c in conns}
+        kept = [c for conns in self.by_dport.values() for k, c in conns.items() if k in fresh]
+        self.by_dport, self.by_src = {}, {}
+        for conn in kept:
+            self.add(conn)
+        for conn in fresh.values():
+            self.add(conn)
+
+    def add(self, conn):
+        """Record a flow; returns False if it was already known."""
+        key = connection_key(conn)
+        port = self.by_dport.setdefault(conn.dport, {})
+        if key in port:
+            return False
+        port[key] = conn
+        self.by_src.setdefault(conn.src, {})[key] = conn
+        return True
+
+    def remove(self, conn):
+        key = connection_key(conn)
+        port = self.by_dport.get(conn.dport)
+        if port is None or port.pop(key, None) is None:
+            return False
+        if not port:
+            del self.by_dport[conn.dport]
+        src = self.by_src.get(conn.src)
+        if src is not None:
+            src.pop(key, None)
+            if not src:
+                del self.by_src[conn.src]
+        return True
+
+    def apply(self, event, conn):
+        """Apply one parsed event; returns True if the table changed."""
+        if event == 'DESTROY':
+            return self.remove(conn)
+        return self.add(conn)
+
+    def for_port(self, port):
+        return list(self.by_dport.get(port, {}).values())
+
+    def for_src(self, src):
+        return list(self.by_src.get(src, {}).values())
+
+    def __len__(self):
+        return sum(len(conns) for conns in self.by_dport.values())
+
+
+def drop_args(conn):
+    """conntrack filter matching exactly this flow's original tuple, not every flow from its source."""
+    return ['-D', '-p', 'udp', '-s', conn.src, '-d', conn.dst,
+            '--sport', str(conn.sport), '--dport', str(conn.dport)]
+
+
+def drop(conn):
+    """Delete one connection's entry so the client has to re-establish it."""
+    return subprocess.run(
+        ['conntrack'] + drop_args(conn),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    ).returncode == 0
+
+
+def drop_many(conns):
+    """Delete several flows with one conntrack process (--load-file, read from stdin);
+    returns the flows that were deleted.
+
+    conntrack-tools older than 1.4.6 lack --load-file (and a batch also fails if one of
+    its flows is already gone); then each flow is deleted on its own.
+    """
+    if not conns:
+        return []
+    batch = ''.join(' '.join(drop_args(conn)) + '\n' for conn in conns)
+    result = subprocess.run(
+        ['conntrack', '--load-file', '-'], input=batch, text=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    if result.returncode == 0:
+        return list(conns)
+    return [conn for conn in conns if drop(conn)]
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--replay':
+        snap = LiveTable()
+        with open(sys.argv[2], 'r') as f:
+            for event, conn in iter_events(f):
+                snap.apply(event, conn)
+    else:
+        snap = snapshot()
+    print(f"{len(snap)} ZIVPN connection(s) from {len(snap.by_src)} source IP(s)")
+    for port, conns in sorted(snap.by_dport.items()):
+        print(f"  dport {port}: {len(conns)}")
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+ZIVPN SQLite Connection Pool - shared by web, bot, API, cleanup and connection manager
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/dbpool.py
+
+Each thread holds at most one connection at a time (nested get_db() calls get the same
+one back). close() does not close the handle: it rolls back anything uncommitted and
+returns it to an idle list, so the next request thread reuses an open, tuned connection.
+Every new connection runs in WAL mode so the bandwidth writer no longer blocks readers.
+Every statement and commit is timed into metrics.QUERY_SECONDS by (operation, table).
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "/etc/zivpn/zivpn.db")
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MAX_IDLE = int(os.environ.get("DB_MAX_IDLE", "8"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+WRITE_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+# Optional hook(conn, sql, params, seconds) for statements at or over slow_query_seconds;
+# params is None for executemany. Set with set_slow_query_hook() (the panel's profiling mode)
+slow_query_hook = None
+slow_query_seconds = 0.1
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that returns itself to its pool on close() and times statements."""
+
+    pool = None
+
+    def _timed(self, method, sql, *args):
+        op, table = metrics.statement_labels(sql)
+        write = op in WRITE_PREFIXES
+        started = time.monotonic()
+        try:
+            return method(self, sql, *args)
+        except sqlite3.OperationalError as e:
+            if write and 'locked' in str(e):
+                self.pool.record_locked()
+            raise
+        finally:
+            # A SELECT is timed up to its first row; fetching the rest is the caller's loop
+            elapsed = time.monotonic() - started
+            metrics.QUERY_SECONDS.observe(elapsed, op, table)
+            if write:
+                self.pool.record_write_wait(elapsed)
+            hook = slow_query_hook
+            if hook is not None and elapsed >= slow_query_seconds:
+                params = (args[0] if args else ()) if method is sqlite3.Connection.execute else None
+                try:
+                    hook(self, sql, params, elapsed)
+                except Exception as e:
+                    print(f"Slow query hook failed: {e}")
+
+    def execute(self, sql, *args):
+        return self._timed(sqlite3.Connection.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._timed(sqlite3.Connection.executemany, sql, *args)
+
+    def commit(self):
+        if not self.in_transaction:
+            return sqlite3.Connection.commit(self)
+        started = time.monotonic()
+        try:
+            sqlite3.Connection.commit(self)
+        finally:
+            elapsed = time.monotonic() - started
+            metrics.QUERY_SECONDS.observe(elapsed, 'COMMIT', '')
+            self.pool.record_write_wait(elapsed)
+
+    def close(self):
+        self.pool.release(self)
+
+
+class ConnectionPool:
+    def __init__(self, path, max_idle=DB_MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.idle = []
+        self.counters = {
+            'opened': 0, 'closed': 0, 'reused': 0, 'in_use': 0,
+            'locked_errors': 0, 'writes': 0, 'write_wait_seconds': 0.0, 'max_write_wait_seconds': 0.0,
+        }
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT_MS / 1000.0,
+                               factory=PooledConnection, check_same_thread=False)
+        conn.pool = self
+        conn.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            sqlite3.Connection.execute(conn, pragma)
+        with self.lock:
+            self.counters['opened'] += 1
+        return conn
+
+    def acquire(self):
+        held = getattr(self.local, 'conn', None)
+        if held is not None:
+            self.local.depth += 1
+            return held
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+            if conn is not None:
+                self.counters['reused'] += 1
+            self.counters['in_use'] += 1
+        if conn is None:
+            conn = self._open()
+        self.local.conn = conn
+        self.local.depth = 1
+        return conn
+
+    def release(self, conn):
+        if getattr(self.local, 'conn', None) is not conn:
+            # Already handed back (double close() or request teardown); nothing to do
+            return
+        self.local.depth -= 1
+        if self.local.depth > 0:
+            return
+        self.local.conn = None
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            self.counters['in_use'] -= 1
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        self._close(conn)
+
+    def release_thread(self):
+        """Hand back this thread's connection regardless of how many users still hold it."""
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            self.local.depth = 1
+            self.release(conn)
+
+    def _close(self, conn):
+        sqlite3.Connection.close(conn)
+        with self.lock:
+            self.counters['closed'] += 1
+
+    def record_write_wait(self, seconds):
+        with self.lock:
+            c = self.counters
+            c['writes'] += 1
+            c['write_wait_seconds'] += seconds
+            if seconds > c['max_write_wait_seconds']:
+                c['max_write_wait_seconds'] = seconds
+
+    def record_locked(self):
+        with self.lock:
+            self.counters['locked_errors'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle'] = len(self.idle)
+        stats['write_wait_seconds'] = round(stats['write_wait_seconds'], 6)
+        stats['max_write_wait_seconds'] = round(stats['max_write_wait_seconds'], 6)
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path=None):
+    path = path or DATABASE_PATH
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+        return pool
+
+
+def get_db(path=None):
+    """Borrow this thread's connection; call close() on it when done, as before."""
+    return get_pool(path).acquire()
+
+
+def release_thread(path=None):
+    get_pool(path).release_thread()
+
+
+def pool_stats(path=None):
+    return get_pool(path).stats()
+
+
+def set_slow_query_hook(hook, seconds=0.1):
+    """Call hook(conn, sql, params, seconds) for statements slower than `seconds`; None disables."""
+    global slow_query_hook, slow_query_seconds
+    slow_query_seconds = seconds
+    slow_query_hook = hook
+
+
+def _pool_gauges():
+    with _pools_lock:
+        pools = list(_pools.values())
+    totals = {('in_use',): 0, ('idle',): 0}
+    for pool in pools:
+        stats = pool.stats()
+        for key in totals:
+            totals[key] += stats[key[0]]
+    return totals
+
+
+metrics.gauge('zivpn_db_pool_connections', 'Pooled SQLite connections by state.', ('state',), fn=_pool_gauges)
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Expiry Scheduler - suspends users at their expiry time instead of once a day
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/expiry.py
+
+The zivpn-expiry.service worker (this file run as a script) keeps a min-heap of the
+expiry dates of active users and sleeps until the earliest one passes. It then suspends
+every due user with one UPDATE over the expiry_date index and queues a single config
+sync. Renew/add/edit/suspend from any service show up through the expiry change
+counter (migration 10), which only moves on status and expiry_date edits; only the rows
+above the last version seen are read back, and each one costs a heap push, so there is
+no full scan after the initial load.
+
+The web panel and the bot call notify() after each user mutation, which wakes the worker
+early over a datagram socket; otherwise it sleeps until the next expiry, or at most
+EXPIRY_POLL_SECONDS for writers that don't notify (a manual sqlite3 session).
+cleanup.py keeps calling suspend_expired() daily as a safety net.
+"""
+
+import heapq
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+import config_sync
+import dbpool
+import migrations
+
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "/etc/zivpn/zivpn.db")
+EXPIRY_SOCKET = os.environ.get("EXPIRY_SOCKET", "/etc/zivpn/expiry.sock")
+# Longest sleep without a notification before the change counter is checked anyway
+EXPIRY_POLL_SECONDS = float(os.environ.get("EXPIRY_POLL_SECONDS", "60"))
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+VERSION_SQL = 'SELECT version FROM expiry_counter WHERE id = 1'
+
+
+def get_db():
+    return dbpool.get_db(DATABASE_PATH)
+
+
+def suspend_expired(db, now=None):
+    """Suspend every active user whose expiry_date has passed; returns their usernames.
+
+    expiry_date is local time, compared as text like everywhere else in the panel.
+    """
+    now = now or datetime.now().strftime(DATE_FORMAT)
+    where = "status = 'active' AND expiry_date IS NOT NULL AND expiry_date < ?"
+    usernames = [r[0] for r in db.execute(f"SELECT username FROM users WHERE {where}", (now,))]
+    if usernames:
+        db.execute(f"UPDATE users SET status = 'suspended' WHERE {where}", (now,))
+    db.commit()
+    return usernames
+
+
+def notify():
+    """Wake the worker after a status or expiry_date change; a no-op when it isn't running."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            sock.sendto(b'.', EXPIRY_SOCKET)
+    except OSError:
+        pass
+
+
+def listen(path=None):
+    """The worker's end of notify(); None if the socket can't be bound (it then just polls)."""
+    path = path or EXPIRY_SOCKET
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        sock.bind(path)
+    except OSError as e:
+        sock.close()
+        print(f"Cannot listen on {path} ({e}); checking for changes every {EXPIRY_POLL_SECONDS:g}s")
+        return None
+    return sock
+
+
+def wait_for_change(sock, timeout):
+    """Sleep up to `timeout` seconds, returning early (True) when notify() is called."""
+    if sock is None:
+        time.sleep(timeout)
+        return False
+    sock.settimeout(timeout)
+    try:
+        sock.recv(64)
+    except (socket.timeout, BlockingIOError):
+        return False
+    # A bulk edit notifies once per request; one refresh covers the whole burst
+    sock.setblocking(False)
+    try:
+        while True:
+            sock.recv(64)
+    except BlockingIOError:
+        pass
+    return True
+
+
+class ExpiryScheduler:
+    """Min-heap of (expiry_date, username) for active users, with lazy deletion.
+
+    `expiries` holds each scheduled user's current date; heap entries that no longer
+    match it are stale and skipped when popped, so a renewal is one push, not a re-heapify.
+    Hard-deleted users are not in the change feed; their entries come due harmlessly,
+    since suspend_expired() is what actually changes rows.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.expiries = {}
+        self.version = 0
+
+    def load(self, db):
+        """Initial load of every active user with an expiry date (one index scan)."""
+        self.version = db.execute(VERSION_SQL).fetchone()[0]
+        rows = db.execute(
+            "SELECT username, expiry_date FROM users WHERE status = 'active' AND expiry_date IS NOT NULL"
+        ).fetchall()
+        self.expiries = {r['username']: r['expiry_date'] for r in rows}
+        self.heap = [(expiry, username) for username, expiry in self.expiries.items()]
+        heapq.heapify(self.heap)
+
+    def schedule(self, username, expiry):
+        if self.expiries.get(username) == expiry:
+            return
+        if expiry is None:
+            self.expiries.pop(username, None)
+            return
+        self.expiries[username] = expiry
+        heapq.heappush(self.heap, (expiry, username))
+
+    def refresh(self, db):
+        """Apply status/expiry changes since the last call; returns how many users were looked at."""
+        version = db.execute(VERSION_SQL).fetchone()[0]
+        if version == self.version:
+            return 0
+        if version < self.version:
+            # The database was restored from a backup: versions no longer line up, start over
+            self.load(db)
+            return len(self.expiries)
+        changed = db.execute(
+            'SELECT username, status, expiry_date FROM users WHERE expiry_version > ? AND expiry_version <= ?',
+            (self.version, version)
+        ).fetchall()
+        for row in changed:
+            self.schedule(row['username'], row['expiry_date'] if row['status'] == 'active' else None)
+        self.version = version
+        # Renewals leave stale entries behind; rebuild once they outnumber the live ones
+        if len(self.heap) > 2 * len(self.expiries) + 1000:
+            self.heap = [(expiry, username) for username, expiry in self.expiries.items()]
+            heapq.heapify(self.heap)
+        return len(changed)
+
+    def next_expiry(self):
+        """Earliest live expiry date, dropping stale heap entries on the way."""
+        while self.heap:
+            expiry, username = self.heap[0]
+            if self.expiries.get(username) == expiry:
+                return expiry
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        """Remove and return the users whose expiry is before `now`."""
+        due = []
+        while True:
+            expiry = self.next_expiry()
+            if expiry is None or expiry >= now:
+                return due
+            _, username = heapq.heappop(self.heap)
+            del self.expiries[username]
+            due.append(username)
+
+    def seconds_until_next(self):
+        expiry = self.next_expiry()
+        if expiry is None:
+            return None
+        try:
+            # Due once the clock passes the stored second, matching the `expiry_date < now` test
+            wake = datetime.strptime(expiry, DATE_FORMAT) + timedelta(seconds=1)
+        except ValueError:
+            # Not a date the clock can reach; pop_due() still compares it as text on every pass
+            return None
+        return max((wake - datetime.now()).total_seconds(), 0)
+
+
+def run_worker():
+    migrations.migrate(DATABASE_PATH)
+    db = get_db()
+    scheduler = ExpiryScheduler()
+    scheduler.load(db)
+    wakeups = listen()
+    print(f"Scheduled {len(scheduler.expiries)} expiry date(s); next at {scheduler.next_expiry() or 'never'}.")
+    while True:
+        try:
+            scheduler.refresh(db)
+            now = datetime.now().strftime(DATE_FORMAT)
+            if scheduler.pop_due(now):
+                # The UPDATE is authoritative; the heap only decides when to run it
+                suspended = suspend_expired(db, now)
+                if suspended:
+                    print(f"Suspended {len(suspended)} expired user(s): {', '.join(suspended[:20])}"
+                          f"{' ...' if len(suspended) > 20 else ''}")
+                    config_sync.request_sync(db)
+                continue
+            wait = scheduler.seconds_until_next()
+            wait_for_change(wakeups, EXPIRY_POLL_SECONDS if wait is None else min(wait, EXPIRY_POLL_SECONDS))
+        except Exception as e:
+            print(f"Expiry scheduler error: {e}")
+            db.rollback()
+            time.sleep(5)
+
+
+if __name__ == '__main__':
+    print("Starting Expiry Scheduler...")
+    try:
+        run_worker()
+    except KeyboardInterrupt:
+        print("Stopping Expiry Scheduler...")
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Metrics - Prometheus text-format counters and histograms for every service
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/metrics.py
+
+Each process keeps its own registry and labels every sample with its service name.
+The web panel and the API serve theirs on /metrics. Services without an HTTP listener
+(bot, connection manager, config sync worker) write theirs to METRICS_DIR every
+METRICS_WRITE_SECONDS, and the panel's /metrics merges those files in, so scraping the
+panel covers the whole box. Recording a sample is a dict update under a lock; nothing
+is formatted until a scrape or a file write.
+"""
+
+import bisect
+import os
+import re
+import tempfile
+import threading
+import time
+from functools import lru_cache
+
+METRICS_DIR = os.environ.get("METRICS_DIR", "/etc/zivpn/metrics")
+METRICS_WRITE_SECONDS = float(os.environ.get("METRICS_WRITE_SECONDS", "15"))
+# Files not rewritten for this long belong to a stopped service and are not merged
+METRICS_STALE_SECONDS = 300
+# When set, /metrics requires "Authorization: Bearer <token>"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+service_name = os.environ.get("METRICS_SERVICE", "")
+
+
+def set_service(name):
+    global service_name
+    service_name = name
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(pairs):
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    return repr(value) if isinstance(value, float) else str(int(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def samples(self):
+        """(suffix, label values, extra label pairs, value) for every series."""
+        return []
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = list(self.values.items())
+        return [('', labels, (), value) for labels, value in items]
+
+
+class Gauge(Metric):
+    """Set directly, or computed at scrape time by `fn` (a number or {label values: number})."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), fn=None):
+        super().__init__(name, help_text, labelnames)
+        self.fn = fn
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.fn is not None:
+            try:
+                value = self.fn()
+            except Exception:
+                return []
+            items = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self.lock:
+                items = list(self.values.items())
+        return [('', labels, (), v) for labels, v in items]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum and count
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self.values.items()]
+        out = []
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                out.append(('_bucket', labels, (('le', _format_value(float(bound))),), cumulative))
+            out.append(('_bucket', labels, (('le', '+Inf'),), count))
+            out.append(('_sum', labels, (), total))
+            out.append(('_count', labels, (), count))
+        return out
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        """Add `metric`, or return the one already registered under its name."""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def families(self):
+        """{name: [help, type, sample lines]} with the service label on every sample."""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        service = (('service', service_name),) if service_name else ()
+        families = {}
+        for metric in metrics:
+            lines = []
+            for suffix, labels, extra, value in metric.samples():
+                pairs = service + tuple(zip(metric.labelnames, labels)) + extra
+                lines.append(f"{metric.name}{suffix}{_format_labels(pairs)} {_format_value(value)}")
+            if lines:
+                families[metric.name] = [metric.help, metric.kind, lines]
+        return families
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, labelnames=()):
+    return REGISTRY.register(Counter(name, help_text, labelnames))
+
+
+def gauge(name, help_text, labelnames=(), fn=None):
+    return REGISTRY.register(Gauge(name, help_text, labelnames, fn))
+
+
+def histogram(name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help_text, labelnames, buckets))
+
+
+def _render(families):
+    out = []
+    for name, (help_text, kind, lines) in families.items():
+        out.append(f"# HELP {name} {help_text}")
+        out.append(f"# TYPE {name} {kind}")
+        out.extend(lines)
+    return '\n'.join(out) + '\n'
+
+
+def _parse(text, families):
+    """Merge exposition text into `families`; samples of one name from several files are combined."""
+    current = None
+    for line in text.splitlines():
+        if line.startswith('# HELP '):
+            name, _, help_text = line[7:].partition(' ')
+            current = families.setdefault(name, [help_text, 'untyped', []])
+        elif line.startswith('# TYPE '):
+            name, _, kind = line[7:].partition(' ')
+            current = families.setdefault(name, ['', kind, []])
+            current[1] = kind
+        elif line and not line.startswith('#') and current is not None:
+            current[2].append(line)
+
+
+def render(include_files=False):
+    """This process's metrics, plus the other services' files when include_files is set."""
+    families = REGISTRY.families()
+    if include_files:
+        try:
+            names = sorted(os.listdir(METRICS_DIR))
+        except OSError:
+            names = []
+        cutoff = time.time() - METRICS_STALE_SECONDS
+        for filename in names:
+            path = os.path.join(METRICS_DIR, filename)
+            if not filename.endswith('.prom') or filename == f"{service_name}.prom":
+                continue
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    continue
+                with open(path, 'r') as f:
+                    _parse(f.read(), families)
+            except OSError:
+                continue
+    return _render(families)
+
+
+def write_textfile():
+    """Write this process's metrics to METRICS_DIR/<service>.prom atomically."""
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.tmp-', dir=METRICS_DIR)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(_render(REGISTRY.families()))
+        os.replace(tmp, os.path.join(METRICS_DIR, f"{service_name or 'unknown'}.prom"))
+    finally:
+        try: os.remove(tmp)
+        except OSError: pass
+
+
+def start_textfile_writer(service):
+    """For services without an HTTP listener: name the process and write its file periodically."""
+    set_service(service)
+
+    def loop():
+        while True:
+            try:
+                write_textfile()
+            except Exception as e:
+                print(f"Metrics write failed: {e}")
+            time.sleep(METRICS_WRITE_SECONDS)
+
+    thread = threading.Thread(target=loop, name='metrics-writer', daemon=True)
+    thread.start()
+    return thread
+
+
+def authorized(authorization_header):
+    return not METRICS_TOKEN or authorization_header == f"Bearer {METRICS_TOKEN}"
+
+
+# --- Shared series ---
+HTTP_SECONDS = histogram('zivpn_http_request_duration_seconds', 'Flask request latency by route.',
+                         ('route', 'method', 'status'))
+QUERY_SECONDS = histogram('zivpn_db_query_seconds', 'SQLite statement time (execute/executemany/commit).',
+                          ('op', 'table'))
+
+_TABLE_RE = re.compile(r'\b(?:FROM|INTO|UPDATE|JOIN)\s+([A-Za-z_][A-Za-z0-9_]*)', re.IGNORECASE)
+
+
+@lru_cache(maxsize=1024)
+def statement_labels(sql):
+    """(op, table) for a statement: its first keyword and the first table it names."""
+    words = sql.split(None, 1)
+    op = words[0].upper() if words else ''
+    match = _TABLE_RE.search(sql)
+    return op, match.group(1) if match else ''
+
+
+def instrument_flask(app, service):
+    """Name the process and time every request of `app` into HTTP_SECONDS."""
+    from flask import g, request
+    set_service(service)
+
+    def _metrics_start():
+        g.metrics_started = time.perf_counter()
+    # Ahead of the app's own hooks, so requests they answer early are timed too
+    app.before_request_funcs.setdefault(None, []).insert(0, _metrics_start)
+
+    @app.after_request
+    def _metrics_observe(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+            HTTP_SECONDS.observe(time.perf_counter() - started, route, request.method, str(response.status_code))
+        return response
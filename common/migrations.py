@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Schema Migrations - ordered, versioned, tracked in PRAGMA user_version
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/migrations.py
+
+Every service calls migrate() once at start-up; get_db() in the services is then a
+plain connect with no per-connection schema probing. Run this file directly to
+migrate by hand (udp.sh does this after installing).
+"""
+
+import os
+import sqlite3
+
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "/etc/zivpn/zivpn.db")
+
+# Older installs created these users columns under different names: legacy -> (current, default)
+LEGACY_USER_COLUMNS = {
+    'expires': ('expiry_date', None),
+    'bandwidth_used': ('used_bytes', 0),
+    'bandwidth_limit': ('data_limit_bytes', 0),
+    'concurrent_conn': ('max_clients', 1),
+}
+
+
+def _columns(db, table):
+    return {row[1] for row in db.execute(f'PRAGMA table_info({table})')}
+
+
+BASE_TABLES = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        expiry_date DATETIME,
+        port INTEGER,
+        status TEXT DEFAULT 'active',
+        data_limit_bytes INTEGER DEFAULT 0,
+        used_bytes INTEGER DEFAULT 0,
+        speed_limit_up INTEGER DEFAULT 0,
+        speed_limit_down INTEGER DEFAULT 0,
+        max_clients INTEGER DEFAULT 1,
+        active_clients INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS billing (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        plan_type TEXT DEFAULT 'monthly',
+        amount REAL DEFAULT 0,
+        currency TEXT DEFAULT 'MMK',
+        payment_method TEXT,
+        payment_status TEXT DEFAULT 'pending',
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        expires_at DATE NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS bandwidth_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        bytes_used INTEGER DEFAULT 0,
+        log_date DATE DEFAULT CURRENT_DATE,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS server_stats (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        total_users INTEGER DEFAULT 0,
+        active_users INTEGER DEFAULT 0,
+        total_bandwidth INTEGER DEFAULT 0,
+        server_load REAL DEFAULT 0,
+        recorded_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS audit_logs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        admin_user TEXT NOT NULL,
+        action TEXT NOT NULL,
+        target_user TEXT,
+        details TEXT,
+        ip_address TEXT,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS notifications (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT NOT NULL,
+        message TEXT NOT NULL,
+        type TEXT DEFAULT 'info',
+        read_status INTEGER DEFAULT 0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+    ''',
+]
+
+
+def m001_base_tables(db):
+    """Create the tables with the column names the Python services use."""
+    # executescript() would commit the migration transaction, so run them one by one
+    for ddl in BASE_TABLES:
+        db.execute(ddl)
+
+
+def m002_reconcile_user_columns(db):
+    """Rename the legacy udp.sh columns and add the ones the panel added on the fly."""
+    cols = _columns(db, 'users')
+    for legacy, (current, default) in LEGACY_USER_COLUMNS.items():
+        if legacy in cols and current not in cols:
+            db.execute(f'ALTER TABLE users RENAME COLUMN {legacy} TO {current}')
+        elif legacy in cols:
+            # Both exist (the panel added the new one next to the old): carry over values
+            # wherever the new column still holds its default
+            db.execute(f'UPDATE users SET {current} = {legacy} WHERE ({current} IS NULL OR {current} IS ?) AND {legacy} IS NOT NULL', (default,))
+    cols = _columns(db, 'users')
+    defaults = {
+        'expiry_date': 'DATETIME',
+        'used_bytes': 'INTEGER DEFAULT 0',
+        'data_limit_bytes': 'INTEGER DEFAULT 0',
+        'max_clients': 'INTEGER DEFAULT 1',
+        'active_clients': 'INTEGER DEFAULT 0',
+    }
+    for name, decl in defaults.items():
+        if name not in cols:
+            db.execute(f'ALTER TABLE users ADD COLUMN {name} {decl}')
+    # `expires` was a DATE; the services compare full '%Y-%m-%d %H:%M:%S' timestamps
+    db.execute("UPDATE users SET expiry_date = expiry_date || ' 23:59:59' WHERE length(expiry_date) = 10")
+    db.execute('UPDATE users SET used_bytes = 0 WHERE used_bytes IS NULL')
+    db.execute('UPDATE users SET data_limit_bytes = 0 WHERE data_limit_bytes IS NULL')
+    db.execute('UPDATE users SET max_clients = 1 WHERE max_clients IS NULL OR max_clients <= 0')
+    db.execute('UPDATE users SET active_clients = 0 WHERE active_clients IS NULL')
+
+
+def m003_config_sync_table(db):
+    """State row for the zivpn-sync worker (see config_sync.py)."""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS config_sync (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            requested_version INTEGER DEFAULT 0,
+            pending_since REAL,
+            last_requested_at REAL,
+            synced_version INTEGER DEFAULT 0,
+            synced_at REAL,
+            last_restart_at REAL,
+            last_error TEXT
+        )
+    ''')
+    db.execute('INSERT OR IGNORE INTO config_sync (id) VALUES (1)')
+
+
+def m004_hot_query_indexes(db):
+    """Indexes for the dashboard, cleanup and report queries."""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_status ON users(status)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_expiry_date ON users(expiry_date)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_active_clients ON users(active_clients)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_bandwidth_logs_created_at ON bandwidth_logs(created_at)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_billing_created_at ON billing(created_at)')
+
+
+def m005_user_keyset_indexes(db):
+    """(sort column, username) indexes for keyset pagination of /api/users."""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_expiry_username ON users(expiry_date, username)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_used_username ON users(used_bytes, username)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_clients_username ON users(active_clients, username)')
+    # Prefixes of the composite indexes above
+    db.execute('DROP INDEX IF EXISTS idx_users_expiry_date')
+    db.execute('DROP INDEX IF EXISTS idx_users_active_clients')
+
+
+# Columns whose change makes a user row "changed" for delta sync and ETags
+VERSIONED_USER_COLUMNS = ('username', 'password', 'status', 'expiry_date', 'data_limit_bytes',
+                          'used_bytes', 'max_clients', 'active_clients')
+
+
+def m006_user_row_versions(db):
+    """Row versions and tombstones on users for /api/users?since= and ETags."""
+    if 'row_version' not in _columns(db, 'users'):
+        db.execute('ALTER TABLE users ADD COLUMN row_version INTEGER NOT NULL DEFAULT 0')
+    db.execute('CREATE TABLE IF NOT EXISTS change_counter (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS user_tombstones (
+            username TEXT NOT NULL,
+            row_version INTEGER NOT NULL
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_user_tombstones_row_version ON user_tombstones(row_version)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_row_version ON users(row_version)')
+    # Existing rows count as changes 1..n so a full since=0 fetch still sees them
+    db.execute('UPDATE users SET row_version = id')
+    db.execute('INSERT OR REPLACE INTO change_counter (id, version) VALUES (1, (SELECT COALESCE(MAX(id), 0) FROM users))')
+
+    # Triggers rather than per-statement bookkeeping: every writer (web, bot, api.py,
+    # cleanup.py, a manual sqlite3 session) bumps the version in the same transaction.
+    stamp = '''
+        UPDATE change_counter SET version = version + 1 WHERE id = 1;
+        UPDATE users SET row_version = (SELECT version FROM change_counter WHERE id = 1),
+                         updated_at = CURRENT_TIMESTAMP
+        WHERE id = NEW.id;
+    '''
+    changed = ' OR '.join(f'OLD.{c} IS NOT NEW.{c}' for c in VERSIONED_USER_COLUMNS)
+    db.execute(f'CREATE TRIGGER IF NOT EXISTS users_version_insert AFTER INSERT ON users BEGIN {stamp} END')
+    # The stamping UPDATE changes row_version itself, which is what stops it re-triggering
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE ON users
+        WHEN NEW.row_version IS OLD.row_version AND ({changed})
+        BEGIN {stamp} END
+    ''')
+    db.execute('''
+        CREATE TRIGGER IF NOT EXISTS users_version_delete AFTER DELETE ON users BEGIN
+            UPDATE change_counter SET version = version + 1 WHERE id = 1;
+            INSERT INTO user_tombstones (username, row_version)
+            VALUES (OLD.username, (SELECT version FROM change_counter WHERE id = 1));
+        END
+    ''')
+
+
+def m007_report_rollups(db):
+    """Daily and monthly rollups of bandwidth_logs and billing for /api/reports."""
+    db.execute('CREATE TABLE IF NOT EXISTS traffic_daily (day TEXT PRIMARY KEY, bytes_used INTEGER NOT NULL DEFAULT 0, entries INTEGER NOT NULL DEFAULT 0)')
+    db.execute('CREATE TABLE IF NOT EXISTS traffic_monthly (month TEXT PRIMARY KEY, bytes_used INTEGER NOT NULL DEFAULT 0, entries INTEGER NOT NULL DEFAULT 0)')
+    for period in ('day', 'month'):
+        table = 'revenue_daily' if period == 'day' else 'revenue_monthly'
+        db.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table} (
+                {period} TEXT NOT NULL,
+                plan_type TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                amount REAL NOT NULL DEFAULT 0,
+                payments INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ({period}, plan_type, currency)
+            )
+        ''')
+    # High-water mark per source table (see rollups.py); the backfill happens on the first catch-up
+    db.execute('CREATE TABLE IF NOT EXISTS rollup_state (source TEXT PRIMARY KEY, last_id INTEGER NOT NULL DEFAULT 0)')
+    db.execute("INSERT OR IGNORE INTO rollup_state (source, last_id) VALUES ('bandwidth_logs', 0), ('billing', 0)")
+
+
+def m008_connection_drops(db):
+    """Per-user log of flows dropped by the connection manager for exceeding max_clients."""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS connection_drops (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL,
+            src TEXT NOT NULL,
+            dport INTEGER NOT NULL,
+            connections INTEGER NOT NULL,
+            max_clients INTEGER NOT NULL,
+            dropped_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_connection_drops_username ON connection_drops(username, id)')
+
+
+def m009_notification_dispatch(db):
+    """Dedupe key, sent time and scan indexes for the bot's notification dispatcher."""
+    columns = _columns(db, 'notifications')
+    if 'threshold' not in columns:
+        db.execute('ALTER TABLE notifications ADD COLUMN threshold TEXT')
+    if 'sent_at' not in columns:
+        db.execute('ALTER TABLE notifications ADD COLUMN sent_at DATETIME')
+    # One notification per user and crossed threshold; INSERT OR IGNORE relies on it
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_notifications_threshold ON notifications(username, threshold) WHERE threshold IS NOT NULL')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_notifications_pending ON notifications(read_status, id)')
+    # Quota scans compare this exact expression, so they read the index instead of every user
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_usage_percent ON users((used_bytes * 100 / data_limit_bytes)) WHERE data_limit_bytes > 0')
+
+
+def m010_expiry_versions(db):
+    """Change feed of status/expiry_date edits for the expiry scheduler."""
+    # row_version also moves on every usage write; the scheduler only cares about these two columns
+    if 'expiry_version' not in _columns(db, 'users'):
+        db.execute('ALTER TABLE users ADD COLUMN expiry_version INTEGER NOT NULL DEFAULT 0')
+    db.execute('CREATE TABLE IF NOT EXISTS expiry_counter (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+    db.execute('INSERT OR IGNORE INTO expiry_counter (id, version) VALUES (1, 0)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_users_expiry_version ON users(expiry_version)')
+    stamp = '''
+        UPDATE expiry_counter SET version = version + 1 WHERE id = 1;
+        UPDATE users SET expiry_version = (SELECT version FROM expiry_counter WHERE id = 1) WHERE id = NEW.id;
+    '''
+    db.execute(f'CREATE TRIGGER IF NOT EXISTS users_expiry_insert AFTER INSERT ON users BEGIN {stamp} END')
+    # UPDATE OF keeps the stamping UPDATE (and migration 6's) from firing this again
+    db.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS users_expiry_update AFTER UPDATE OF status, expiry_date ON users
+        WHEN OLD.status IS NOT NEW.status OR OLD.expiry_date IS NOT NEW.expiry_date
+        BEGIN {stamp} END
+    ''')
+
+
+# Append only; the position in this list is the schema version
+MIGRATIONS = [
+    m001_base_tables,
+    m002_reconcile_user_columns,
+    m003_config_sync_table,
+    m004_hot_query_indexes,
+    m005_user_keyset_indexes,
+    m006_user_row_versions,
+    m007_report_rollups,
+    m008_connection_drops,
+    m009_notification_dispatch,
+    m010_expiry_versions,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(path=None):
+    """Apply pending migrations. Safe to call concurrently from several services."""
+    db = sqlite3.connect(path or DATABASE_PATH, isolation_level=None, timeout=30)
+    try:
+        if db.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return SCHEMA_VERSION
+        # Take the write lock first, then re-read: another service may have migrated meanwhile
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            version = db.execute('PRAGMA user_version').fetchone()[0]
+            for number, migration in enumerate(MIGRATIONS, start=1):
+                if number <= version:
+                    continue
+                print(f"Database migration {number}: {migration.__doc__.strip()}")
+                migration(db)
+                db.execute(f'PRAGMA user_version = {number}')
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return SCHEMA_VERSION
+    finally:
+        db.close()
+
+
+if __name__ == '__main__':
+    print(f"Database schema is at version {migrate()}.")
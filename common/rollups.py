@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Report Rollups - daily/monthly aggregates of bandwidth_logs and billing
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/rollups.py
+
+catch_up() folds every source row above a per-source high-water mark (its id) into
+the day and month rollup tables, a bounded id range per transaction. zivpn-api.service
+runs it every ROLLUP_INTERVAL_SECONDS (5 minutes), cleanup.py daily as a backstop and
+udp.sh once at install; run this file directly to catch up by hand.
+Reports read the rollups and add only the rows above the mark from the raw table,
+which is a primary-key range scan over the last few minutes of rows.
+"""
+
+import os
+
+import dbpool
+import migrations
+
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "/etc/zivpn/zivpn.db")
+ROLLUP_BATCH_ROWS = 50000
+
+# source table -> statements that add the rows in (?, ?] to each rollup (created_at is UTC text)
+ROLLUP_SOURCES = {
+    'bandwidth_logs': (
+        '''
+        INSERT INTO traffic_daily (day, bytes_used, entries)
+        SELECT DATE(created_at), SUM(bytes_used), COUNT(*) FROM bandwidth_logs
+        WHERE id > ? AND id <= ? GROUP BY 1
+        ON CONFLICT(day) DO UPDATE SET
+            bytes_used = bytes_used + excluded.bytes_used, entries = entries + excluded.entries
+        ''',
+        '''
+        INSERT INTO traffic_monthly (month, bytes_used, entries)
+        SELECT strftime('%Y-%m', created_at), SUM(bytes_used), COUNT(*) FROM bandwidth_logs
+        WHERE id > ? AND id <= ? GROUP BY 1
+        ON CONFLICT(month) DO UPDATE SET
+            bytes_used = bytes_used + excluded.bytes_used, entries = entries + excluded.entries
+        ''',
+    ),
+    'billing': (
+        '''
+        INSERT INTO revenue_daily (day, plan_type, currency, amount, payments)
+        SELECT DATE(created_at), COALESCE(plan_type, ''), COALESCE(currency, ''), SUM(amount), COUNT(*) FROM billing
+        WHERE id > ? AND id <= ? GROUP BY 1, 2, 3
+        ON CONFLICT(day, plan_type, currency) DO UPDATE SET
+            amount = amount + excluded.amount, payments = payments + excluded.payments
+        ''',
+        '''
+        INSERT INTO revenue_monthly (month, plan_type, currency, amount, payments)
+        SELECT strftime('%Y-%m', created_at), COALESCE(plan_type, ''), COALESCE(currency, ''), SUM(amount), COUNT(*) FROM billing
+        WHERE id > ? AND id <= ? GROUP BY 1, 2, 3
+        ON CONFLICT(month, plan_type, currency) DO UPDATE SET
+            amount = amount + excluded.amount, payments = payments + excluded.payments
+        ''',
+    ),
+}
+
+
+def high_water_mark(db, source):
+    row = db.execute('SELECT last_id FROM rollup_state WHERE source = ?', (source,)).fetchone()
+    return row[0] if row else 0
+
+
+def catch_up(db=None, batch_rows=ROLLUP_BATCH_ROWS):
+    """Fold all not-yet-rolled-up source rows into the rollups; returns rows folded per source."""
+    own = db is None
+    if own:
+        db = dbpool.get_db(DATABASE_PATH)
+    folded = {}
+    try:
+        for source, statements in ROLLUP_SOURCES.items():
+            folded[source] = 0
+            while True:
+                last_id = high_water_mark(db, source)
+                max_id = db.execute(f'SELECT MAX(id) FROM {source}').fetchone()[0] or 0
+                if max_id <= last_id:
+                    break
+                upto = min(max_id, last_id + batch_rows)
+                # Rollups and the mark move in one transaction, so a crash never counts rows twice
+                for sql in statements:
+                    db.execute(sql, (last_id, upto))
+                db.execute('UPDATE rollup_state SET last_id = ? WHERE source = ? AND last_id = ?', (upto, source, last_id))
+                if db.execute('SELECT changes()').fetchone()[0] != 1:
+                    # Another process moved the mark first; drop our copy of this range
+                    db.rollback()
+                    continue
+                db.commit()
+                folded[source] += db.execute(
+                    f'SELECT COUNT(*) FROM {source} WHERE id > ? AND id <= ?', (last_id, upto)
+                ).fetchone()[0]
+        return folded
+    finally:
+        if own:
+            db.close()
+
+
+if __name__ == '__main__':
+    migrations.migrate(DATABASE_PATH)
+    for source, count in catch_up().items():
+        print(f"Rolled up {count} {source} row(s).")
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+ZIVPN Dashboard Stats - single-pass aggregates behind a short-TTL process cache
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/stats_cache.py
+
+The panel polls /api/users continuously and the bot answers /stats on demand; both
+read the same four totals. They are computed in one scan of `users`, kept for
+STATS_TTL_SECONDS and dropped early by invalidate() on user mutations in this process.
+Mutations in other processes are seen through config_sync.requested_version, which
+every add/edit/delete/suspend bumps but bandwidth and active_clients writes do not, so
+usage totals follow the TTL instead of missing the cache on every flush.
+cleanup.py records the `server_stats` history with record_snapshot().
+"""
+
+import os
+import threading
+import time
+
+STATS_TTL_SECONDS = float(os.environ.get("STATS_TTL_SECONDS", "10"))
+MEMBERSHIP_VERSION_SQL = 'SELECT requested_version FROM config_sync WHERE id = 1'
+
+AGGREGATE_SQL = '''
+    SELECT
+        SUM(CASE WHEN status != 'deleted' THEN 1 ELSE 0 END) AS total_users,
+        SUM(CASE WHEN status = 'active' AND active_clients > 0 THEN 1 ELSE 0 END) AS active_users,
+        COALESCE(SUM(used_bytes), 0) AS total_used_bytes,
+        COALESCE(SUM(data_limit_bytes), 0) AS total_data_limit
+    FROM users
+'''
+
+
+class StatsCache:
+    def __init__(self, ttl=STATS_TTL_SECONDS):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.value = None
+        self.expires_at = 0
+        self.generation = 0
+        self.version = None
+
+    def get(self, db):
+        """Return the cached totals, recomputing them with `db` when stale."""
+        version = db.execute(MEMBERSHIP_VERSION_SQL).fetchone()[0]
+        with self.lock:
+            if self.value is not None and version == self.version and time.time() < self.expires_at:
+                return self.value
+            generation = self.generation
+        value = compute_stats(db)
+        with self.lock:
+            # Don't cache a result that raced with an invalidate()
+            if generation == self.generation:
+                self.value = value
+                self.version = version
+                self.expires_at = time.time() + self.ttl
+        return value
+
+    def invalidate(self):
+        with self.lock:
+            self.value = None
+            self.generation += 1
+
+
+def compute_stats(db):
+    row = db.execute(AGGREGATE_SQL).fetchone()
+    return {
+        'total_users': row['total_users'] or 0,
+        'active_users': row['active_users'] or 0,
+        'total_used_bytes': row['total_used_bytes'],
+        'total_data_limit': row['total_data_limit'],
+    }
+
+
+def record_snapshot(db):
+    """Append one server_stats row for the history charts (cleanup.py, not request handlers)."""
+    stats = compute_stats(db)
+    try:
+        load = os.getloadavg()[0]
+    except OSError:
+        load = 0
+    db.execute(
+        'INSERT INTO server_stats (total_users, active_users, total_bandwidth, server_load) VALUES (?, ?, ?, ?)',
+        (stats['total_users'], stats['active_users'], stats['total_used_bytes'], load)
+    )
+    db.commit()
+
+
+dashboard_stats = StatsCache()
+
+
+def get_stats(db):
+    return dashboard_stats.get(db)
+
+
+def invalidate():
+    dashboard_stats.invalidate()
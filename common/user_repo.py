@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+ZIVPN User Repository - shared user queries and compact user records
+Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/user_repo.py
+
+The web panel and the bot read users through this module instead of repeating the
+same SELECTs. Rows become UserRecord objects (__slots__, no per-row dict), expiry
+comes back from SQLite as an integer epoch alongside the text date so nothing calls
+strptime per row, and status/usage are computed once per record against a single
+`now` taken per request. user_formatter() builds the JSON projection for a whole page
+from one precomputed list of getters.
+
+cached_user() serves single-user lookups (/myinfo, the bot's existence checks, the
+API's /api/v1/user/<name>) from a bounded in-process LRU with a TTL; unknown names are
+cached too, for a shorter time. Writes made in this process call invalidate(); writes
+from the other services (cleanup, expiry, bandwidth flushes, the connection manager)
+are picked up from the users change counter (migration 6), read at most every
+USER_CACHE_SYNC_SECONDS, so a hit in between does not touch SQLite.
+"""
+
+import calendar
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# expiry_date is local wall-clock text; '%s' reads it as if it were UTC, and now_epoch()
+# does the same with the local clock, so epochs compare exactly like the text did
+EXPIRY_EPOCH_SQL = "CAST(strftime('%s', expiry_date) AS INTEGER) AS expiry_epoch"
+
+USER_COLUMNS = ('id', 'username', 'password', 'status', 'expiry_date', 'data_limit_bytes',
+                'used_bytes', 'max_clients', 'active_clients', 'row_version')
+# State keys returned by UserRecord.state(); callers map them to labels or icons
+STATES = ('active', 'suspended', 'expired')
+
+USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL_SECONDS = float(os.environ.get("USER_CACHE_TTL_SECONDS", "30"))
+USER_CACHE_NEGATIVE_TTL_SECONDS = float(os.environ.get("USER_CACHE_NEGATIVE_TTL_SECONDS", "5"))
+USER_CACHE_SYNC_SECONDS = float(os.environ.get("USER_CACHE_SYNC_SECONDS", "1"))
+
+
+def now_epoch():
+    """The current local time on the expiry_epoch scale; take it once per request."""
+    return calendar.timegm(time.localtime())
+
+
+@lru_cache(maxsize=4096)
+def bytes_to_readable(b):
+    if b is None: return "0 B"
+    b = float(b)
+    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
+        if b < 1024.0:
+            return f"{b:3.2f} {unit}"
+        b /= 1024.0
+    return f"{b:3.2f} PB"
+
+
+class UserRecord:
+    """One users row; columns that were not selected stay None."""
+
+    __slots__ = USER_COLUMNS + ('expiry_epoch', '_state', '_usage')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+    def is_expired(self, now):
+        return self.expiry_epoch is not None and self.expiry_epoch < now
+
+    def state(self, now):
+        # Memoised per `now`: cached records outlive the request that loaded them
+        if self._state is None or self._state[0] != now:
+            if self.status == 'suspended':
+                state = 'suspended'
+            elif self.is_expired(now):
+                state = 'expired'
+            else:
+                state = 'active'
+            self._state = (now, state)
+        return self._state[1]
+
+    def usage_percent(self):
+        if self._usage is None:
+            if self.data_limit_bytes and self.data_limit_bytes > 0:
+                self._usage = min(100, round(((self.used_bytes or 0) / self.data_limit_bytes) * 100, 2))
+            else:
+                self._usage = 0
+        return self._usage
+
+    def used_readable(self):
+        return bytes_to_readable(self.used_bytes)
+
+    def limit_readable(self):
+        return bytes_to_readable(self.data_limit_bytes)
+
+
+def select_sql(columns, with_epoch=True):
+    """SELECT list for the given users columns, plus expiry_epoch."""
+    return f"SELECT {', '.join(columns)}{', ' + EXPIRY_EPOCH_SQL if with_epoch else ''} FROM users"
+
+
+def fetch_records(db, sql, params=()):
+    """Run a users SELECT and return UserRecord objects, column names resolved once."""
+    cursor = db.execute(sql, params)
+    names = [d[0] for d in cursor.description]
+    records = []
+    for row in cursor:
+        record = UserRecord()
+        for name, value in zip(names, row):
+            setattr(record, name, value)
+        records.append(record)
+    return records
+
+
+def get_user(db, username, columns=USER_COLUMNS):
+    records = fetch_records(db, select_sql(columns) + " WHERE username = ?", (username,))
+    return records[0] if records else None
+
+
+# Computed fields that user_formatter() can add, and the columns each one needs
+COMPUTED_FIELDS = {
+    'used_readable': ('used_bytes',),
+    'limit_readable': ('data_limit_bytes',),
+    'usage_percent': ('data_limit_bytes', 'used_bytes'),
+    'display_status': ('status', 'expiry_date'),
+}
+
+
+def user_formatter(fields, now, state_labels):
+    """Return record -> dict for `fields`, with the per-field work decided once per page."""
+    getters = []
+    for field in fields:
+        if field == 'used_readable':
+            getters.append((field, UserRecord.used_readable))
+        elif field == 'limit_readable':
+            getters.append((field, UserRecord.limit_readable))
+        elif field == 'usage_percent':
+            getters.append((field, UserRecord.usage_percent))
+        elif field == 'display_status':
+            getters.append((field, lambda r: state_labels[r.state(now)]))
+        else:
+            getters.append((field, lambda r, name=field: getattr(r, name)))
+    return lambda record: {field: get(record) for field, get in getters}
+
+
+class UserCache:
+    """Bounded LRU of username -> loader(db, username), with None cached for unknown names.
+
+    Entries expire after `ttl` (`negative_ttl` for None). A load that races with an
+    invalidate() is returned but not stored, as in stats_cache.
+    """
+
+    def __init__(self, loader, maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS,
+                 negative_ttl=USER_CACHE_NEGATIVE_TTL_SECONDS, sync_seconds=USER_CACHE_SYNC_SECONDS):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.sync_seconds = sync_seconds
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.entries = OrderedDict()   # username -> (value, expires_at), least recently used first
+        self.generation = 0
+        self.version = None
+        self.next_sync = 0
+        self.counters = dict.fromkeys(
+            ('hits', 'negative_hits', 'misses', 'evictions', 'expirations', 'invalidations', 'syncs'), 0)
+
+    def get(self, db, username):
+        now = time.monotonic()
+        if now >= self.next_sync:
+            self.sync(db, now)
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is not None:
+                value, expires_at = entry
+                if now < expires_at:
+                    self.entries.move_to_end(username)
+                    self.counters['hits' if value is not None else 'negative_hits'] += 1
+                    return value
+                del self.entries[username]
+                self.counters['expirations'] += 1
+            self.counters['misses'] += 1
+            generation = self.generation
+        value = self.loader(db, username)
+        with self.lock:
+            if generation == self.generation:
+                self.entries[username] = (value, now + (self.ttl if value is not None else self.negative_ttl))
+                self.entries.move_to_end(username)
+                while len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+                    self.counters['evictions'] += 1
+        return value
+
+    def sync(self, db, now=None):
+        """Drop users changed by any process since the last sync (one thread at a time)."""
+        if not self.sync_lock.acquire(blocking=False):
+            return
+        try:
+            self.next_sync = (now or time.monotonic()) + self.sync_seconds
+            version = db.execute('SELECT version FROM change_counter WHERE id = 1').fetchone()[0]
+            if self.version is not None and version > self.version:
+                changed = [r[0] for r in db.execute(
+                    'SELECT username FROM users WHERE row_version > ? AND row_version <= ? '
+                    'UNION SELECT username FROM user_tombstones WHERE row_version > ? AND row_version <= ?',
+                    (self.version, version, self.version, version)
+                )]
+                self.invalidate_many(changed)
+            elif self.version is not None and version < self.version:
+                # The database was restored from a backup; nothing cached can be trusted
+                self.invalidate()
+            self.version = version
+            with self.lock:
+                self.counters['syncs'] += 1
+        finally:
+            self.sync_lock.release()
+
+    def invalidate(self, username=None):
+        """Drop one user, or everything when no username is given."""
+        if username is not None:
+            self.invalidate_many((username,))
+            return
+        with self.lock:
+            self.generation += 1
+            self.counters['invalidations'] += len(self.entries)
+            self.entries.clear()
+
+    def invalidate_many(self, usernames):
+        with self.lock:
+            self.generation += 1
+            for username in usernames:
+                if self.entries.pop(username, None) is not None:
+                    self.counters['invalidations'] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['size'] = len(self.entries)
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['hits'] + stats['negative_hits']) / lookups, 4) if lookups else 0
+        stats.update(maxsize=self.maxsize, ttl_seconds=self.ttl, negative_ttl_seconds=self.negative_ttl)
+        return stats
+
+
+user_cache = UserCache(lambda db, username: get_user(db, username))
+
+
+def cached_user(db, username):
+    """UserRecord for `username` (all USER_COLUMNS) or None, from the process cache."""
+    return user_cache.get(db, username)
+
+
+def invalidate(username=None):
+    user_cache.invalidate(username)
+
+
+def cache_stats():
+    return user_cache.stats()
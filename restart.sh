@@ -45,8 +45,10 @@ restart_service() {
 #    - Must be done first as it handles traffic.
 restart_service zivpn.service
 
-# 2. Restart management components (API, Web)
+# 2. Restart management components (Config Sync, API, Web)
 #    - They rely on the database and core logic.
+restart_service zivpn-sync.service
+restart_service zivpn-expiry.service
 restart_service zivpn-api.service
 restart_service zivpn-web.service
 
@@ -1,18 +1,37 @@
 #!/usr/bin/env python3
 """
 ZIVPN Telegram Bot - Unlimited Users Version
+
+Runs on the asyncio Application API (python-telegram-bot 20+) with concurrent update
+processing. Handlers never touch SQLite on the event loop: every query and config sync
+goes through run_db(), a bounded thread pool, so one slow write does not stall the
+other chats.
 """
-import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, filters, CallbackContext
-from telegram import Update
-import sqlite3
+import asyncio
+import functools
+import hmac
+import html
+import json
+import secrets
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TimedOut
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, ContextTypes
 import logging
 import os
 from datetime import datetime, timedelta
-import socket
-import json
-import tempfile
-import subprocess
+import config_sync
+import dbpool
+import expiry
+import metrics
+import migrations
+import stats_cache
+import user_repo
 
 # Configure logging
 logging.basicConfig(
@@ -29,8 +48,52 @@ CONFIG_FILE = "/etc/zivpn/config.json"
 # Admin configuration - ONLY YOUR ID CAN SEE ADMIN COMMANDS
 ADMIN_IDS = [7576434717, 7240495054]  # Telegram ID
 
+# Concurrency: updates handled at once, DB worker threads, and DB calls allowed to queue for them
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "32"))
+BOT_DB_WORKERS = int(os.environ.get("BOT_DB_WORKERS", "4"))
+BOT_DB_MAX_PENDING = int(os.environ.get("BOT_DB_MAX_PENDING", "64"))
+# Handlers slower than this are logged as warnings
+HANDLER_SLOW_MS = float(os.environ.get("HANDLER_SLOW_MS", "500"))
+
+# Update delivery: "polling" (default, and the fallback) or "webhook". In webhook mode the
+# receiver listens on BOT_WEBHOOK_LISTEN:BOT_WEBHOOK_PORT behind an HTTPS proxy whose public
+# URL is BOT_WEBHOOK_URL; with no URL it only serves locally (for posting recorded updates).
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+BOT_WEBHOOK_LISTEN = os.environ.get("BOT_WEBHOOK_LISTEN", "127.0.0.1")
+BOT_WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+BOT_WEBHOOK_PATH = os.environ.get("BOT_WEBHOOK_PATH", "/telegram")
+BOT_WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL", "")
+BOT_WEBHOOK_SECRET = os.environ.get("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_MAX_BODY = 1024 * 1024
+
+# Notifications to admins: scan interval (0 disables), thresholds, and Telegram send limits
+NOTIFY_INTERVAL_SECONDS = int(os.environ.get("NOTIFY_INTERVAL_SECONDS", "300"))
+NOTIFY_EXPIRY_DAYS = (1, 3)
+NOTIFY_QUOTA_PERCENTS = (80, 100)
+NOTIFY_BATCH = 500
+NOTIFY_GLOBAL_RATE = 25  # messages/second across all chats (Telegram allows about 30)
+NOTIFY_CHAT_RATE = 1     # messages/second to one chat
+NOTIFY_MAX_ATTEMPTS = 5
+
+# /users paging: rows fetched per page, and Telegram's per-message text limit
+USERS_PAGE_SIZE = 25
+MESSAGE_LIMIT = 4096
+# /users filter -> (button label, WHERE clause); :now is the current local time
+USER_FILTERS = {
+    'all': ("All", "status != 'deleted'"),
+    'expired': ("Expired", "status != 'deleted' AND expiry_date < :now"),
+    'suspended': ("Suspended", "status = 'suspended'"),
+    'over_quota': ("Over quota", "status != 'deleted' AND data_limit_bytes > 0 AND used_bytes >= data_limit_bytes"),
+    'online': ("Online", "status = 'active' AND active_clients > 0"),
+}
+# Columns read for /users rows, and the icon for each user_repo state
+USER_ROW_COLUMNS = ('id', 'username', 'status', 'expiry_date', 'data_limit_bytes', 'used_bytes',
+                    'max_clients', 'active_clients')
+STATE_ICONS = {'active': '✅', 'suspended': '⏸️', 'expired': '⛔'}
+
 # --- Localization Data (Simplified for Bot) ---
 T_MM = {
+    'title': 'ZIVPN Bot',
     'not_admin': 'သင်သည် Admin မဟုတ်ပါ။',
     'missing_args': 'အချက်အလက် မပြည့်စုံပါ။ အသုံးပြုပုံကို စစ်ဆေးပါ။',
     'invalid_input': 'ရက်/ဒေတာ/ကန့်သတ်ချက် ကိန်းဂဏန်း မမှန်ပါ။',
@@ -61,61 +124,160 @@ T_MM = {
     'stats_total_users': 'စုစုပေါင်း အသုံးပြုသူ:',
     'stats_active_users': 'အွန်လိုင်း အသုံးပြုသူ:',
     'stats_used_data': 'စုစုပေါင်း သုံးပြီးသား ဒေတာ:',
+    'notify_header': '🔔 သတိပေးချက်များ (Notifications)',
 }
 
 # ===== HELPER FUNCTIONS =====
-def bytes_to_readable(b):
-    if b is None: return "0 B"
-    b = float(b)
-    for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-        if b < 1024.0:
-            return f"{b:3.2f} {unit}"
-        b /= 1024.0
-    return f"{b:3.2f} PB"
+bytes_to_readable = user_repo.bytes_to_readable
 
 def is_admin(update: Update) -> bool:
     return update.effective_user.id in ADMIN_IDS
 
 def get_db():
-    db = sqlite3.connect(DATABASE_PATH)
-    db.row_factory = sqlite3.Row
-    # Check and update schema for max_clients (critical for new feature)
+    return dbpool.get_db(DATABASE_PATH)
+
+def sync_config_passwords(username=None):
+    """Queue a sync of users.json/config.json; zivpn-sync.service coalesces and applies it"""
+    stats_cache.invalidate()
+    user_repo.invalidate(username)
     try:
-        db.execute('SELECT max_clients FROM users LIMIT 1').fetchone()
-    except sqlite3.OperationalError:
-        logger.warning("Database schema updated: Adding max_clients column...")
-        db.execute('ALTER TABLE users ADD COLUMN max_clients INTEGER DEFAULT 1')
-        db.commit()
-    # Check and update schema for active_clients (for real-time tracking)
+        config_sync.request_sync()
+    except Exception as e:
+        logger.error(f"Error queueing configuration sync: {e}")
+    expiry.notify()
+
+# ===== NON-BLOCKING DB ACCESS =====
+db_executor = ThreadPoolExecutor(max_workers=BOT_DB_WORKERS, thread_name_prefix="zivpn-db")
+
+def _with_db(fn, *args):
+    db = get_db()
     try:
-        db.execute('SELECT active_clients FROM users LIMIT 1').fetchone()
-    except sqlite3.OperationalError:
-        logger.warning("Database schema updated: Adding active_clients column...")
-        # active_clients should default to 0
-        db.execute('ALTER TABLE users ADD COLUMN active_clients INTEGER DEFAULT 0') 
-        db.commit()
-    return db
-
-def sync_config_passwords():
-    """Sync passwords back to the users.json file for the core VPN service"""
-    # This function is not fully implemented here but is assumed to be present
-    # in the web.py/API logic. If needed, this should be implemented.
-    pass
+        return fn(db, *args)
+    finally:
+        db.close()
+
+async def run_db(context, fn, *args):
+    """Run fn(db, *args) on the DB thread pool with a pooled connection.
+
+    At most BOT_DB_MAX_PENDING calls wait for the pool; past that, handlers wait here
+    instead of piling work onto an unbounded executor queue during a spike. `context` is
+    the handler's context or the Application, whose bot_data holds the semaphore.
+    """
+    async with context.bot_data['db_slots']:
+        return await asyncio.get_running_loop().run_in_executor(db_executor, functools.partial(_with_db, fn, *args))
+
+HANDLER_SECONDS = metrics.histogram('zivpn_bot_handler_seconds', 'Bot command and callback latency.', ('handler',))
+NOTIFICATIONS_SENT = metrics.counter('zivpn_bot_notifications_total', 'Notification messages by outcome.', ('result',))
+
+def timed(handler):
+    """Log how long each command takes, including DB time and Telegram round trips"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        started = time.perf_counter()
+        try:
+            await handler(update, context)
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler.__name__)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            level = logging.WARNING if elapsed_ms >= HANDLER_SLOW_MS else logging.INFO
+            logger.log(level, f"{handler.__name__} handled in {elapsed_ms:.1f} ms")
+    return wrapper
+
+# ===== DB OPERATIONS (run on the DB thread pool) =====
+def user_exists(db, username):
+    # Served from the user cache; the UNIQUE index still guards the INSERT in add_user
+    return user_repo.cached_user(db, username) is not None
+
+def add_user(db, username, password, expiry_date, data_limit_bytes, max_clients):
+    if user_exists(db, username):
+        return False
+    # NEW: Insert max_clients into the database
+    db.execute('''
+        INSERT INTO users (username, password, status, expiry_date, data_limit_bytes, used_bytes, max_clients)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', (username, password, 'active', expiry_date, data_limit_bytes, 0, max_clients))
+    db.commit()
+    sync_config_passwords(username)
+    return True
+
+def update_user(db, username, column, value):
+    """Set one column of an existing user and queue a sync; False if the user does not exist"""
+    # Unknown names are answered from the cache without opening a write transaction
+    if not user_exists(db, username):
+        return False
+    cursor = db.execute(f'UPDATE users SET {column} = ? WHERE username = ?', (value, username))
+    db.commit()
+    if cursor.rowcount == 0:
+        return False
+    sync_config_passwords(username)
+    return True
+
+def renew_user(db, username, days):
+    if not user_exists(db, username):
+        return None
+    user_data = db.execute('SELECT expiry_date FROM users WHERE username = ?', (username,)).fetchone()
+    if not user_data:
+        return None
+
+    current_expiry = datetime.strptime(user_data['expiry_date'], '%Y-%m-%d %H:%M:%S')
+
+    # If already expired, start from now. If not expired, add to current expiry.
+    if current_expiry < datetime.now():
+        new_expiry = datetime.now() + timedelta(days=days)
+    else:
+        new_expiry = current_expiry + timedelta(days=days)
+
+    new_expiry_str = new_expiry.strftime('%Y-%m-%d %H:%M:%S')
+    db.execute('UPDATE users SET expiry_date = ?, status = ? WHERE username = ?', (new_expiry_str, 'active', username))
+    db.commit()
+    sync_config_passwords(username)
+    return new_expiry_str
+
+def fetch_users_page(db, user_filter, direction, cursor_id, limit):
+    """One keyset page of users by username, after (next) or before (prev) the row with id cursor_id.
+
+    The cursor is the boundary row's id rather than its username so callback data stays
+    within Telegram's 64 bytes. Returns (rows in display order, whether more rows exist
+    in that direction, total users matching the filter).
+    """
+    params = {'now': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'cursor': cursor_id, 'limit': limit + 1}
+    where = USER_FILTERS[user_filter][1]
+    total = db.execute(f"SELECT COUNT(*) FROM users WHERE {where}", params).fetchone()[0]
+    if cursor_id:
+        where += f" AND username {'>' if direction == 'next' else '<'} (SELECT username FROM users WHERE id = :cursor)"
+    rows = user_repo.fetch_records(db, user_repo.select_sql(USER_ROW_COLUMNS) + f"""
+        WHERE {where}
+        ORDER BY username {'ASC' if direction == 'next' else 'DESC'} LIMIT :limit
+    """, params)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if direction == 'prev':
+        rows.reverse()
+    return rows, more, total
+
+def fetch_user(db, username):
+    return user_repo.cached_user(db, username)
+
+def fetch_stats(db):
+    # Single-pass totals (active users based on active_clients column), cached briefly
+    return stats_cache.get_stats(db)
 
 # ===== COMMAND HANDLERS =====
 
-def start(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text(f'{T_MM["title"]} မှ ကြိုဆိုပါတယ်! \nအကူအညီအတွက် /help ကိုနှိပ်ပါ။')
+@timed
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text(f'{T_MM["title"]} မှ ကြိုဆိုပါတယ်! \nအကူအညီအတွက် /help ကိုနှိပ်ပါ။')
 
-def help_command(update: Update, context: CallbackContext) -> None:
+@timed
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     help_text = (
         "📖 **အသုံးပြုနိုင်သော Command များ**:\n"
         "/start - စတင်ခြင်း\n"
         "/help - အကူအညီ ရယူခြင်း\n"
-        "/stats - စနစ်၏ အခြေအနေကို ကြည့်ခြင်း\n"
+        "/stats - စနစ်၏ အခြေအနေကို ကြည့်ခြင်း\n"
         "/myinfo - သင့်အကောင့် အချက်အလက်များကို ကြည့်ခြင်း\n"
     )
-    
+
     if is_admin(update):
         help_text += (
             "\n👑 **Admin Command များ**:\n"
@@ -127,28 +289,30 @@ def help_command(update: Update, context: CallbackContext) -> None:
             "/activate `<user>` - ပြန်လည်ဖွင့်ခြင်း\n"
             "/renew `<user> <days>` - သက်တမ်းတိုးခြင်း\n"
             "/reset `<user>` - ဒေတာအသုံးပြုမှု သုညပြန်သတ်မှတ်ခြင်း\n"
-            "/users - အသုံးပြုသူ စာရင်းကို ကြည့်ခြင်း (Limit 50)\n"
+            "/users `[expired|suspended|over_quota|online]` - အသုံးပြုသူ စာရင်းကို ကြည့်ခြင်း\n"
         )
-    
-    update.message.reply_text(help_text, parse_mode=telegram.ParseMode.MARKDOWN)
 
-def admin_command(update: Update, context: CallbackContext) -> None:
+    await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+
+@timed
+async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(T_MM['not_admin'])
         return
-    update.message.reply_text("Admin Menu (Admin Commands for easy copy-paste): \n\n/adduser user pass 30 500 1\n/renew user 30\n/suspend user")
+    await update.message.reply_text("Admin Menu (Admin Commands for easy copy-paste): \n\n/adduser user pass 30 500 1\n/renew user 30\n/suspend user")
 
-def adduser_command(update: Update, context: CallbackContext) -> None:
+@timed
+async def adduser_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(T_MM['not_admin'])
         return
-        
+
     args = context.args
     # Expected: user, pass, days, data_limit_gb, [max_clients]
     if len(args) < 4:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /adduser <user> <pass> <days> <limit_gb> [max_clients=1]")
+        await update.message.reply_text(f"{T_MM['missing_args']} Example: /adduser <user> <pass> <days> <limit_gb> [max_clients=1]")
         return
-        
+
     username, password, days_str, data_limit_gb_str = args[:4]
     max_clients_str = args[4] if len(args) >= 5 else "1" # NEW: Default to 1
 
@@ -159,357 +323,606 @@ def adduser_command(update: Update, context: CallbackContext) -> None:
         if days <= 0 or data_limit_gb < 0 or max_clients <= 0:
             raise ValueError
     except ValueError:
-        update.message.reply_text(T_MM['invalid_input'])
+        await update.message.reply_text(T_MM['invalid_input'])
         return
-        
+
     expiry_date = (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
     data_limit_bytes = data_limit_gb * (1024**3)
-    
-    db = get_db()
+
     try:
-        if db.execute('SELECT username FROM users WHERE username = ?', (username,)).fetchone():
-            update.message.reply_text(T_MM['user_exists'] % username)
-            return
-
-        # NEW: Insert max_clients into the database
-        db.execute('''
-            INSERT INTO users (username, password, status, expiry_date, data_limit_bytes, used_bytes, max_clients)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (username, password, 'active', expiry_date, data_limit_bytes, 0, max_clients))
-        db.commit()
-        sync_config_passwords()
-        
-        message = T_MM['user_added'] % (username, days, data_limit_gb, max_clients)
-        update.message.reply_text(message)
+        added = await run_db(context, add_user, username, password, expiry_date, data_limit_bytes, max_clients)
     except Exception as e:
         logger.error(f"Error adding user: {e}")
-        update.message.reply_text(f"❌ အသုံးပြုသူ ထည့်သွင်းရာတွင် အမှားဖြစ်ပွားသည်- {e}")
-    finally:
-        db.close()
-
-def changepass_command(update: Update, context: CallbackContext) -> None:
-    if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(f"❌ အသုံးပြုသူ ထည့်သွင်းရာတွင် အမှားဖြစ်ပွားသည်- {e}")
         return
-        
-    args = context.args
-    if len(args) != 2:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /changepass <user> <newpass>")
+    if not added:
+        await update.message.reply_text(T_MM['user_exists'] % username)
         return
-        
-    username, new_password = args
-    db = get_db()
-    try:
-        if not db.execute('SELECT username FROM users WHERE username = ?', (username,)).fetchone():
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-            
-        db.execute('UPDATE users SET password = ? WHERE username = ?', (new_password, username))
-        db.commit()
-        sync_config_passwords()
-        update.message.reply_text(T_MM['pass_changed'] % username)
-    finally:
-        db.close()
+    await update.message.reply_text(T_MM['user_added'] % (username, days, data_limit_gb, max_clients))
 
-def deluser_command(update: Update, context: CallbackContext) -> None:
+@timed
+async def changepass_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(T_MM['not_admin'])
         return
-        
+
     args = context.args
-    if len(args) != 1:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /deluser <user>")
+    if len(args) != 2:
+        await update.message.reply_text(f"{T_MM['missing_args']} Example: /changepass <user> <newpass>")
         return
-        
-    username = args[0]
-    db = get_db()
-    try:
-        if not db.execute('SELECT username FROM users WHERE username = ?', (username,)).fetchone():
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-            
-        db.execute('UPDATE users SET status = ? WHERE username = ?', ('deleted', username))
-        db.commit()
-        sync_config_passwords()
-        update.message.reply_text(T_MM['user_deleted'] % username)
-    finally:
-        db.close()
 
-def suspend_command(update: Update, context: CallbackContext) -> None:
-    if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
-        return
-        
-    args = context.args
-    if len(args) != 1:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /suspend <user>")
+    username, new_password = args
+    if not await run_db(context, update_user, username, 'password', new_password):
+        await update.message.reply_text(T_MM['user_not_found'])
         return
-        
-    username = args[0]
-    db = get_db()
-    try:
-        if not db.execute('SELECT username FROM users WHERE username = ?', (username,)).fetchone():
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-            
-        db.execute('UPDATE users SET status = ? WHERE username = ?', ('suspended', username))
-        db.commit()
-        sync_config_passwords()
-        update.message.reply_text(T_MM['user_suspended'] % username)
-    finally:
-        db.close()
+    await update.message.reply_text(T_MM['pass_changed'] % username)
 
-def activate_command(update: Update, context: CallbackContext) -> None:
+async def single_user_command(update, context, usage, column, value, reply_key):
+    """Shared body of /deluser, /suspend, /activate and /reset: one column set on one user"""
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(T_MM['not_admin'])
         return
-        
+
     args = context.args
     if len(args) != 1:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /activate <user>")
+        await update.message.reply_text(f"{T_MM['missing_args']} Example: {usage}")
         return
-        
+
     username = args[0]
-    db = get_db()
-    try:
-        if not db.execute('SELECT username FROM users WHERE username = ?', (username,)).fetchone():
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-            
-        db.execute('UPDATE users SET status = ? WHERE username = ?', ('active', username))
-        db.commit()
-        sync_config_passwords()
-        update.message.reply_text(T_MM['user_activated'] % username)
-    finally:
-        db.close()
+    if not await run_db(context, update_user, username, column, value):
+        await update.message.reply_text(T_MM['user_not_found'])
+        return
+    await update.message.reply_text(T_MM[reply_key] % username)
 
-def renew_command(update: Update, context: CallbackContext) -> None:
+@timed
+async def deluser_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await single_user_command(update, context, "/deluser <user>", 'status', 'deleted', 'user_deleted')
+
+@timed
+async def suspend_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await single_user_command(update, context, "/suspend <user>", 'status', 'suspended', 'user_suspended')
+
+@timed
+async def activate_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await single_user_command(update, context, "/activate <user>", 'status', 'active', 'user_activated')
+
+@timed
+async def renew_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(T_MM['not_admin'])
         return
-        
+
     args = context.args
     if len(args) != 2:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /renew <user> <days>")
+        await update.message.reply_text(f"{T_MM['missing_args']} Example: /renew <user> <days>")
         return
-        
+
     username, days_str = args
-    
+
     try:
         days = int(days_str)
         if days <= 0: raise ValueError
     except ValueError:
-        update.message.reply_text(T_MM['invalid_input'])
+        await update.message.reply_text(T_MM['invalid_input'])
         return
-        
-    db = get_db()
-    try:
-        user_data = db.execute('SELECT expiry_date FROM users WHERE username = ?', (username,)).fetchone()
-        if not user_data:
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-            
-        current_expiry = datetime.strptime(user_data['expiry_date'], '%Y-%m-%d %H:%M:%S')
-        
-        # If already expired, start from now. If not expired, add to current expiry.
-        if current_expiry < datetime.now():
-            new_expiry = datetime.now() + timedelta(days=days)
-        else:
-            new_expiry = current_expiry + timedelta(days=days)
-            
-        new_expiry_str = new_expiry.strftime('%Y-%m-%d %H:%M:%S')
-        
-        db.execute('UPDATE users SET expiry_date = ?, status = ? WHERE username = ?', (new_expiry_str, 'active', username))
-        db.commit()
-        sync_config_passwords()
-        update.message.reply_text(T_MM['user_renewed'] % (username, new_expiry_str))
-    finally:
-        db.close()
 
-def reset_command(update: Update, context: CallbackContext) -> None:
+    new_expiry_str = await run_db(context, renew_user, username, days)
+    if new_expiry_str is None:
+        await update.message.reply_text(T_MM['user_not_found'])
+        return
+    await update.message.reply_text(T_MM['user_renewed'] % (username, new_expiry_str))
+
+@timed
+async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await single_user_command(update, context, "/reset <user>", 'used_bytes', 0, 'traffic_reset')
+
+def render_user_row(u, now):
+    status_icon = STATE_ICONS[u.state(now)]
+
+    used = u.used_readable()
+    limit = u.limit_readable() if u.data_limit_bytes else T_MM['info_unlimited']
+
+    # NEW: Client Limit Info
+    client_info = f"{u.active_clients}/{u.max_clients}"
+
+    return (
+        f"{status_icon} <b>{html.escape(u.username)}</b>\n"
+        f"  - Exp: <code>{(u.expiry_date or '-').split()[0]}</code>\n"
+        f"  - Data: <code>{used} / {limit}</code>\n"
+        f"  - Clients: <code>{client_info}</code>\n"
+    )
+
+def render_users_page(user_filter, direction, cursor_id, rows, more, total):
+    """Text and inline keyboard for one page, packing as many rows as fit in one message.
+
+    Rows that don't fit are left for the next press: from the end of a forward page,
+    from the start of a backward one, so paging back and forth stays consistent.
+    """
+    header = f"👥 <b>အသုံးပြုသူ စာရင်း (Users List)</b> · {USER_FILTERS[user_filter][0]} ({total})\n\n"
+    now = user_repo.now_epoch()
+    rendered = [render_user_row(u, now) for u in rows]
+    budget = MESSAGE_LIMIT - len(header)
+    keep = 0
+    for text in (rendered if direction == 'next' else reversed(rendered)):
+        if budget - len(text) < 0:
+            break
+        budget -= len(text)
+        keep += 1
+    if direction == 'next':
+        has_prev, has_next = bool(cursor_id), more or keep < len(rows)
+        rows, rendered = rows[:keep], rendered[:keep]
+    else:
+        has_prev, has_next = more or keep < len(rows), True
+        rows, rendered = rows[len(rows) - keep:], rendered[len(rendered) - keep:]
+
+    if not rows:
+        return header + "အသုံးပြုသူ စာရင်း မရှိပါ (No users found).", users_keyboard(user_filter, None, None)
+    return header + "".join(rendered), users_keyboard(
+        user_filter,
+        rows[0].id if has_prev else None,
+        rows[-1].id if has_next else None,
+    )
+
+def users_keyboard(user_filter, prev_id, next_id):
+    nav = []
+    if prev_id is not None:
+        nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"users:{user_filter}:prev:{prev_id}"))
+    if next_id is not None:
+        nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"users:{user_filter}:next:{next_id}"))
+    filters_row = [
+        InlineKeyboardButton(("• " if key == user_filter else "") + label, callback_data=f"users:{key}:next:0")
+        for key, (label, _) in USER_FILTERS.items()
+    ]
+    return InlineKeyboardMarkup([row for row in (nav, filters_row[:3], filters_row[3:]) if row])
+
+async def users_page(context, user_filter, direction='next', cursor_id=0):
+    rows, more, total = await run_db(context, fetch_users_page, user_filter, direction, cursor_id, USERS_PAGE_SIZE)
+    return render_users_page(user_filter, direction, cursor_id, rows, more, total)
+
+@timed
+async def users_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await update.message.reply_text(T_MM['not_admin'])
         return
-        
-    args = context.args
-    if len(args) != 1:
-        update.message.reply_text(f"{T_MM['missing_args']} Example: /reset <user>")
+
+    user_filter = context.args[0] if context.args else 'all'
+    if user_filter not in USER_FILTERS:
+        await update.message.reply_text(f"{T_MM['missing_args']} Example: /users [{'|'.join(USER_FILTERS)}]")
         return
-        
-    username = args[0]
-    db = get_db()
-    try:
-        if not db.execute('SELECT username FROM users WHERE username = ?', (username,)).fetchone():
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-            
-        db.execute('UPDATE users SET used_bytes = ? WHERE username = ?', (0, username))
-        db.commit()
-        sync_config_passwords() # Trigger sync if needed
-        update.message.reply_text(T_MM['traffic_reset'] % username)
-    finally:
-        db.close()
 
-def users_command(update: Update, context: CallbackContext) -> None:
+    text, keyboard = await users_page(context, user_filter)
+    await update.message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+
+@timed
+async def users_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Prev/Next/filter buttons under /users: edit the list in place"""
+    query = update.callback_query
     if not is_admin(update):
-        update.message.reply_text(T_MM['not_admin'])
+        await query.answer(T_MM['not_admin'], show_alert=True)
         return
-        
-    db = get_db()
     try:
-        # NEW: Select max_clients and active_clients
-        users_raw = db.execute("SELECT username, status, expiry_date, data_limit_bytes, used_bytes, max_clients, active_clients FROM users WHERE status != 'deleted' ORDER BY username ASC LIMIT 50").fetchall()
-        
-        if not users_raw:
-            update.message.reply_text("အသုံးပြုသူ စာရင်း မရှိပါ (No users found).")
-            return
-            
-        message = "👥 **အသုံးပြုသူ စာရင်း (Users List)**\n\n"
-        for u in users_raw:
-            expiry_dt = datetime.strptime(u['expiry_date'], '%Y-%m-%d %H:%M:%S')
-            if u['status'] == 'suspended':
-                status_icon = '⏸️'
-            elif expiry_dt < datetime.now():
-                status_icon = '⛔'
-            else:
-                status_icon = '✅'
-                
-            used = bytes_to_readable(u['used_bytes'])
-            limit = bytes_to_readable(u['data_limit_bytes']) if u['data_limit_bytes'] > 0 else T_MM['info_unlimited']
-            
-            # NEW: Client Limit Info
-            client_info = f"{u['active_clients']}/{u['max_clients']}"
-            
-            message += (
-                f"{status_icon} **{u['username']}**\n"
-                f"  - Exp: `{u['expiry_date'].split()[0]}`\n"
-                f"  - Data: `{used} / {limit}`\n"
-                f"  - Clients: `{client_info}`\n"
-            )
-        
-        update.message.reply_text(message, parse_mode=telegram.ParseMode.MARKDOWN)
-    finally:
-        db.close()
+        _, user_filter, direction, cursor = query.data.split(':')
+        cursor_id = int(cursor)
+        if user_filter not in USER_FILTERS or direction not in ('next', 'prev'):
+            raise ValueError
+    except ValueError:
+        await query.answer()
+        return
 
-def myinfo_command(update: Update, context: CallbackContext) -> None:
+    text, keyboard = await users_page(context, user_filter, direction, cursor_id)
+    await query.answer()
+    try:
+        await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=keyboard)
+    except BadRequest as e:
+        # Pressing the filter that is already shown changes nothing
+        if 'not modified' not in str(e).lower():
+            raise
+
+@timed
+async def myinfo_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     username = context.args[0] if context.args else None
-    
+
     # If no username is provided, try to find user by chat_id (if linked) - this feature is not implemented, so just use args
     if not username:
-        update.message.reply_text("ကျေးဇူးပြု၍ သင့်အသုံးပြုသူအမည်ကို ရိုက်ထည့်ပါ။ ဥပမာ- /myinfo <username>")
+        await update.message.reply_text("ကျေးဇူးပြု၍ သင့်အသုံးပြုသူအမည်ကို ရိုက်ထည့်ပါ။ ဥပမာ- /myinfo <username>")
         return
 
-    db = get_db()
-    try:
-        # NEW: Select max_clients and active_clients
-        user_data = db.execute('SELECT username, status, expiry_date, data_limit_bytes, used_bytes, max_clients, active_clients FROM users WHERE username = ?', (username,)).fetchone()
-        
-        if not user_data:
-            update.message.reply_text(T_MM['user_not_found'])
-            return
-
-        expiry_dt = datetime.strptime(user_data['expiry_date'], '%Y-%m-%d %H:%M:%S')
-        
-        if user_data['status'] == 'suspended':
-            status_text = T_MM['status_suspended']
-        elif expiry_dt < datetime.now():
-            status_text = T_MM['status_expired']
-        else:
-            status_text = T_MM['status_active']
-
-        data_limit = bytes_to_readable(user_data['data_limit_bytes']) if user_data['data_limit_bytes'] > 0 else T_MM['info_unlimited']
-        
-        # NEW: Client Limit Info
-        client_limit_text = f"{user_data['max_clients']}"
-        active_clients_text = f"{user_data['active_clients']}"
-
-        message = (
-            f"**{T_MM['info_header']}**\n"
-            f"**{T_MM['info_username']}** `{user_data['username']}`\n"
-            f"**{T_MM['info_status']}** {status_text}\n"
-            f"**{T_MM['info_expiry']}** `{user_data['expiry_date']}`\n"
-            f"**{T_MM['info_data_limit']}** `{data_limit}`\n"
-            f"**{T_MM['info_data_used']}** `{bytes_to_readable(user_data['used_bytes'])}`\n"
-            f"**{T_MM['info_client_limit']}** `{client_limit_text}`\n"
-            f"**{T_MM['info_clients_active']}** `{active_clients_text}`\n"
-        )
-        
-        update.message.reply_text(message, parse_mode=telegram.ParseMode.MARKDOWN)
-    finally:
-        db.close()
+    user_data = await run_db(context, fetch_user, username)
 
-def stats_command(update: Update, context: CallbackContext) -> None:
-    db = get_db()
-    try:
-        total_users = db.execute("SELECT COUNT(*) FROM users WHERE status != 'deleted'").fetchone()[0]
-        # Active users based on active_clients column
-        active_users = db.execute("SELECT COUNT(DISTINCT username) FROM users WHERE active_clients > 0 AND status = 'active'").fetchone()[0]
-        total_used_bytes = db.execute("SELECT SUM(used_bytes) FROM users").fetchone()[0] or 0
-        
-        message = (
-            f"**{T_MM['stats_header']}**\n"
-            f"**{T_MM['stats_total_users']}** `{total_users}`\n"
-            f"**{T_MM['stats_active_users']}** `{active_users}`\n"
-            f"**{T_MM['stats_used_data']}** `{bytes_to_readable(total_used_bytes)}`\n"
-        )
-        
-        update.message.reply_text(message, parse_mode=telegram.ParseMode.MARKDOWN)
-    finally:
-        db.close()
+    if not user_data:
+        await update.message.reply_text(T_MM['user_not_found'])
+        return
+
+    status_text = T_MM['status_' + user_data.state(user_repo.now_epoch())]
+    data_limit = user_data.limit_readable() if user_data.data_limit_bytes else T_MM['info_unlimited']
+
+    # NEW: Client Limit Info
+    client_limit_text = f"{user_data.max_clients}"
+    active_clients_text = f"{user_data.active_clients}"
+
+    message = (
+        f"**{T_MM['info_header']}**\n"
+        f"**{T_MM['info_username']}** `{user_data.username}`\n"
+        f"**{T_MM['info_status']}** {status_text}\n"
+        f"**{T_MM['info_expiry']}** `{user_data.expiry_date or '-'}`\n"
+        f"**{T_MM['info_data_limit']}** `{data_limit}`\n"
+        f"**{T_MM['info_data_used']}** `{user_data.used_readable()}`\n"
+        f"**{T_MM['info_client_limit']}** `{client_limit_text}`\n"
+        f"**{T_MM['info_clients_active']}** `{active_clients_text}`\n"
+    )
+
+    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
+
+@timed
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    totals = await run_db(context, fetch_stats)
+
+    message = (
+        f"**{T_MM['stats_header']}**\n"
+        f"**{T_MM['stats_total_users']}** `{totals['total_users']}`\n"
+        f"**{T_MM['stats_active_users']}** `{totals['active_users']}`\n"
+        f"**{T_MM['stats_used_data']}** `{bytes_to_readable(totals['total_used_bytes'])}`\n"
+    )
+
+    await update.message.reply_text(message, parse_mode=ParseMode.MARKDOWN)
 
 # Other commands (ban, unban) are omitted for brevity as they are not core to the request but should exist if originally present
 
-def error_handler(update: Update, context: CallbackContext) -> None:
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     logger.error(f'Update {update} caused error {context.error}')
     try:
-        if update and update.effective_chat:
-            update.effective_chat.send_message(text=f'❌ Internal error occurred: {context.error}')
+        if isinstance(update, Update) and update.effective_chat:
+            await update.effective_chat.send_message(text=f'❌ Internal error occurred: {context.error}')
     except Exception as e:
         logger.error(f"Error handling error: {e}")
 
+# ===== NOTIFICATIONS =====
+class TokenBucket:
+    """Async token bucket: `rate` sends per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class RateLimitedSender:
+    """Sends messages within Telegram's global and per-chat limits, honouring RetryAfter"""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(NOTIFY_GLOBAL_RATE, NOTIFY_GLOBAL_RATE)
+        self.chat_buckets = {}
+
+    async def send(self, chat_id, text):
+        """True once delivered; False if Telegram refuses the chat or retries run out"""
+        bucket = self.chat_buckets.setdefault(chat_id, TokenBucket(NOTIFY_CHAT_RATE, 1))
+        for attempt in range(NOTIFY_MAX_ATTEMPTS):
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await self.bot.send_message(chat_id=chat_id, text=text)
+                NOTIFICATIONS_SENT.inc('sent')
+                return True
+            except RetryAfter as e:
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                logger.warning(f"Flood control for chat {chat_id}, retrying in {delay}s")
+                NOTIFICATIONS_SENT.inc('rate_limited')
+                await asyncio.sleep(delay)
+            except (Forbidden, BadRequest) as e:
+                logger.error(f"Notification to chat {chat_id} refused: {e}")
+                NOTIFICATIONS_SENT.inc('refused')
+                return False
+            except (TimedOut, NetworkError) as e:
+                logger.warning(f"Notification to chat {chat_id} failed ({e}), attempt {attempt + 1}")
+                await asyncio.sleep(2 ** attempt)
+        NOTIFICATIONS_SENT.inc('failed')
+        return False
+
+def generate_notifications(db):
+    """Record newly crossed expiry and quota thresholds; returns how many were added.
+
+    Set-based INSERT OR IGNORE per threshold: the expiry windows read the expiry_date
+    index, the quota ones the usage-percent expression index (migration 9), and the
+    (username, threshold) unique index drops repeats. Keys include the expiry date, so
+    a renewal starts a new period that can be notified again.
+    """
+    now = datetime.now()
+    added = 0
+    lower = now
+    for days in sorted(NOTIFY_EXPIRY_DAYS):
+        upper = now + timedelta(days=days)
+        # +status keeps the planner on the expiry_date range rather than the status index
+        added += db.execute('''
+            INSERT OR IGNORE INTO notifications (username, message, type, threshold)
+            SELECT username, printf('⏳ %s: expires in %d day(s) (%s)', username, ?, expiry_date),
+                   'expiry', printf('expiry:%d:%s', ?, expiry_date)
+            FROM users
+            WHERE +status = 'active' AND expiry_date > ? AND expiry_date <= ?
+        ''', (days, days, lower.strftime('%Y-%m-%d %H:%M:%S'), upper.strftime('%Y-%m-%d %H:%M:%S'))).rowcount
+        lower = upper
+    for percent in sorted(NOTIFY_QUOTA_PERCENTS):
+        added += db.execute('''
+            INSERT OR IGNORE INTO notifications (username, message, type, threshold)
+            SELECT username, printf('📶 %s: %d%% of data used (%.2f / %.2f GB)', username, ?,
+                                    used_bytes / 1073741824.0, data_limit_bytes / 1073741824.0),
+                   'quota', printf('quota:%d:%d:%s', ?, data_limit_bytes, COALESCE(expiry_date, ''))
+            FROM users
+            WHERE data_limit_bytes > 0 AND used_bytes * 100 / data_limit_bytes >= ? AND status != 'deleted'
+        ''', (percent, percent, percent)).rowcount
+    db.commit()
+    return added
+
+def fetch_pending_notifications(db, limit):
+    return db.execute(
+        'SELECT id, username, message FROM notifications WHERE read_status = 0 ORDER BY id LIMIT ?', (limit,)
+    ).fetchall()
+
+def mark_notifications_sent(db, ids):
+    db.executemany(
+        'UPDATE notifications SET read_status = 1, sent_at = CURRENT_TIMESTAMP WHERE id = ?', [(i,) for i in ids]
+    )
+    db.commit()
+
+def pack_messages(header, lines):
+    """Join lines into as few messages as fit under MESSAGE_LIMIT"""
+    chunks, current = [], header
+    for line in lines:
+        if len(current) + len(line) + 1 > MESSAGE_LIMIT:
+            chunks.append(current)
+            current = header
+        current += line + "\n"
+    if current != header:
+        chunks.append(current)
+    return chunks
+
+async def dispatch_notifications(application, sender):
+    """Send pending notifications as per-admin digests; returns how many were sent"""
+    pending = await run_db(application, fetch_pending_notifications, NOTIFY_BATCH)
+    if not pending:
+        return 0
+    chunks = pack_messages(f"{T_MM['notify_header']}\n\n", [n['message'] for n in pending])
+    delivered = await asyncio.gather(*[
+        send_digest(sender, admin_id, chunks) for admin_id in ADMIN_IDS
+    ])
+    # Delivered to at least one admin counts as sent; otherwise try again next round
+    if any(delivered):
+        await run_db(application, mark_notifications_sent, [n['id'] for n in pending])
+        return len(pending)
+    return 0
+
+async def send_digest(sender, chat_id, chunks):
+    for chunk in chunks:
+        if not await sender.send(chat_id, chunk):
+            return False
+    return True
+
+async def notification_loop(application: Application) -> None:
+    sender = RateLimitedSender(application.bot)
+    while True:
+        try:
+            added = await run_db(application, generate_notifications)
+            if added:
+                logger.info(f"{added} new notification(s) queued")
+            # Keep draining while full batches come back, e.g. after a mass expiry day
+            while await dispatch_notifications(application, sender) == NOTIFY_BATCH:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Notification dispatch error: {e}")
+        await asyncio.sleep(NOTIFY_INTERVAL_SECONDS)
+
+async def post_init(application: Application) -> None:
+    # Created here so it belongs to the loop that runs this Application
+    application.bot_data['db_slots'] = asyncio.Semaphore(BOT_DB_MAX_PENDING)
+    if NOTIFY_INTERVAL_SECONDS > 0:
+        # A plain task rather than application.create_task(), which stop() would wait on forever
+        application.bot_data['notification_task'] = asyncio.create_task(notification_loop(application))
+
+async def post_shutdown(application: Application) -> None:
+    task = application.bot_data.pop('notification_task', None)
+    if task:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+# ===== WEBHOOK MODE =====
+class WebhookReceiver:
+    """Local HTTP endpoint for Telegram webhook deliveries, served from a thread.
+
+    Telegram (or the HTTPS reverse proxy in front of this port) POSTs each update as
+    JSON. Requests must carry the secret token header registered with setWebhook;
+    accepted updates are queued into the Application, which processes them exactly as
+    in polling mode. The same endpoint accepts recorded update JSON for testing.
+    """
+
+    def __init__(self, application, loop, secret):
+        self.application = application
+        self.loop = loop
+        self.secret = secret
+        self.draining = False
+        self.serving = False
+        self.received = 0
+        self.server = ThreadingHTTPServer((BOT_WEBHOOK_LISTEN, BOT_WEBHOOK_PORT), self._handler_class())
+        self.server.daemon_threads = True
+
+    def _handler_class(self):
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                status = receiver.accept(self.path, self.headers, self.rfile)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, fmt, *args):
+                logger.debug("webhook: " + fmt % args)
+
+        return Handler
+
+    def accept(self, path, headers, body):
+        """Validate and queue one delivery; returns the HTTP status for Telegram"""
+        if path.split('?', 1)[0] != BOT_WEBHOOK_PATH:
+            return 404
+        if not hmac.compare_digest(headers.get('X-Telegram-Bot-Api-Secret-Token', ''), self.secret):
+            return 403
+        if self.draining:
+            # Telegram redelivers anything that was not answered with 2xx
+            return 503
+        try:
+            length = int(headers.get('Content-Length', 0))
+        except ValueError:
+            return 400
+        if length <= 0 or length > BOT_WEBHOOK_MAX_BODY:
+            return 413 if length > 0 else 400
+        try:
+            update = Update.de_json(json.loads(body.read(length)), self.application.bot)
+        except (ValueError, TypeError, KeyError, AttributeError):
+            # Valid JSON that is not an Update fails inside de_json with any of these
+            return 400
+        if update is None:
+            return 400
+        future = asyncio.run_coroutine_threadsafe(self.application.update_queue.put(update), self.loop)
+        try:
+            future.result(timeout=10)
+        except FutureTimeoutError:
+            future.cancel()
+            return 503
+        self.received += 1
+        return 200
+
+    def start(self):
+        self.serving = True
+        threading.Thread(target=self.server.serve_forever, name="zivpn-webhook", daemon=True).start()
+
+    def stop(self):
+        self.draining = True
+        if self.serving:
+            # shutdown() waits for serve_forever(), so only call it once that is running
+            self.serving = False
+            self.server.shutdown()
+        self.server.server_close()
+
+async def run_webhook(application: Application) -> None:
+    """Receive updates over HTTP until SIGTERM/SIGINT, then drain and stop"""
+    secret = BOT_WEBHOOK_SECRET or (secrets.token_urlsafe(32) if BOT_WEBHOOK_URL else '')
+    if not secret:
+        raise ValueError("BOT_WEBHOOK_SECRET must be set when BOT_WEBHOOK_URL is empty")
+
+    loop = asyncio.get_running_loop()
+    # Bind first, so a busy port falls back to polling before anything is registered
+    receiver = WebhookReceiver(application, loop, secret)
+    try:
+        async with application:
+            # run_polling() calls these hooks itself; this loop has to, or the notification task never starts
+            if application.post_init:
+                await application.post_init(application)
+            if BOT_WEBHOOK_URL:
+                await application.bot.set_webhook(
+                    url=BOT_WEBHOOK_URL, secret_token=secret,
+                    allowed_updates=Update.ALL_TYPES, max_connections=BOT_CONCURRENT_UPDATES,
+                )
+            await application.start()
+            receiver.start()
+            logger.info(f"🤖 Webhook receiver listening on {BOT_WEBHOOK_LISTEN}:{BOT_WEBHOOK_PORT}{BOT_WEBHOOK_PATH}")
+
+            stopping = asyncio.Event()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stopping.set)
+            await stopping.wait()
+
+            # Graceful drain: refuse new deliveries (Telegram retries them after the restart),
+            # then let Application.stop() finish every queued and in-flight update.
+            # The webhook stays registered so nothing is lost while the bot is down.
+            logger.info("Draining webhook updates before shutdown...")
+            receiver.stop()
+            await application.stop()
+            logger.info(f"Webhook receiver stopped after {receiver.received} update(s)")
+    finally:
+        receiver.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
 # ===== MAIN FUNCTION =====
+def build_application() -> Application:
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(BOT_CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Public commands (everyone can see and use)
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+
+    # Admin commands (only admin can see and use)
+    # Note: You need to implement proper Admin check logic on command execution
+    application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("adduser", adduser_command))
+    application.add_handler(CommandHandler("changepass", changepass_command))
+    application.add_handler(CommandHandler("deluser", deluser_command))
+    application.add_handler(CommandHandler("suspend", suspend_command))
+    application.add_handler(CommandHandler("activate", activate_command))
+    # application.add_handler(CommandHandler("ban", ban_user)) # Assuming these exist but are omitted
+    # application.add_handler(CommandHandler("unban", unban_user)) # Assuming these exist but are omitted
+    application.add_handler(CommandHandler("renew", renew_command))
+    application.add_handler(CommandHandler("reset", reset_command))
+    application.add_handler(CommandHandler("users", users_command))
+    application.add_handler(CallbackQueryHandler(users_page_callback, pattern=r"^users:"))
+    application.add_handler(CommandHandler("myinfo", myinfo_command)) # Changed to take argument
+
+    application.add_error_handler(error_handler)
+    return application
+
 def main() -> None:
     if not BOT_TOKEN:
         logger.error("BOT_TOKEN is not set. Please check environment variables")
         return
-        
-    try:
-        # Check if the database exists and run schema check/update
-        db = get_db()
-        db.close()
-
-        updater = Updater(BOT_TOKEN, use_context=True)
-        dp = updater.dispatcher
-
-        # Public commands (everyone can see and use)
-        dp.add_handler(CommandHandler("start", start))
-        dp.add_handler(CommandHandler("help", help_command))
-        dp.add_handler(CommandHandler("stats", stats_command))
-        
-        # Admin commands (only admin can see and use)
-        # Note: You need to implement proper Admin check logic on command execution
-        dp.add_handler(CommandHandler("admin", admin_command))
-        dp.add_handler(CommandHandler("adduser", adduser_command))
-        dp.add_handler(CommandHandler("changepass", changepass_command))
-        dp.add_handler(CommandHandler("deluser", deluser_command))
-        dp.add_handler(CommandHandler("suspend", suspend_command))
-        dp.add_handler(CommandHandler("activate", activate_command))
-        # dp.add_handler(CommandHandler("ban", ban_user)) # Assuming these exist but are omitted
-        # dp.add_handler(CommandHandler("unban", unban_user)) # Assuming these exist but are omitted
-        dp.add_handler(CommandHandler("renew", renew_command))
-        dp.add_handler(CommandHandler("reset", reset_command))
-        dp.add_handler(CommandHandler("users", users_command))
-        dp.add_handler(CommandHandler("myinfo", myinfo_command)) # Changed to take argument
-        
-        dp.add_error_handler(error_handler)
 
+    try:
+        # Bring the schema up to date once at start-up
+        migrations.migrate(DATABASE_PATH)
+        # No HTTP listener of our own; the panel's /metrics picks this file up
+        metrics.start_textfile_writer('bot')
+
+        if BOT_MODE == 'webhook':
+            try:
+                asyncio.run(run_webhook(build_application()))
+                return
+            except Exception as e:
+                logger.error(f"Webhook mode failed ({e}), falling back to polling")
+                asyncio.set_event_loop(asyncio.new_event_loop())
+
+        application = build_application()
         logger.info("🤖 ZIVPN Telegram Bot Started Successfully")
-        updater.start_polling()
-        updater.idle()
-        
+        # Polling deletes any registered webhook first
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
     except Exception as e:
         logger.error(f"Failed to start bot: {e}")
+    finally:
+        # Let in-flight DB work (a half-done /adduser) finish before the process exits
+        db_executor.shutdown(wait=True)
 
 if __name__ == '__main__':
     main()
-
@@ -4,11 +4,19 @@ ZIVPN Enterprise Web Panel - External HTML Template
 Downloaded from: https://raw.githubusercontent.com/BaeGyee9/web-bot/main/templates/web.py
 """
 
-from flask import Flask, jsonify, render_template_string, request, redirect, url_for, session, make_response, g
-import json, re, subprocess, os, tempfile, hmac, sqlite3, datetime
+from flask import Flask, jsonify, render_template, render_template_string, request, redirect, url_for, session, make_response, g, has_request_context, Response
+import json, re, os, tempfile, sqlite3, hashlib, threading, time, queue, csv, io
+import collections, contextlib, cProfile, pstats, random
 from datetime import datetime, timedelta
-import statistics
 import requests
+import config_sync
+import dbpool
+import expiry
+import metrics
+import migrations
+import rollups
+import stats_cache
+import user_repo
 
 # Configuration
 USERS_FILE = "/etc/zivpn/users.json"
@@ -20,6 +28,16 @@ LOGO_URL = "https://raw.githubusercontent.com/BaeGyee9/khaing/main/logo.png"
 
 # GitHub Template URL
 HTML_TEMPLATE_URL = "https://raw.githubusercontent.com/BaeGyee9/web-bot/main/templates/index.html"
+# Local copy of the template (seeded by udp.sh) and how often it is revalidated against GitHub
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "/etc/zivpn/templates")
+TEMPLATE_REVALIDATE_SECONDS = int(os.environ.get("TEMPLATE_REVALIDATE_SECONDS", "300"))
+LOGIN_BLOCK_START = '<!-- START_LOGIN_BLOCK -->'
+LOGIN_BLOCK_END = '<!-- END_LOGIN_BLOCK -->'
+# Live event stream (/api/stream)
+STREAM_POLL_SECONDS = float(os.environ.get("STREAM_POLL_SECONDS", "1"))
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_CLIENT_QUEUE = 256
+STREAM_RETRY_MS = 3000
 
 # --- Localization Data ---
 TRANSLATIONS = {
@@ -31,7 +49,7 @@ TRANSLATIONS = {
         'active_users': 'Online Users', 'bandwidth_used': 'Total Data Used',
         'expiry_date': 'Expiry Date', 'status': 'Status', 'traffic': 'Traffic',
         'actions': 'Actions', 'add_user': 'Add User', 'renew_user': 'Renew User',
-        'suspend': 'Suspend', 'activate': 'Activate', 'delete': 'Delete',
+        'suspend': 'Suspend', 'activate': 'Activate', 'delete': 'Delete', 'expired': 'Expired',
         'edit': 'Edit', 'days': 'Days', 'submit': 'Submit', 'cancel': 'Cancel',
         'confirm_delete': 'Are you sure you want to delete this user?',
         'confirm_suspend': 'Are you sure you want to suspend this user?',
@@ -55,7 +73,7 @@ TRANSLATIONS = {
         'active_users': 'အွန်လိုင်း အသုံးပြုသူ', 'bandwidth_used': 'အသုံးပြုပြီးသား ဒေတာပမာဏ',
         'expiry_date': 'သက်တမ်းကုန်ဆုံးရက်', 'status': 'အခြေအနေ', 'traffic': 'ဒေတာပမာဏ',
         'actions': 'လုပ်ဆောင်ချက်များ', 'add_user': 'အသုံးပြုသူ အသစ်ထည့်မည်', 'renew_user': 'သက်တမ်းတိုးမည်',
-        'suspend': 'ဆိုင်းငံ့မည်', 'activate': 'ပြန်လည်ဖွင့်မည်', 'delete': 'ဖျက်ပစ်မည်',
+        'suspend': 'ဆိုင်းငံ့မည်', 'activate': 'ပြန်လည်ဖွင့်မည်', 'delete': 'ဖျက်ပစ်မည်', 'expired': 'သက်တမ်းကုန်',
         'edit': 'ပြင်ဆင်မည်', 'days': 'ရက်ပေါင်း', 'submit': 'အတည်ပြုမည်', 'cancel': 'ဖျက်သိမ်းမည်',
         'confirm_delete': 'ဤအသုံးပြုသူကို ဖျက်ပစ်ရန် သေချာပါသလား။',
         'confirm_suspend': 'ဤအသုံးပြုသူကို ဆိုင်းငံ့ရန် သေချာပါသလား။',
@@ -75,28 +93,180 @@ TRANSLATIONS = {
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
+metrics.instrument_flask(app, 'web')
+
+# Bring the schema up to date once per process instead of probing on every connection
+migrations.migrate(DATABASE_PATH)
 
 # --- Database Functions ---
 def get_db():
-    db = sqlite3.connect(DATABASE_PATH)
-    db.row_factory = sqlite3.Row
-    # Check and update schema for max_clients (critical for new feature)
-    try:
-        db.execute('SELECT max_clients FROM users LIMIT 1').fetchone()
-    except sqlite3.OperationalError:
-        print("Database schema updated: Adding max_clients column...")
-        db.execute('ALTER TABLE users ADD COLUMN max_clients INTEGER DEFAULT 1')
-        db.commit()
-    # Check and update schema for active_clients (for real-time tracking)
-    try:
-        db.execute('SELECT active_clients FROM users LIMIT 1').fetchone()
-    except sqlite3.OperationalError:
-        print("Database schema updated: Adding active_clients column...")
-        # active_clients should default to 0
-        db.execute('ALTER TABLE users ADD COLUMN active_clients INTEGER DEFAULT 0') 
-        db.commit()
+    """Borrow this thread's pooled connection; it is handed back at request teardown at the latest."""
+    db = dbpool.get_db(DATABASE_PATH)
+    if has_request_context():
+        g.db = db
     return db
 
+@app.teardown_request
+def release_db(exc):
+    if g.pop('db', None) is not None:
+        dbpool.release_thread(DATABASE_PATH)
+
+# --- Profiling (opt-in) ---
+# PROFILE_ENABLED=1 (or the toggle on /profiling) turns on per-request phase timings, slow SQL
+# logging with EXPLAIN QUERY PLAN, and cProfile on a PROFILE_SAMPLE_RATE fraction of requests;
+# sampled requests over PROFILE_BUDGET_MS are dumped to PROFILE_DIR. Off, it costs one flag check.
+PROFILE_ENABLED = os.environ.get("PROFILE_ENABLED", "0") == "1"
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0.01"))
+PROFILE_BUDGET_MS = float(os.environ.get("PROFILE_BUDGET_MS", "500"))
+PROFILE_SLOW_SQL_MS = float(os.environ.get("PROFILE_SLOW_SQL_MS", "100"))
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/etc/zivpn/profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "50"))
+PROFILE_NAME_RE = re.compile(r'^[\w.-]+\.(prof|txt)$')
+# One cProfile at a time: from Python 3.12 a second enable() raises and a profile records every thread
+PROFILE_LOCK = threading.Lock()
+
+PHASE_SECONDS = metrics.histogram('zivpn_web_phase_seconds', 'Request phase time while profiling is on.',
+                                  ('route', 'phase'))
+
+class RequestProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.sample_rate = PROFILE_SAMPLE_RATE
+        self.budget_ms = PROFILE_BUDGET_MS
+        self.slow_sql_ms = PROFILE_SLOW_SQL_MS
+        self.lock = threading.Lock()
+        self.slow_queries = collections.deque(maxlen=100)
+        self.slow_requests = collections.deque(maxlen=100)
+        self.plans = {}   # sql -> plan text; statements are few, so this stays small
+
+    def configure(self, enabled, sample_rate=None, budget_ms=None, slow_sql_ms=None):
+        if sample_rate is not None: self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if budget_ms is not None: self.budget_ms = max(budget_ms, 1.0)
+        if slow_sql_ms is not None: self.slow_sql_ms = max(slow_sql_ms, 1.0)
+        self.enabled = enabled
+        dbpool.set_slow_query_hook(self.slow_query if enabled else None, self.slow_sql_ms / 1000.0)
+
+    def plan(self, conn, sql, params):
+        """EXPLAIN QUERY PLAN for a statement, once per distinct SQL text."""
+        plan = self.plans.get(sql)
+        if plan is None:
+            if params is None:
+                return '(executemany, not explained)'
+            try:
+                rows = sqlite3.Connection.execute(conn, 'EXPLAIN QUERY PLAN ' + sql, params).fetchall()
+                plan = ' / '.join(row[3] for row in rows) or '-'
+            except sqlite3.Error as e:
+                plan = f'(no plan: {e})'
+            with self.lock:
+                if len(self.plans) >= 500:
+                    self.plans.clear()
+                self.plans[sql] = plan
+        return plan
+
+    def slow_query(self, conn, sql, params, seconds):
+        """dbpool hook: log a statement over the slow-SQL threshold with its plan."""
+        text = ' '.join(sql.split())
+        plan = self.plan(conn, sql, params)
+        path = request.path if has_request_context() else '-'
+        print(f"Slow SQL {seconds * 1000:.0f} ms on {path}: {text[:300]} | plan: {plan}")
+        self.slow_queries.appendleft({
+            'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'ms': round(seconds * 1000, 1),
+            'path': path, 'sql': text[:1000], 'plan': plan,
+        })
+
+    def dump(self, prof, route, elapsed_ms):
+        """Write a sampled profile (.prof for snakeviz/flameprof, .txt summary) and rotate old ones."""
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+        base = os.path.join(PROFILE_DIR, f"{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}-{slug}-{elapsed_ms:.0f}ms")
+        prof.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as f:
+            pstats.Stats(prof, stream=f).sort_stats('cumulative').print_stats(40)
+        for name in self.profiles()[PROFILE_KEEP:]:
+            for ext in ('.prof', '.txt'):
+                try: os.remove(os.path.join(PROFILE_DIR, name + ext))
+                except OSError: pass
+
+    def profiles(self):
+        """Dump names (without extension), newest first."""
+        try:
+            return sorted((n[:-5] for n in os.listdir(PROFILE_DIR) if n.endswith('.prof')), reverse=True)
+        except OSError:
+            return []
+
+profiler = RequestProfiler()
+profiler.configure(PROFILE_ENABLED)
+
+@contextlib.contextmanager
+def phase(name):
+    """Time a block of the current request as `name` while profiling is on."""
+    if not profiler.enabled or not has_request_context() or 'profile_started' not in g:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.phases.append((name, time.perf_counter() - started))
+
+@app.before_request
+def profile_start():
+    if not profiler.enabled:
+        return
+    g.profile_started = time.perf_counter()
+    g.phases = []
+    # Streams stay open for minutes; their handler time means nothing
+    if request.endpoint != 'stream_api' and random.random() < profiler.sample_rate:
+        # Skip the sample rather than wait if another request is being profiled
+        if not PROFILE_LOCK.acquire(blocking=False):
+            return
+        g.profile_locked = True
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError as e:
+            print(f"Profiler unavailable: {e}")
+            return
+        g.cprofile = prof
+
+@app.teardown_request
+def profile_release(exc):
+    # after_request is skipped when the view raises, so the profiler and lock are let go here
+    prof = g.pop('cprofile', None)
+    if prof is not None:
+        prof.disable()
+    if g.pop('profile_locked', False):
+        PROFILE_LOCK.release()
+
+@app.after_request
+def profile_finish(response):
+    started = g.pop('profile_started', None)
+    if started is None:
+        return response
+    prof = g.pop('cprofile', None)
+    if prof is not None:
+        prof.disable()
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    phases = g.pop('phases', [])
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    for name, seconds in phases:
+        PHASE_SECONDS.observe(seconds, route, name)
+    response.headers['Server-Timing'] = ', '.join(
+        [f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases] + [f"total;dur={elapsed_ms:.1f}"])
+    if elapsed_ms >= profiler.budget_ms:
+        summary = ', '.join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in phases) or 'no phases'
+        print(f"Slow request {request.method} {request.path}: {elapsed_ms:.0f} ms ({summary})")
+        profiler.slow_requests.appendleft({
+            'at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'), 'ms': round(elapsed_ms, 1),
+            'path': request.path, 'phases': summary, 'sampled': prof is not None,
+        })
+        if prof is not None:
+            try:
+                profiler.dump(prof, route, elapsed_ms)
+            except OSError as e:
+                print(f"Error writing profile: {e}")
+    return response
+
 def read_config():
     try:
         with open(CONFIG_FILE, 'r') as f:
@@ -116,29 +286,19 @@ def get_online_users():
     return online_users
 
 def sync_config_passwords():
-    """Sync passwords back to the users.json file for the core VPN service"""
-    db = get_db()
-    users = db.execute("SELECT username, password, status, expiry_date, data_limit_bytes, used_bytes FROM users WHERE status != 'deleted'").fetchall()
-    db.close()
-    
-    user_data = {}
-    for user in users:
-        # Build the user structure expected by the VPN core system
-        # The core system uses the 'status' and 'password'
-        user_data[user['username']] = {
-            'password': user['password'],
-            'status': user['status'],
-            'expiry_date': user['expiry_date'],
-            'data_limit_bytes': user['data_limit_bytes'],
-            'used_bytes': user['used_bytes'],
-        }
-        
+    """Queue a sync of users.json/config.json; zivpn-sync.service coalesces and applies it"""
+    # Every user mutation ends up here, so this is also where cached totals and users are dropped
+    stats_cache.invalidate()
+    user_repo.invalidate()
     try:
-        write_json_atomic(USERS_FILE, user_data)
-        subprocess.run(["systemctl", "restart", "zivpn.service"], check=False) # Restart service to apply changes
-        print("Configuration synchronized and zivpn service restarted.")
+        with phase('sync'):
+            config_sync.request_sync()
     except Exception as e:
-        print(f"Error syncing configuration: {e}")
+        print(f"Error queueing configuration sync: {e}")
+    # Renewals and suspensions reschedule zivpn-expiry.service without waiting for its poll
+    expiry.notify()
+    # Push the change to open panels now instead of on the next poll
+    event_hub.notify()
 
 def write_json_atomic(path, data):
     """Safely write JSON data to a file."""
@@ -153,6 +313,269 @@ def write_json_atomic(path, data):
         os.remove(tmp)
         raise e
 
+# --- HTML Template Store ---
+class TemplateStore:
+    """Keeps index.html on disk and compiled Jinja templates in memory.
+
+    The remote copy is revalidated in a background thread with ETag/Last-Modified,
+    so page loads never wait on GitHub and the last good copy survives outages.
+    """
+
+    def __init__(self, url, cache_dir, max_age):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.path = os.path.join(cache_dir, "index.html")
+        self.meta_path = os.path.join(cache_dir, "index.meta.json")
+        self.lock = threading.Lock()
+        self.source = None
+        self.version = None
+        self.etag = None
+        self.last_modified = None
+        self.checked_at = 0
+        self.refreshing = False
+        self.compiled = {}
+        self._load_disk()
+
+    def _load_disk(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                source = f.read()
+        except OSError:
+            return
+        meta = {}
+        try:
+            with open(self.meta_path, 'r') as f:
+                meta = json.load(f)
+        except Exception:
+            pass
+        self._set_source(source, meta.get('etag'), meta.get('last_modified'))
+        self.checked_at = meta.get('checked_at', 0)
+
+    def _set_source(self, source, etag, last_modified):
+        version = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            if version != self.version:
+                # Compiled templates are per version; drop the ones from the old copy
+                self.compiled = {}
+            self.source = source
+            self.version = version
+            self.etag = etag
+            self.last_modified = last_modified
+
+    def _save_disk(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=self.cache_dir)
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(self.source)
+        os.replace(tmp, self.path)
+        write_json_atomic(self.meta_path, {
+            'etag': self.etag,
+            'last_modified': self.last_modified,
+            'checked_at': self.checked_at,
+            'version': self.version,
+        })
+
+    def revalidate(self):
+        """Conditional GET against GitHub; keeps the current copy on any failure."""
+        headers = {}
+        if self.source is not None:
+            if self.etag:
+                headers['If-None-Match'] = self.etag
+            if self.last_modified:
+                headers['If-Modified-Since'] = self.last_modified
+        try:
+            response = requests.get(self.url, headers=headers, timeout=10)
+            if response.status_code == 304:
+                self.checked_at = time.time()
+            else:
+                response.raise_for_status()
+                self._set_source(response.text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                self.checked_at = time.time()
+            self._save_disk()
+        except Exception as e:
+            print(f"Error revalidating HTML template: {e}")
+            # Back off for a full interval instead of retrying on every request
+            self.checked_at = time.time()
+        finally:
+            self.refreshing = False
+
+    def _maybe_refresh(self):
+        if self.source is None:
+            # Nothing on disk yet: the very first load has to wait for the download
+            if not self.refreshing and time.time() - self.checked_at >= min(self.max_age, 30):
+                self.refreshing = True
+                self.revalidate()
+            return
+        if time.time() - self.checked_at < self.max_age or self.refreshing:
+            return
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.revalidate, daemon=True).start()
+
+    def get(self, block=None):
+        """Return the compiled page (or the login block slice), or None if unavailable."""
+        self._maybe_refresh()
+        with self.lock:
+            source, version = self.source, self.version
+            template = self.compiled.get((version, block))
+        if template is not None or source is None:
+            return template
+        if block == 'login':
+            if LOGIN_BLOCK_START not in source or LOGIN_BLOCK_END not in source:
+                return None
+            source = source.split(LOGIN_BLOCK_START, 1)[1].split(LOGIN_BLOCK_END, 1)[0]
+        template = app.jinja_env.from_string(source)
+        with self.lock:
+            if version == self.version:
+                self.compiled[(version, block)] = template
+        return template
+
+template_store = TemplateStore(HTML_TEMPLATE_URL, TEMPLATE_CACHE_DIR, TEMPLATE_REVALIDATE_SECONDS)
+
+# --- Live Event Hub (SSE) ---
+STREAM_USER_FIELDS = ('username', 'status', 'expiry_date', 'data_limit_bytes', 'used_bytes', 'max_clients', 'active_clients')
+STREAM_RESYNC = object()
+
+def format_event(event, data, event_id=None):
+    """One text/event-stream frame."""
+    frame = f"id: {event_id}\n" if event_id is not None else ""
+    return frame + f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def user_change_events(db, since, upto):
+    """(row_version, frame) pairs of `user`/`deleted` frames for every row whose row_version is in (since, upto].
+
+    Rows only carry their latest state, so this is also how a reconnecting client
+    replays whatever it missed: the event id is the row version.
+    """
+    rows = db.execute(
+        f"SELECT {', '.join(STREAM_USER_FIELDS)}, row_version FROM users "
+        "WHERE row_version > ? AND row_version <= ? ORDER BY row_version",
+        (since, upto)
+    ).fetchall()
+    tombstones = db.execute(
+        "SELECT username, row_version FROM user_tombstones WHERE row_version > ? AND row_version <= ?", (since, upto)
+    ).fetchall()
+    events = []
+    for r in rows:
+        if r['status'] == 'deleted':
+            events.append((r['row_version'], format_event('deleted', {'username': r['username']}, r['row_version'])))
+        else:
+            events.append((r['row_version'], format_event('user', {f: r[f] for f in STREAM_USER_FIELDS}, r['row_version'])))
+    for r in tombstones:
+        events.append((r['row_version'], format_event('deleted', {'username': r['username']}, r['row_version'])))
+    events.sort(key=lambda e: e[0])
+    return events
+
+class EventHub:
+    """Single poller that turns database changes into SSE frames for every open panel.
+
+    Writers live in several processes (web, bot, api.py, cleanup.py, connection manager),
+    so the hub watches the users change counter and the config_sync row instead of
+    relying on in-process calls; notify() just wakes it early after our own mutations.
+    One delta query per change is shared by all subscribers. A subscriber whose queue
+    fills up is not allowed to hold the others back: its queue is replaced by a resync
+    marker and it catches up from the database on its own.
+    """
+
+    def __init__(self, poll_seconds):
+        self.poll_seconds = poll_seconds
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.wake = threading.Event()
+        self.thread = None
+        self.version = None
+        self.stats = None
+        self.synced_version = None
+
+    def subscribe(self, since):
+        """Register a client that has seen every change up to `since`; returns its queue."""
+        sub = queue.Queue(maxsize=STREAM_CLIENT_QUEUE)
+        with self.lock:
+            self.subscribers.add(sub)
+            # Never start past what the client has seen; anything it gets twice is skipped by id
+            if self.version is None or since < self.version:
+                self.version = since
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self.lock:
+            self.subscribers.discard(sub)
+
+    def notify(self):
+        self.wake.set()
+
+    def publish(self, frames):
+        """Queue (event_id, frame) pairs for every subscriber without ever blocking."""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for sub in subscribers:
+            for frame in frames:
+                try:
+                    sub.put_nowait(frame)
+                except queue.Full:
+                    # Slow client: drop its backlog and let it replay from the database
+                    while True:
+                        try:
+                            sub.get_nowait()
+                        except queue.Empty:
+                            break
+                    sub.put_nowait(STREAM_RESYNC)
+                    break
+
+    def poll(self):
+        db = dbpool.get_db(DATABASE_PATH)
+        try:
+            with self.lock:
+                since = self.version
+            version = db.execute("SELECT version FROM change_counter WHERE id = 1").fetchone()[0]
+            frames = []
+            if version != since:
+                frames += user_change_events(db, since, version)
+            with self.lock:
+                # A subscribe() during this poll may have moved the baseline back; keep it then
+                if self.version == since:
+                    self.version = version
+
+            totals = stats_cache.get_stats(db)
+            stats = {'total_users': totals['total_users'], 'online_users': totals['active_users'],
+                     'used_bytes': totals['total_used_bytes']}
+            if stats != self.stats:
+                frames.append((None, format_event('stats', stats)))
+                self.stats = stats
+
+            sync = config_sync.sync_status(db)
+            if self.synced_version is not None and sync['synced_version'] != self.synced_version:
+                frames.append((None, format_event('sync', {'synced_version': sync['synced_version'], 'synced_at': sync['synced_at'],
+                                                           'last_error': sync['last_error']})))
+            self.synced_version = sync['synced_version']
+        finally:
+            db.close()
+        if frames:
+            self.publish(frames)
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.subscribers:
+                    # Idle panels cost nothing; the next subscribe() starts a fresh poller
+                    self.thread = None
+                    self.version = self.stats = self.synced_version = None
+                    return
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling live events: {e}")
+            self.wake.wait(self.poll_seconds)
+            self.wake.clear()
+
+event_hub = EventHub(STREAM_POLL_SECONDS)
+
 # --- Auth/Global Context ---
 def require_login():
     """Checks if the user is logged in as Admin"""
@@ -186,76 +609,39 @@ def index():
     if not require_login():
         return redirect(url_for('login'))
         
-    try:
-        response = requests.get(HTML_TEMPLATE_URL)
-        response.raise_for_status()
-        template_content = response.text
-    except Exception as e:
-        print(f"Error loading HTML template: {e}")
-        # Fallback template if fetching fails
-        template_content = f"<h1>{t['title']}</h1><p>Error loading content: {e}</p>"
+    with phase('template'):
+        template = template_store.get()
+    if template is None:
+        # Fallback template if no copy could be fetched yet
+        template = f"<h1>{t['title']}</h1><p>Error loading content: template unavailable</p>"
 
     db = get_db()
     
-    # 1. Dashboard Stats
-    total_users = db.execute("SELECT COUNT(*) FROM users WHERE status != 'deleted'").fetchone()[0]
-    
-    # This assumes that the core service (zivpn-api.service) updates the 'active_users' table or similar.
-    # For now, we rely on the `active_clients` column which is updated by the server's connection scripts.
-    active_users = db.execute("SELECT COUNT(DISTINCT username) FROM users WHERE active_clients > 0 AND status = 'active'").fetchone()[0]
-    
-    total_used_bytes = db.execute("SELECT SUM(used_bytes) FROM users").fetchone()[0] or 0
-    total_data_limit = db.execute("SELECT SUM(data_limit_bytes) FROM users").fetchone()[0] or 0
-    
-    # Helper for converting bytes to readable format
-    def bytes_to_readable(b):
-        if b is None: return "0 B"
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if b < 1024.0:
-                return f"{b:3.2f} {unit}"
-            b /= 1024.0
-        return f"{b:3.2f} PB"
+    # 1. Dashboard Stats (one pass over users, cached for a few seconds)
+    # Online users rely on the `active_clients` column which is updated by the server's connection scripts.
+    with phase('stats'):
+        totals = stats_cache.get_stats(db)
+    bytes_to_readable = user_repo.bytes_to_readable
 
     stats = {
-        'total_users': total_users,
-        'active_users': active_users,
-        'used_total': bytes_to_readable(total_used_bytes),
-        'limit_total': bytes_to_readable(total_data_limit),
+        'total_users': totals['total_users'],
+        'active_users': totals['active_users'],
+        'used_total': bytes_to_readable(totals['total_used_bytes']),
+        'limit_total': bytes_to_readable(totals['total_data_limit']),
     }
 
-    # 2. Users List
-    users_raw = db.execute("SELECT username, status, expiry_date, data_limit_bytes, used_bytes, max_clients, active_clients FROM users WHERE status != 'deleted' ORDER BY username ASC").fetchall()
-    
-    users = []
-    for u in users_raw:
-        user_dict = dict(u)
-        user_dict['used_readable'] = bytes_to_readable(u['used_bytes'])
-        user_dict['limit_readable'] = bytes_to_readable(u['data_limit_bytes'])
-        
-        # Calculate percentage for progress bar
-        if u['data_limit_bytes'] and u['data_limit_bytes'] > 0:
-            user_dict['usage_percent'] = min(100, round((u['used_bytes'] / u['data_limit_bytes']) * 100, 2))
-        else:
-            user_dict['usage_percent'] = 0
-
-        # Status check
-        if u['status'] == 'suspended':
-            user_dict['display_status'] = t['suspend']
-        elif u['expiry_date'] and datetime.strptime(u['expiry_date'], '%Y-%m-%d %H:%M:%S') < datetime.now():
-            user_dict['display_status'] = t['expired']
-        else:
-            user_dict['display_status'] = t['activate']
-            
-        users.append(user_dict)
-    
+    # 2. Users List is fetched page by page from /api/users by the browser
     db.close()
     
-    return render_template_string(template_content, 
-                                  t=t, 
-                                  lang=g.lang, 
-                                  stats=stats, 
-                                  users=users, 
-                                  bytes_to_readable=bytes_to_readable)
+    with phase('render'):
+        if isinstance(template, str):
+            return render_template_string(template, t=t)
+        return render_template(template, 
+                               t=t, 
+                               lang=g.lang, 
+                               stats=stats, 
+                               users=[], 
+                               bytes_to_readable=bytes_to_readable)
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -277,18 +663,12 @@ def login():
         else:
             return jsonify({"ok": False, "message": t['login_err']}), 401
             
-    try:
-        response = requests.get(HTML_TEMPLATE_URL)
-        response.raise_for_status()
-        template_content = response.text
-    except Exception as e:
-        template_content = f"<h1>{t['title']}</h1><p>Error loading content: {e}</p>"
-        
-    # Extract only the login section for rendering
-    # This is a simplification; a cleaner way is to use proper template inheritance.
-    login_html = template_content.split('<!-- START_LOGIN_BLOCK -->')[1].split('<!-- END_LOGIN_BLOCK -->')[0]
+    # Only the login section is rendered; the store compiles and caches that slice separately.
+    login_template = template_store.get(block='login')
+    if login_template is None:
+        return render_template_string(f"<h1>{t['title']}</h1><p>Error loading content: login template unavailable</p>")
 
-    return render_template_string(login_html, t=t, lang=g.lang)
+    return render_template(login_template, t=t, lang=g.lang)
 
 
 @app.route("/logout")
@@ -299,63 +679,192 @@ def logout():
 
 # --- API Routes for User Management ---
 
-# --- API: Get All Users (for dynamic table update) ---
+# --- API: Get Users (keyset-paginated, for dynamic table update) ---
+USER_PAGE_DEFAULT = 100
+USER_PAGE_MAX = 1000
+# Sort keys map to columns that have a (column, username) index, so every page is an index range scan
+USER_SORT_KEYS = {
+    'username': 'username',
+    'expiry_date': 'expiry_date',
+    'used_bytes': 'used_bytes',
+    'active_clients': 'active_clients',
+}
+USER_DB_FIELDS = ('username', 'password', 'status', 'expiry_date', 'data_limit_bytes', 'used_bytes', 'max_clients', 'active_clients')
+USER_COMPUTED_FIELDS = tuple(user_repo.COMPUTED_FIELDS)
+# Passwords are only sent when a caller asks for them explicitly
+USER_DEFAULT_FIELDS = tuple(f for f in USER_DB_FIELDS if f != 'password') + USER_COMPUTED_FIELDS
+
+def keyset_condition(col, descending, cursor_value, cursor_user):
+    """WHERE clause selecting rows strictly after (cursor_value, cursor_user) in ORDER BY col, username.
+
+    SQLite sorts NULLs first, so they need their own branches instead of a row-value compare.
+    """
+    if col == 'username':
+        return ("username < ?" if descending else "username > ?"), [cursor_user]
+    if cursor_value is None:
+        if descending:
+            return f"({col} IS NULL AND username < ?)", [cursor_user]
+        return f"(({col} IS NULL AND username > ?) OR {col} IS NOT NULL)", [cursor_user]
+    if descending:
+        return f"({col} < ? OR ({col} = ? AND username < ?) OR {col} IS NULL)", [cursor_value, cursor_value, cursor_user]
+    return f"({col} > ? OR ({col} = ? AND username > ?))", [cursor_value, cursor_value, cursor_user]
+
+def users_etag(db, version, now_str):
+    """Strong validator for /api/users responses.
+
+    The change counter moves on every users insert/update/delete (see migration 6). The
+    expired count covers users whose display status flips with time alone, and the
+    digest keeps different queries and languages apart.
+
+    Usage counts too: used_bytes and active_clients are versioned columns, because every
+    response carries them (and the usage totals). So while zivpn-api flushes bandwidth
+    or the connection manager writes active_clients, the ETag changes with each flush
+    and a poll gets a 304 only between flushes. since=<version> stays cheap either way.
+    """
+    expired = db.execute("SELECT COUNT(*) FROM users WHERE expiry_date < ?", (now_str,)).fetchone()[0]
+    digest = hashlib.sha1(f"{request.query_string.decode()}|{g.lang}".encode()).hexdigest()[:12]
+    return f"users-{version}-{expired}-{digest}"
+
 @app.route("/api/users")
 def get_users_api():
+    """Query params: limit, after=<username>, sort, order=asc|desc, status, expired=0|1,
+    online=1, expires_before/expires_after=YYYY-MM-DD, min_usage_percent, over_quota=1, fields=a,b,c
+
+    since=<version> returns only rows changed after that version (and the usernames deleted
+    since), ignoring sort and filters; pass the returned `version` back on the next call.
+    Usage writes move the version too, so see users_etag() for when a 304 can be expected.
+    """
     t = g.t
     if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
-    
+
+    args = request.args
+    try:
+        limit = min(max(int(args.get('limit', USER_PAGE_DEFAULT)), 1), USER_PAGE_MAX)
+        min_usage = float(args['min_usage_percent']) if args.get('min_usage_percent') else None
+        since = int(args['since']) if args.get('since') else None
+        for key in ('expires_before', 'expires_after'):
+            if args.get(key): datetime.strptime(args[key], '%Y-%m-%d')
+    except ValueError:
+        return jsonify({"ok": False, "message": "Invalid numeric or date input."}), 400
+    if args.get('over_quota') == '1':
+        min_usage = max(min_usage or 0, 100)
+    if since is not None and args.get('after'):
+        return jsonify({"ok": False, "message": "since and after cannot be combined."}), 400
+
+    sort = args.get('sort', 'username')
+    if sort not in USER_SORT_KEYS:
+        return jsonify({"ok": False, "message": f"Invalid sort key. Use one of: {', '.join(USER_SORT_KEYS)}"}), 400
+    sort_col = USER_SORT_KEYS[sort]
+    descending = args.get('order', 'asc').lower() == 'desc'
+
+    fields = tuple(f for f in args.get('fields', '').split(',') if f) or USER_DEFAULT_FIELDS
+    unknown = [f for f in fields if f not in USER_DB_FIELDS + USER_COMPUTED_FIELDS]
+    if unknown:
+        return jsonify({"ok": False, "message": f"Unknown fields: {', '.join(unknown)}"}), 400
+
+    now_str = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    now = user_repo.now_epoch()
     db = get_db()
-    
-    # IMPORTANT: Include max_clients and active_clients in the SELECT query
-    users_raw = db.execute("SELECT username, password, status, expiry_date, data_limit_bytes, used_bytes, max_clients, active_clients FROM users WHERE status != 'deleted' ORDER BY username ASC").fetchall()
-    db.close()
-    
-    # Helper for converting bytes to readable format (local scope)
-    def bytes_to_readable(b):
-        if b is None: return "0 B"
-        for unit in ['B', 'KB', 'MB', 'GB', 'TB']:
-            if b < 1024.0:
-                return f"{b:3.2f} {unit}"
-            b /= 1024.0
-        return f"{b:3.2f} PB"
-
-    users = []
-    for u in users_raw:
-        user_dict = dict(u)
-        user_dict['used_readable'] = bytes_to_readable(u['used_bytes'])
-        user_dict['limit_readable'] = bytes_to_readable(u['data_limit_bytes'])
-        
-        # Usage percentage
-        if u['data_limit_bytes'] and u['data_limit_bytes'] > 0:
-            user_dict['usage_percent'] = min(100, round((u['used_bytes'] / u['data_limit_bytes']) * 100, 2))
-        else:
-            user_dict['usage_percent'] = 0
 
-        # Status check
-        if u['status'] == 'suspended':
-            user_dict['display_status'] = t['suspend']
-        elif u['expiry_date'] and datetime.strptime(u['expiry_date'], '%Y-%m-%d %H:%M:%S') < datetime.now():
-            user_dict['display_status'] = t['expired']
-        else:
-            user_dict['display_status'] = t['activate']
-            
-        users.append(user_dict)
-        
-    # 3. Dashboard Stats (Re-calculate stats for API)
-    total_users = db.execute("SELECT COUNT(*) FROM users WHERE status != 'deleted'").fetchone()[0]
-    active_users = db.execute("SELECT COUNT(DISTINCT username) FROM users WHERE active_clients > 0 AND status = 'active'").fetchone()[0]
-    total_used_bytes = db.execute("SELECT SUM(used_bytes) FROM users").fetchone()[0] or 0
-    total_data_limit = db.execute("SELECT SUM(data_limit_bytes) FROM users").fetchone()[0] or 0
+    # Read the version before any rows: anything committed later carries a higher row_version
+    with phase('etag'):
+        version = db.execute("SELECT version FROM change_counter WHERE id = 1").fetchone()[0]
+        etag = users_etag(db, version, now_str)
+    if request.if_none_match.contains(etag):
+        db.close()
+        response = make_response('', 304)
+        response.set_etag(etag)
+        return response
+
+    # Only read the columns the projection needs; computed fields pull in their inputs
+    needed = set(f for f in fields if f in USER_DB_FIELDS) | {'username'}
+    for f in fields:
+        needed.update(user_repo.COMPUTED_FIELDS.get(f, ()))
+    columns = [c for c in USER_DB_FIELDS if c in needed]
+    with_epoch = 'display_status' in fields
+
+    deleted = []
+    has_more = False
+    if since is not None:
+        # Soft-deleted rows come back too, so they can be reported as removals
+        with phase('query'):
+            changed = user_repo.fetch_records(
+                db,
+                user_repo.select_sql(sorted(set(columns) | {'status', 'row_version'}), with_epoch)
+                + " WHERE row_version > ? AND row_version <= ? ORDER BY row_version LIMIT ?",
+                (since, version, limit)
+            )
+        if len(changed) == limit:
+            version = changed[-1].row_version
+            has_more = True
+        deleted = [u.username for u in changed if u.status == 'deleted']
+        deleted += [r[0] for r in db.execute(
+            "SELECT username FROM user_tombstones WHERE row_version > ? AND row_version <= ?", (since, version)
+        )]
+        users_raw = [u for u in changed if u.status != 'deleted']
+    else:
+        where, params = ["status != 'deleted'"], []
+        if args.get('status'):
+            where.append("status = ?"); params.append(args['status'])
+        if args.get('expired') == '1':
+            where.append("expiry_date < ?"); params.append(now_str)
+        elif args.get('expired') == '0':
+            where.append("(expiry_date IS NULL OR expiry_date >= ?)"); params.append(now_str)
+        if args.get('online') == '1':
+            where.append("active_clients > 0")
+        if args.get('expires_before'):
+            where.append("expiry_date < ?"); params.append(args['expires_before'])
+        if args.get('expires_after'):
+            where.append("expiry_date >= ?"); params.append(args['expires_after'])
+        if min_usage is not None:
+            where.append("data_limit_bytes > 0 AND used_bytes * 100.0 >= ? * data_limit_bytes"); params.append(min_usage)
+
+        after = args.get('after')
+        if after:
+            cursor_row = db.execute(f"SELECT {sort_col} FROM users WHERE username = ?", (after,)).fetchone()
+            if cursor_row is None:
+                db.close()
+                return jsonify({"ok": False, "message": "Unknown cursor."}), 400
+            clause, clause_params = keyset_condition(sort_col, descending, cursor_row[0], after)
+            where.append(clause); params.extend(clause_params)
+
+        direction = 'DESC' if descending else 'ASC'
+        order_by = "username " + direction if sort_col == 'username' else f"{sort_col} {direction}, username {direction}"
+        with phase('query'):
+            users_raw = user_repo.fetch_records(
+                db,
+                user_repo.select_sql(columns, with_epoch) + f" WHERE {' AND '.join(where)} ORDER BY {order_by} LIMIT ?",
+                params + [limit]
+            )
+
+    # One formatter per page: field getters and status labels are resolved once, not per row
+    with phase('format'):
+        format_user = user_repo.user_formatter(
+            fields, now, {'suspended': t['suspend'], 'expired': t['expired'], 'active': t['activate']}
+        )
+        users = [format_user(u) for u in users_raw]
+
+    # Dashboard Stats (shared single-pass cache, refreshed on user changes and every STATS_TTL_SECONDS)
+    with phase('stats'):
+        totals = stats_cache.get_stats(db)
+    db.close()
 
     stats = {
-        'total_users': total_users,
-        'active_users': active_users,
-        'used_total': bytes_to_readable(total_used_bytes),
-        'limit_total': bytes_to_readable(total_data_limit),
+        'total_users': totals['total_users'],
+        'active_users': totals['active_users'],
+        'used_total': user_repo.bytes_to_readable(totals['total_used_bytes']),
+        'limit_total': user_repo.bytes_to_readable(totals['total_data_limit']),
     }
 
-    return jsonify({"ok": True, "users": users, "stats": stats})
+    if since is not None:
+        response = jsonify({"ok": True, "users": users, "deleted": deleted, "version": version, "has_more": has_more, "stats": stats})
+    else:
+        next_cursor = users_raw[-1].username if len(users_raw) == limit else None
+        response = jsonify({"ok": True, "users": users, "next_cursor": next_cursor, "version": version, "stats": stats})
+    # Always revalidate; an unchanged list then costs a 304 with no body
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 # --- API: Add User ---
 @app.route("/api/user/add", methods=["POST"])
@@ -595,58 +1104,636 @@ def update_user_password():
     else:
         return jsonify({"ok": False, "message": "Missing username or password."}), 400
 
+# --- API: Bulk User Operations ---
+BULK_MAX_OPERATIONS = 2000
+BULK_STATUS_OPS = {'suspend': 'suspended', 'activate': 'active', 'delete': 'deleted'}
+BULK_OPS = ('add', 'renew', 'edit', 'reset_traffic') + tuple(BULK_STATUS_OPS)
+
+def parse_bulk_operation(item):
+    """Validate one bulk item without touching the database; returns (op, username, fields) or raises ValueError."""
+    if not isinstance(item, dict):
+        raise ValueError("Operation must be an object.")
+    op = item.get('op')
+    if op not in BULK_OPS:
+        raise ValueError(f"Unknown op. Use one of: {', '.join(BULK_OPS)}")
+    # 'add' names the user like /api/user/add, everything else like the other routes
+    username = item.get('username') if op == 'add' else item.get('user')
+    if not username or not isinstance(username, str):
+        raise ValueError("Missing username")
+
+    if op == 'add' and (not item.get('password') or not item.get('days')):
+        raise ValueError("Missing required fields.")
+    if op == 'renew' and not item.get('days'):
+        raise ValueError("Missing required fields")
+
+    fields = {}
+    try:
+        if op == 'add':
+            fields = {
+                'password': item['password'],
+                'days': int(item['days']),
+                'data_limit_bytes': int(item['data_limit_gb']) * (1024**3) if item.get('data_limit_gb') else 0,
+                'max_clients': max(int(item.get('max_clients', 1)), 1), # Must be at least 1
+            }
+        elif op == 'renew':
+            fields = {'days': int(item['days'])}
+        elif op == 'edit':
+            if item.get('password'):
+                fields['password'] = item['password']
+            if item.get('data_limit_gb') is not None:
+                fields['data_limit_bytes'] = int(item['data_limit_gb']) * (1024**3)
+            if item.get('max_clients') is not None:
+                fields['max_clients'] = max(int(item['max_clients']), 1)
+    except (TypeError, ValueError):
+        raise ValueError("Invalid numeric input.")
+    if op == 'edit' and not fields:
+        raise ValueError("No changes provided.")
+    return op, username, fields
+
+@app.route("/api/users/bulk", methods=["POST"])
+def bulk_users():
+    """Apply a list of add/renew/suspend/activate/delete/edit/reset_traffic operations.
+
+    Every item is validated before anything is written; if any item fails, nothing is
+    applied and the per-item results say why. Otherwise all writes go through one
+    transaction (one executemany per kind of statement) followed by a single config sync.
+    """
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+
+    data = request.get_json() or {}
+    items = data.get('operations')
+    if not isinstance(items, list) or not items:
+        return jsonify({"ok": False, "message": "Missing operations list."}), 400
+    if len(items) > BULK_MAX_OPERATIONS:
+        return jsonify({"ok": False, "message": f"At most {BULK_MAX_OPERATIONS} operations per request."}), 400
+
+    # 1. Validate shape and values
+    results = [{"index": i, "ok": True} for i in range(len(items))]
+    parsed = [None] * len(items)
+    seen = set()
+    for i, item in enumerate(items):
+        try:
+            parsed[i] = op, username, fields = parse_bulk_operation(item)
+            results[i].update(op=op, user=username)
+            # One operation per user keeps the batch order-independent
+            if username in seen:
+                raise ValueError("User appears more than once in this batch.")
+            seen.add(username)
+        except ValueError as e:
+            results[i].update(ok=False, message=str(e))
+
+    db = get_db()
+    try:
+        # 2. Validate existence with a handful of IN queries instead of one lookup per item
+        names = list(seen)
+        existing = {}
+        for start in range(0, len(names), 500):
+            chunk = names[start:start + 500]
+            rows = db.execute(
+                f"SELECT username, expiry_date FROM users WHERE username IN ({', '.join('?' * len(chunk))})", chunk
+            ).fetchall()
+            existing.update((r['username'], r['expiry_date']) for r in rows)
+
+        for i, p in enumerate(parsed):
+            if p is None:
+                continue
+            op, username, _ = p
+            if op == 'add' and username in existing:
+                results[i].update(ok=False, message=f"User '{username}' already exists.")
+            elif op != 'add' and username not in existing:
+                results[i].update(ok=False, message=t['user_not_found'])
+
+        if not all(r['ok'] for r in results):
+            for r in results:
+                if r['ok']:
+                    r.update(ok=False, message="Not applied: other operations in this batch are invalid.")
+            return jsonify({"ok": False, "message": "Nothing was applied.", "results": results}), 400
+
+        # 3. Build one parameter list per statement
+        now = datetime.now()
+        inserts, renewals, edits, resets = [], [], [], []
+        status_changes = []
+        for i, (op, username, fields) in enumerate(parsed):
+            if op == 'add':
+                expiry = (now + timedelta(days=fields['days'])).strftime('%Y-%m-%d %H:%M:%S')
+                inserts.append((username, fields['password'], 'active', expiry, fields['data_limit_bytes'], 0, fields['max_clients']))
+                results[i].update(message=t['user_added'], expiry_date=expiry)
+            elif op == 'renew':
+                current = existing[username]
+                current = datetime.strptime(current, '%Y-%m-%d %H:%M:%S') if current else now
+                # If already expired, start from now. If not expired, add to current expiry.
+                base = now if current < now else current
+                expiry = (base + timedelta(days=fields['days'])).strftime('%Y-%m-%d %H:%M:%S')
+                renewals.append((expiry, username))
+                results[i].update(message=t['user_renewed'], expiry_date=expiry)
+            elif op == 'edit':
+                edits.append((fields.get('password'), fields.get('data_limit_bytes'), fields.get('max_clients'), username))
+                results[i].update(message=t['user_updated'])
+            elif op == 'reset_traffic':
+                resets.append((username,))
+                results[i].update(message="Traffic reset successfully.")
+            else:
+                status_changes.append((BULK_STATUS_OPS[op], username))
+                results[i].update(message={'suspend': t['user_suspended'], 'activate': t['user_activated'],
+                                           'delete': t['user_deleted']}[op])
+
+        # 4. Apply everything in one transaction
+        try:
+            if inserts:
+                db.executemany('''
+                    INSERT INTO users (username, password, status, expiry_date, data_limit_bytes, used_bytes, max_clients)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', inserts)
+            if renewals:
+                db.executemany("UPDATE users SET expiry_date = ?, status = 'active' WHERE username = ?", renewals)
+            if edits:
+                db.executemany('''
+                    UPDATE users SET password = COALESCE(?, password),
+                                     data_limit_bytes = COALESCE(?, data_limit_bytes),
+                                     max_clients = COALESCE(?, max_clients)
+                    WHERE username = ?
+                ''', edits)
+            if resets:
+                db.executemany('UPDATE users SET used_bytes = 0 WHERE username = ?', resets)
+            if status_changes:
+                db.executemany('UPDATE users SET status = ? WHERE username = ?', status_changes)
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            return jsonify({"ok": False, "message": f"Bulk update failed, nothing was applied: {e}"}), 500
+    finally:
+        db.close()
+
+    sync_config_passwords()
+    return jsonify({"ok": True, "applied": len(results), "results": results})
+
+# --- API: Export / Import Users ---
+TRANSFER_COLUMNS = ('username', 'password', 'status', 'expiry_date', 'data_limit_bytes', 'used_bytes', 'max_clients')
+TRANSFER_STATUSES = ('active', 'suspended', 'deleted')
+EXPORT_CHUNK_ROWS = 1000
+IMPORT_BATCH_ROWS = 500
+IMPORT_MAX_ERRORS = 1000
+
+IMPORT_UPSERT_SQL = '''
+    INSERT INTO users (username, password, status, expiry_date, data_limit_bytes, used_bytes, max_clients)
+    VALUES (:username, :password, COALESCE(:status, 'active'), :expiry_date,
+            COALESCE(:data_limit_bytes, 0), COALESCE(:used_bytes, 0), COALESCE(:max_clients, 1))
+    ON CONFLICT(username) DO UPDATE SET
+        password = excluded.password,
+        status = COALESCE(:status, users.status),
+        expiry_date = COALESCE(:expiry_date, users.expiry_date),
+        data_limit_bytes = COALESCE(:data_limit_bytes, users.data_limit_bytes),
+        used_bytes = COALESCE(:used_bytes, users.used_bytes),
+        max_clients = COALESCE(:max_clients, users.max_clients)
+'''
+
+def transfer_format(filename=None):
+    """csv or jsonl from ?format=, else from the file extension; None if unknown."""
+    fmt = request.args.get('format')
+    if not fmt and filename:
+        fmt = filename.rsplit('.', 1)[-1].lower()
+    fmt = {'ndjson': 'jsonl', 'json': 'jsonl'}.get(fmt, fmt)
+    return fmt if fmt in ('csv', 'jsonl') else None
+
+@app.route("/api/users/export")
+def export_users():
+    """Stream the users table as CSV or JSON Lines, EXPORT_CHUNK_ROWS rows at a time."""
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+
+    fmt = transfer_format() or 'csv'
+    where = "" if request.args.get('include_deleted') == '1' else "WHERE status != 'deleted' "
+
+    def generate():
+        # The request's own connection is handed back at teardown, before streaming starts
+        db = dbpool.get_db(DATABASE_PATH)
+        try:
+            cursor = db.execute(f"SELECT {', '.join(TRANSFER_COLUMNS)} FROM users {where}ORDER BY username")
+            if fmt == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerow(TRANSFER_COLUMNS)
+            while True:
+                rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+                if not rows:
+                    break
+                if fmt == 'csv':
+                    writer.writerows(tuple(r) for r in rows)
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+                else:
+                    yield ''.join(json.dumps(dict(r), ensure_ascii=False) + '\n' for r in rows)
+            if fmt == 'csv' and buffer.tell():
+                yield buffer.getvalue()
+        finally:
+            db.close()
+
+    filename = f"zivpn-users-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(generate(), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+def parse_import_row(raw):
+    """Normalise one imported record into upsert parameters or raise ValueError."""
+    if not isinstance(raw, dict):
+        raise ValueError("Row must be an object.")
+    row = {c: (raw.get(c) if raw.get(c) not in ('', None) else None) for c in TRANSFER_COLUMNS}
+    if not row['username'] or not row['password']:
+        raise ValueError("username and password are required.")
+    row['username'], row['password'] = str(row['username']), str(row['password'])
+    if row['status'] is not None and row['status'] not in TRANSFER_STATUSES:
+        raise ValueError(f"Invalid status. Use one of: {', '.join(TRANSFER_STATUSES)}")
+    if row['expiry_date'] is not None:
+        expiry = str(row['expiry_date'])
+        try:
+            if len(expiry) == 10:
+                # Date-only values mean the end of that day, as in migration 2
+                expiry = datetime.strptime(expiry, '%Y-%m-%d').strftime('%Y-%m-%d 23:59:59')
+            else:
+                datetime.strptime(expiry, '%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            raise ValueError("Invalid expiry_date; use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS.")
+        row['expiry_date'] = expiry
+    try:
+        for c in ('data_limit_bytes', 'used_bytes', 'max_clients'):
+            if row[c] is not None:
+                row[c] = int(row[c])
+    except (TypeError, ValueError):
+        raise ValueError("Invalid numeric input.")
+    if row['max_clients'] is not None and row['max_clients'] <= 0:
+        row['max_clients'] = 1
+    return row
+
+def iter_import_rows(stream, fmt):
+    """Yield (line number, record or ValueError) from an upload without reading it whole."""
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text)
+        for record in reader:
+            yield reader.line_num, record
+        return
+    for line_num, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield line_num, json.loads(line)
+        except ValueError:
+            yield line_num, ValueError("Invalid JSON.")
+
+@app.route("/api/users/import", methods=["POST"])
+def import_users():
+    """Upsert users from a CSV or JSON Lines upload (multipart field 'file', or the raw body).
+
+    Rows are validated one by one and written IMPORT_BATCH_ROWS per transaction; bad rows are
+    skipped and reported by line. dry_run=1 validates and counts without writing.
+    """
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+
+    upload = request.files.get('file')
+    fmt = transfer_format(upload.filename if upload else None)
+    if fmt is None:
+        return jsonify({"ok": False, "message": "Unknown format; use format=csv or format=jsonl."}), 400
+    dry_run = request.args.get('dry_run') == '1'
+    stream = upload.stream if upload else request.stream
+
+    summary = {"rows": 0, "inserted": 0, "updated": 0, "failed": 0}
+    errors = []
+    batch = []
+
+    def fail(line_num, username, message):
+        summary['failed'] += 1
+        if len(errors) < IMPORT_MAX_ERRORS:
+            errors.append({"line": line_num, "username": username, "message": message})
+
+    db = get_db()
+
+    def flush():
+        names = [row['username'] for _, row in batch]
+        existing = {r[0] for r in db.execute(
+            f"SELECT username FROM users WHERE username IN ({', '.join('?' * len(names))})", names
+        )}
+        applied = batch
+        if not dry_run:
+            try:
+                db.executemany(IMPORT_UPSERT_SQL, [row for _, row in batch])
+                db.commit()
+            except sqlite3.Error:
+                # Find the offending rows one by one; the rest of the batch still goes in
+                db.rollback()
+                applied = []
+                for line_num, row in batch:
+                    try:
+                        db.execute(IMPORT_UPSERT_SQL, row)
+                        applied.append((line_num, row))
+                    except sqlite3.Error as e:
+                        fail(line_num, row['username'], str(e))
+                db.commit()
+        # A username repeated inside one batch counts as an insert followed by updates
+        for _, row in applied:
+            if row['username'] in existing:
+                summary['updated'] += 1
+            else:
+                summary['inserted'] += 1
+                existing.add(row['username'])
+        batch.clear()
+
+    try:
+        for line_num, record in iter_import_rows(stream, fmt):
+            summary['rows'] += 1
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                batch.append((line_num, parse_import_row(record)))
+            except ValueError as e:
+                fail(line_num, record.get('username') if isinstance(record, dict) else None, str(e))
+                continue
+            if len(batch) >= IMPORT_BATCH_ROWS:
+                flush()
+        if batch:
+            flush()
+    except (csv.Error, UnicodeDecodeError) as e:
+        db.rollback()
+        summary['failed'] += len(batch)
+        committed = 0 if dry_run else summary['inserted'] + summary['updated']
+        return jsonify({"ok": False, "message": f"Could not read the file after {summary['rows']} rows "
+                                                f"({committed} already committed): {e}",
+                        "dry_run": dry_run, "committed": committed, "summary": summary, "errors": errors}), 400
+    finally:
+        db.close()
+        # Batches commit as they go, so sync on every exit once anything was written
+        if not dry_run and summary['inserted'] + summary['updated']:
+            sync_config_passwords()
+
+    return jsonify({"ok": True, "dry_run": dry_run, "summary": summary, "errors": errors})
+
+# --- API: Config Sync Status ---
+@app.route("/api/sync/status")
+def sync_status_api():
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+    return jsonify({"ok": True, "sync": config_sync.sync_status()})
+
+# --- API: Live Event Stream (SSE) ---
+@app.route("/api/stream")
+def stream_api():
+    """Server-Sent Events: user, deleted, stats and sync events, plus a heartbeat comment.
+
+    Reconnects send Last-Event-ID (a users row version) and get what they missed replayed;
+    a first connection may pass ?since=<version> from /api/users for the same effect.
+    """
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+
+    try:
+        last_id = request.headers.get('Last-Event-ID') or request.args.get('since')
+        last_id = int(last_id) if last_id else None
+    except ValueError:
+        return jsonify({"ok": False, "message": "Invalid event id."}), 400
+
+    db = get_db()
+    version = db.execute("SELECT version FROM change_counter WHERE id = 1").fetchone()[0]
+    initial = user_change_events(db, last_id, version) if last_id is not None else []
+    totals = stats_cache.get_stats(db)
+    db.close()
+    initial.append((None, format_event('stats', {'total_users': totals['total_users'], 'online_users': totals['active_users'],
+                                                 'used_bytes': totals['total_used_bytes']})))
+    sub = event_hub.subscribe(version)
+
+    def generate():
+        last = version
+        last_plain = initial[-1][1]
+        try:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+            for _, frame in initial:
+                yield frame
+            while True:
+                try:
+                    item = sub.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    # Keeps proxies from timing out the connection and detects gone clients
+                    yield ": ping\n\n"
+                    continue
+                if item is STREAM_RESYNC:
+                    replay_db = dbpool.get_db(DATABASE_PATH)
+                    try:
+                        upto = replay_db.execute("SELECT version FROM change_counter WHERE id = 1").fetchone()[0]
+                        replay = user_change_events(replay_db, last, upto)
+                    finally:
+                        replay_db.close()
+                    for _, frame in replay:
+                        yield frame
+                    last = max(last, upto)
+                    continue
+                event_id, frame = item
+                if event_id is not None:
+                    if event_id <= last:
+                        continue
+                    last = event_id
+                elif frame == last_plain:
+                    # e.g. the poller's first stats frame repeats the one sent on connect
+                    continue
+                else:
+                    last_plain = frame
+                yield frame
+        finally:
+            event_hub.unsubscribe(sub)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# --- API: Database Pool Stats ---
+@app.route("/api/db/stats")
+def db_stats_api():
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+    return jsonify({"ok": True, "pool": dbpool.pool_stats(DATABASE_PATH), "user_cache": user_repo.cache_stats()})
+
+# --- Prometheus Metrics ---
+@app.route("/metrics")
+def metrics_endpoint():
+    """This process's metrics plus the files written by the bot, sync worker and connection manager"""
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    return Response(metrics.render(include_files=True), content_type=metrics.CONTENT_TYPE)
+
+# --- Admin: Profiling ---
+PROFILING_TEMPLATE = """<!doctype html>
+<html><head><meta charset="utf-8"><title>{{ t['title'] }} - Profiling</title>
+<style>body{font-family:sans-serif;margin:1.5em}table{border-collapse:collapse;width:100%;margin-bottom:1.5em}
+td,th{border:1px solid #ccc;padding:4px 6px;text-align:left;vertical-align:top;font-size:13px}code{white-space:pre-wrap}</style>
+</head><body>
+<h2>Profiling {{ 'ON' if p.enabled else 'OFF' }}</h2>
+<form method="post">
+  <label><input type="checkbox" name="enabled" value="1" {{ 'checked' if p.enabled }}> Enabled</label>
+  Sample rate <input name="sample_rate" size="5" value="{{ p.sample_rate }}">
+  Budget (ms) <input name="budget_ms" size="5" value="{{ p.budget_ms }}">
+  Slow SQL (ms) <input name="slow_sql_ms" size="5" value="{{ p.slow_sql_ms }}">
+  <button type="submit">Save</button>
+</form>
+<h3>Slow requests</h3>
+<table><tr><th>At</th><th>ms</th><th>Path</th><th>Phases</th><th>Profiled</th></tr>
+{% for r in p.slow_requests %}<tr><td>{{ r.at }}</td><td>{{ r.ms }}</td><td>{{ r.path }}</td><td>{{ r.phases }}</td><td>{{ 'yes' if r.sampled }}</td></tr>{% endfor %}
+</table>
+<h3>Slow SQL</h3>
+<table><tr><th>At</th><th>ms</th><th>Path</th><th>SQL</th><th>Plan</th></tr>
+{% for q in p.slow_queries %}<tr><td>{{ q.at }}</td><td>{{ q.ms }}</td><td>{{ q.path }}</td><td><code>{{ q.sql }}</code></td><td><code>{{ q.plan }}</code></td></tr>{% endfor %}
+</table>
+<h3>Profiles</h3>
+<p>.prof files open in snakeviz or flameprof for a flame graph.</p>
+<table>{% for name in profiles %}<tr><td>{{ name }}</td>
+<td><a href="{{ url_for('profiling_file', name=name + '.txt') }}">summary</a></td>
+<td><a href="{{ url_for('profiling_file', name=name + '.prof') }}">.prof</a></td></tr>{% endfor %}
+</table>
+</body></html>"""
+
+@app.route("/profiling", methods=["GET", "POST"])
+def profiling_page():
+    t = g.t
+    if not require_login():
+        return redirect(url_for('login'))
+    if request.method == "POST":
+        try:
+            profiler.configure(
+                request.form.get('enabled') == '1',
+                float(request.form.get('sample_rate', profiler.sample_rate)),
+                float(request.form.get('budget_ms', profiler.budget_ms)),
+                float(request.form.get('slow_sql_ms', profiler.slow_sql_ms)),
+            )
+        except ValueError:
+            return "Invalid numeric input.", 400
+        return redirect(url_for('profiling_page'))
+    return render_template_string(PROFILING_TEMPLATE, t=t, p=profiler, profiles=profiler.profiles())
+
+@app.route("/profiling/<name>")
+def profiling_file(name):
+    if not require_login():
+        return redirect(url_for('login'))
+    if not PROFILE_NAME_RE.match(name):
+        return "Not found", 404
+    try:
+        with open(os.path.join(PROFILE_DIR, name), 'rb') as f:
+            data = f.read()
+    except OSError:
+        return "Not found", 404
+    if name.endswith('.txt'):
+        return Response(data, mimetype='text/plain')
+    return Response(data, mimetype='application/octet-stream',
+                    headers={'Content-Disposition': f'attachment; filename="{name}"'})
+
+# --- API: Connection Drops ---
+@app.route("/api/connection_drops")
+def connection_drops_api():
+    """Flows the connection manager dropped for exceeding max_clients, newest first (?user=, ?limit=)."""
+    t = g.t
+    if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
+
+    try:
+        limit = min(max(int(request.args.get('limit', 100)), 1), 1000)
+    except ValueError:
+        return jsonify({"ok": False, "message": "Invalid numeric input."}), 400
+    username = request.args.get('user')
+    where, params = ("WHERE username = ? ", [username]) if username else ("", [])
+
+    db = get_db()
+    try:
+        drops = db.execute(
+            f"SELECT username, src, dport, connections, max_clients, dropped_at FROM connection_drops {where}ORDER BY id DESC LIMIT ?",
+            params + [limit]
+        ).fetchall()
+        # Per-user totals for the last day, for a "sharing" column next to each user
+        recent = "AND username = ? " if username else ""
+        per_user = db.execute(f'''
+            SELECT username, COUNT(*) AS drops, MAX(dropped_at) AS last_drop FROM connection_drops
+            WHERE dropped_at >= datetime('now', '-1 day') {recent}
+            GROUP BY username ORDER BY drops DESC
+        ''', params).fetchall()
+        return jsonify({"ok": True, "drops": [dict(r) for r in drops], "last_24h": [dict(r) for r in per_user]})
+    finally:
+        db.close()
+
 # --- API: Get Reports ---
 @app.route("/api/reports")
 def get_reports():
+    """type=traffic|revenue over from..to (YYYY-MM-DD); period=day|month groups by calendar day or
+    month (month reports cover the whole months touched by the range). Revenue is totalled per
+    plan and currency unless a period is given."""
     t = g.t
     if not require_login(): return jsonify({"ok": False, "err": t['login_err']}), 401
 
     from_date = request.args.get('from')
     to_date = request.args.get('to')
     report_type = request.args.get('type')
-    
+    period = request.args.get('period', 'day')
+
     # Basic date validation
     try:
         if from_date: datetime.strptime(from_date, '%Y-%m-%d')
         if to_date: datetime.strptime(to_date, '%Y-%m-%d')
     except ValueError:
         return jsonify({"message": "Invalid date format. Use YYYY-MM-DD."}), 400
+    if period not in ('day', 'month'):
+        return jsonify({"message": "Invalid period. Use day or month."}), 400
+
+    start, end = from_date or '2000-01-01', to_date or '2030-12-31'
+    if period == 'day':
+        key, suffix, bucket = 'date', 'daily', "DATE(created_at)"
+        low, high = start, end
+        raw_range = (start, end, '+1 day')
+    else:
+        key, suffix, bucket = 'month', 'monthly', "strftime('%Y-%m', created_at)"
+        low, high = start[:7], end[:7]
+        raw_range = (low + '-01', high + '-01', '+1 month')
+    column = 'day' if period == 'day' else 'month'
 
     db = get_db()
     try:
-        data = []
-        
-        # This assumes you have 'traffic_log' and 'billing' tables for reporting
+        # Rollups hold every source row up to the high-water mark; only the rows above it
+        # (roughly today's) are read raw, by primary key rather than by date
         if report_type == 'traffic':
-            # Example query for daily traffic (assuming traffic_log table exists)
-            data = db.execute('''
-                SELECT 
-                    DATE(created_at) as date, 
-                    SUM(bytes_used) as total_bytes_used
-                FROM traffic_log
-                WHERE created_at BETWEEN ? AND datetime(?, '+1 day')
-                GROUP BY date
-                ORDER BY date ASC
-            ''', (from_date or '2000-01-01', to_date or '2030-12-31')).fetchall()
+            totals = dict(db.execute(
+                f"SELECT {column}, bytes_used FROM traffic_{suffix} WHERE {column} BETWEEN ? AND ?", (low, high)
+            ).fetchall())
+            tail = db.execute(f'''
+                SELECT {bucket}, SUM(bytes_used) FROM bandwidth_logs NOT INDEXED
+                WHERE id > ? AND created_at >= ? AND created_at < date(?, ?)
+                GROUP BY 1
+            ''', (rollups.high_water_mark(db, 'bandwidth_logs'),) + raw_range).fetchall()
+            for bucket_key, bytes_used in tail:
+                totals[bucket_key] = totals.get(bucket_key, 0) + bytes_used
+            data = [{key: k, 'total_bytes_used': v} for k, v in sorted(totals.items())]
 
         elif report_type == 'revenue':
-            # Example query for revenue (assuming billing table exists)
-            data = db.execute('''
-                SELECT plan_type, currency, SUM(amount) as total_revenue
-                FROM billing
-                WHERE created_at BETWEEN ? AND datetime(?, '+1 day')
-                GROUP BY plan_type, currency
-            ''', (from_date or '2000-01-01', to_date or '2030-12-31')).fetchall()
-        
+            by_period = 'period' in request.args
+            group = f"{column}, plan_type, currency" if by_period else "plan_type, currency"
+            raw_group = f"{bucket}, COALESCE(plan_type, ''), COALESCE(currency, '')" if by_period else "COALESCE(plan_type, ''), COALESCE(currency, '')"
+            totals = {}
+            rolled = db.execute(
+                f"SELECT {group}, SUM(amount) FROM revenue_{suffix} WHERE {column} BETWEEN ? AND ? GROUP BY {group}", (low, high)
+            ).fetchall()
+            tail = db.execute(f'''
+                SELECT {raw_group}, SUM(amount) FROM billing NOT INDEXED
+                WHERE id > ? AND created_at >= ? AND created_at < date(?, ?)
+                GROUP BY {raw_group}
+            ''', (rollups.high_water_mark(db, 'billing'),) + raw_range).fetchall()
+            for row in list(rolled) + list(tail):
+                totals[tuple(row[:-1])] = totals.get(tuple(row[:-1]), 0) + row[-1]
+            data = []
+            for group_key, amount in sorted(totals.items()):
+                item = dict(zip(([key] if by_period else []) + ['plan_type', 'currency'], group_key))
+                item['total_revenue'] = amount
+                data.append(item)
+
         else:
             return jsonify({"message": "Invalid report type"}), 400
 
-        return jsonify([dict(d) for d in data])
+        return jsonify(data)
     finally:
         db.close()
 
 
 if __name__ == "__main__":
-    import time
     app.run(host='0.0.0.0', port=os.environ.get("WEB_PORT", 8080), debug=True)
 
@@ -0,0 +1,37 @@
+import importlib.util
+import os
+import re
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The services read these at import time, so point them at a scratch directory first
+SCRATCH = tempfile.mkdtemp(prefix='zivpn-tests-')
+os.environ.setdefault('DATABASE_PATH', os.path.join(SCRATCH, 'zivpn.db'))
+os.environ.setdefault('METRICS_DIR', os.path.join(SCRATCH, 'metrics'))
+os.environ.setdefault('TEMPLATE_CACHE_DIR', os.path.join(SCRATCH, 'templates'))
+os.environ.setdefault('PROFILE_DIR', os.path.join(SCRATCH, 'profiles'))
+
+# common/, templates/ and telegram/ modules are deployed side by side and imported flat
+sys.path[:0] = [os.path.join(ROOT, 'common'), os.path.join(ROOT, 'templates'), os.path.join(ROOT, 'telegram')]
+
+
+@pytest.fixture
+def udp_script(tmp_path):
+    """Import one of the scripts udp.sh writes to /etc/zivpn (api.py, cleanup.py, ...) from its heredoc."""
+    with open(os.path.join(ROOT, 'udp.sh'), 'r', encoding='utf-8') as f:
+        installer = f.read()
+
+    def load(filename):
+        match = re.search(rf"^cat >/etc/zivpn/{re.escape(filename)} <<'PY'\n(.*?)^PY$", installer, re.M | re.S)
+        path = tmp_path / filename
+        path.write_text(match.group(1), encoding='utf-8')
+        spec = importlib.util.spec_from_file_location(filename[:-3], path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    return load
@@ -0,0 +1,55 @@
+import signal
+
+import pytest
+
+
+class Recorder:
+    def __init__(self):
+        self.records = []
+
+    def add(self, records):
+        self.records.extend(records)
+
+
+@pytest.fixture
+def api(udp_script, monkeypatch):
+    # api.py routes SIGTERM to sys.exit at import; keep the test process's handler
+    monkeypatch.setattr(signal, 'signal', lambda signum, handler: None)
+    module = udp_script('api.py')
+    module.bandwidth.stop()
+    monkeypatch.setattr(module, 'bandwidth', Recorder())
+    return module
+
+
+def test_single_user_bandwidth_goes_through_the_accumulator(api):
+    client = api.app.test_client()
+    assert client.post('/api/v1/bandwidth/alice', json={'bytes_used': 1024}).status_code == 200
+    assert client.post('/api/v1/bandwidth/alice', json={}).status_code == 200
+    assert api.bandwidth.records == [('alice', 1024)]
+
+
+@pytest.mark.parametrize('body', [
+    {'bytes_used': 'lots'},
+    {'bytes_used': -5},
+    {'bytes_used': 1.5},
+    [1024],
+    None,
+])
+def test_single_user_bandwidth_rejects_bad_input(api, body):
+    client = api.app.test_client()
+    response = client.post('/api/v1/bandwidth/alice', json=body) if body is not None else \
+        client.post('/api/v1/bandwidth/alice')
+    assert response.status_code == 400
+    assert api.bandwidth.records == []
+
+
+def test_batch_uses_the_same_validation(api):
+    response = api.app.test_client().post('/api/v1/bandwidth/batch', json={'records': [
+        {'username': 'alice', 'bytes_used': 10},
+        {'username': 'bob', 'bytes_used': -1},
+        {'username': '', 'bytes_used': 1},
+        {'username': 'carol', 'bytes_used': 0},
+    ]})
+    assert response.status_code == 202
+    assert [r['index'] for r in response.get_json()['rejected']] == [1, 2]
+    assert api.bandwidth.records == [('alice', 10)]
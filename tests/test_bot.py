@@ -0,0 +1,58 @@
+import asyncio
+import signal
+
+import pytest
+from telegram import User
+
+bot = pytest.importorskip('bot')
+
+
+def test_webhook_mode_runs_the_notification_dispatcher(monkeypatch):
+    events = []
+    default_handler = signal.getsignal(signal.SIGTERM)
+
+    async def notification_loop(application):
+        events.append('started')
+        try:
+            # Once run_webhook is waiting for SIGTERM, ask it to shut down
+            while signal.getsignal(signal.SIGTERM) == default_handler:
+                await asyncio.sleep(0.01)
+            signal.raise_signal(signal.SIGTERM)
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            events.append('cancelled')
+            raise
+
+    async def get_me(self, *args, **kwargs):
+        self._bot_user = User(id=1, first_name='ZIVPN', is_bot=True, username='zivpn_test_bot')
+        return self._bot_user
+
+    monkeypatch.setattr(bot, 'notification_loop', notification_loop)
+    monkeypatch.setattr(bot, 'NOTIFY_INTERVAL_SECONDS', 60)
+    monkeypatch.setattr(bot, 'BOT_WEBHOOK_URL', '')
+    monkeypatch.setattr(bot, 'BOT_WEBHOOK_SECRET', 'secret')
+    monkeypatch.setattr(bot, 'BOT_WEBHOOK_PORT', 0)
+    application = bot.build_application()
+    # initialize() verifies the token with getMe; answer it locally
+    monkeypatch.setattr(type(application.bot), 'get_me', get_me)
+
+    asyncio.run(asyncio.wait_for(bot.run_webhook(application), timeout=10))
+
+    assert events == ['started', 'cancelled']
+    assert 'notification_task' not in application.bot_data
+
+
+def test_each_application_gets_its_own_db_semaphore(monkeypatch):
+    monkeypatch.setattr(bot, 'NOTIFY_INTERVAL_SECONDS', 0)
+
+    async def start():
+        application = bot.build_application()
+        await bot.post_init(application)
+        value = await bot.run_db(application, lambda db: db.execute('SELECT 1').fetchone()[0])
+        return application.bot_data['db_slots'], value
+
+    first, value = asyncio.run(start())
+    second, _ = asyncio.run(start())
+    assert value == 1
+    assert first is not second
+    assert first._value == bot.BOT_DB_MAX_PENDING
@@ -0,0 +1,103 @@
+import sqlite3
+
+import pytest
+
+import conntrack
+import migrations
+
+
+def flow(src, dport, timeout=30):
+    return conntrack.Connection('udp', src, '10.0.0.1', 40000, dport, timeout, True)
+
+
+@pytest.fixture
+def cm(udp_script, tmp_path, monkeypatch):
+    module = udp_script('connection_manager.py')
+    path = str(tmp_path / 'zivpn.db')
+    migrations.migrate(path)
+    db = sqlite3.connect(path)
+    db.executemany('INSERT INTO users (username, password, port, max_clients) VALUES (?, ?, ?, ?)', [
+        ('alice', 'pw', None, 1),      # alice and bob share the default port
+        ('bob', 'pw', None, 1),
+        ('carol', 'pw', 6001, 1),
+    ])
+    db.commit()
+    db.close()
+    monkeypatch.setattr(module, 'DATABASE_PATH', path)
+    module.dropped = []
+    monkeypatch.setattr(conntrack, 'drop_many', lambda conns: module.dropped.extend(conns) or list(conns))
+    return module
+
+
+def test_dedicated_port(cm):
+    assert cm.dedicated_port(6001) == 6001
+    assert cm.dedicated_port('6001') == 6001
+    assert cm.dedicated_port(None) is None
+    assert cm.dedicated_port(conntrack.ZIVPN_PORT) is None
+
+
+def test_poll_leaves_the_shared_default_port_alone(cm):
+    manager = cm.ConnectionManager()
+    # Three customers' flows on the default port, two on carol's own port
+    snap = conntrack.Snapshot([
+        flow('198.51.100.1', 5667), flow('198.51.100.2', 5667), flow('198.51.100.3', 5667),
+        flow('203.0.113.1', 6001, timeout=20), flow('203.0.113.2', 6001, timeout=10),
+    ], taken_at=1000)
+    manager.get_active_connections = lambda: snap
+
+    manager.enforce_connection_limits()
+
+    assert [c.src for c in cm.dropped] == ['203.0.113.2']
+
+
+def test_events_leave_the_shared_default_port_alone(cm):
+    manager = cm.ConnectionManager()
+    db = manager.get_db()
+    try:
+        manager.load_limits(db, force=True)
+    finally:
+        db.close()
+    assert manager.port_limits == {6001: (1, 'carol')}
+    assert manager.port_users == {6001: ['carol']}
+
+    for src in ('198.51.100.1', '198.51.100.2', '198.51.100.3'):
+        manager.handle_event('NEW', flow(src, 5667))
+    assert cm.dropped == []
+    assert len(manager.live.for_port(5667)) == 3
+
+    manager.handle_event('NEW', flow('203.0.113.1', 6001))
+    manager.handle_event('NEW', flow('203.0.113.2', 6001))
+    assert [c.src for c in cm.dropped] == ['203.0.113.1']
+    assert [c.src for c in manager.live.for_port(6001)] == ['203.0.113.2']
+
+
+def test_only_flows_conntrack_removed_are_recorded(cm, monkeypatch):
+    manager = cm.ConnectionManager()
+    gone, kept = flow('203.0.113.1', 6001), flow('203.0.113.2', 6001)
+    monkeypatch.setattr(conntrack, 'drop_many', lambda conns: [gone])
+    drops, errors = cm.DROPS.values.get((), 0), cm.DROP_ERRORS.values.get((), 0)
+
+    manager.drop_connections([('carol', gone, 3, 1), ('carol', kept, 3, 1)])
+
+    assert cm.DROPS.values.get((), 0) == drops + 1
+    assert cm.DROP_ERRORS.values.get((), 0) == errors + 1
+    db = manager.get_db()
+    try:
+        assert [tuple(r) for r in db.execute('SELECT username, src FROM connection_drops')] == [('carol', '203.0.113.1')]
+    finally:
+        db.close()
+
+
+def test_nothing_is_recorded_when_no_flow_was_removed(cm, monkeypatch):
+    manager = cm.ConnectionManager()
+    monkeypatch.setattr(conntrack, 'drop_many', lambda conns: [])
+    drops = cm.DROPS.values.get((), 0)
+
+    manager.drop_connections([('carol', flow('203.0.113.1', 6001), 2, 1)])
+
+    assert cm.DROPS.values.get((), 0) == drops
+    db = manager.get_db()
+    try:
+        assert db.execute('SELECT COUNT(*) FROM connection_drops').fetchone()[0] == 0
+    finally:
+        db.close()
@@ -0,0 +1,102 @@
+import conntrack
+
+PROC_LINE = ('ipv4     2 udp      17 29 src=203.0.113.5 dst=10.0.0.1 sport=40000 dport=6001 '
+             'src=10.0.0.1 dst=203.0.113.5 sport=5667 dport=40000 [ASSURED] mark=0 zone=0 use=2')
+LIST_LINE = ('udp      17 30 src=203.0.113.7 dst=10.0.0.1 sport=41000 dport=5667 [UNREPLIED] '
+             'src=10.0.0.1 dst=203.0.113.7 sport=5667 dport=41000 mark=0 use=1')
+NEW_LINE = ('    [NEW] udp      17 30 src=203.0.113.7 dst=10.0.0.1 sport=41000 dport=5667 [UNREPLIED] '
+            'src=10.0.0.1 dst=203.0.113.7 sport=5667 dport=41000')
+DESTROY_LINE = (' [DESTROY] udp      17 src=203.0.113.7 dst=10.0.0.1 sport=41000 dport=5667 '
+                'src=10.0.0.1 dst=203.0.113.7 sport=5667 dport=41000')
+
+
+def conn(src, sport, dport=5667):
+    return conntrack.Connection('udp', src, '10.0.0.1', sport, dport, 30, False)
+
+
+def test_parse_line_reads_the_original_tuple():
+    parsed = conntrack.parse_line(PROC_LINE)
+    assert parsed == conntrack.Connection('udp', '203.0.113.5', '10.0.0.1', 40000, 6001, 29, True)
+
+
+def test_parse_line_skips_other_protocols_and_garbage():
+    assert conntrack.parse_line('ipv4 2 tcp 6 431999 ESTABLISHED src=1.1.1.1 dst=2.2.2.2 sport=1 dport=2') is None
+    assert conntrack.parse_line('udp 17 30 src=1.1.1.1') is None
+    assert conntrack.parse_line('') is None
+
+
+def test_snapshot_indexes_zivpn_ports():
+    snap = conntrack.Snapshot.from_lines([PROC_LINE, LIST_LINE, 'garbage'])
+    assert len(snap) == 2
+    assert [c.src for c in snap.for_port(6001)] == ['203.0.113.5']
+    assert snap.for_port(7000) == []
+
+
+def test_parse_event():
+    event, parsed = conntrack.parse_event(NEW_LINE)
+    assert event == 'NEW'
+    assert (parsed.src, parsed.sport, parsed.dport, parsed.timeout) == ('203.0.113.7', 41000, 5667, 30)
+
+    event, parsed = conntrack.parse_event(DESTROY_LINE)
+    assert event == 'DESTROY'
+    assert parsed.timeout is None
+    assert conntrack.connection_key(parsed) == ('203.0.113.7', 41000, '10.0.0.1', 5667)
+
+    assert conntrack.parse_event(PROC_LINE) is None
+
+
+def test_iter_events_keeps_zivpn_ports_only():
+    other = NEW_LINE.replace('dport=5667 [UNREPLIED]', 'dport=53 [UNREPLIED]')
+    assert [event for event, _ in conntrack.iter_events([NEW_LINE, other, DESTROY_LINE])] == ['NEW', 'DESTROY']
+
+
+def test_live_table_apply():
+    table = conntrack.LiveTable()
+    for event, parsed in conntrack.iter_events([NEW_LINE, NEW_LINE]):
+        table.apply(event, parsed)
+    assert len(table) == 1
+    assert [c.src for c in table.for_src('203.0.113.7')] == ['203.0.113.7']
+
+    event, parsed = conntrack.parse_event(DESTROY_LINE)
+    assert table.apply(event, parsed) is True
+    assert len(table) == 0
+    assert table.by_dport == {} and table.by_src == {}
+    assert table.apply(event, parsed) is False
+
+
+def test_reset_keeps_flow_order():
+    table = conntrack.LiveTable()
+    a, b, c, d = (conn(f'198.51.100.{i}', 40000 + i) for i in range(4))
+    for flow in (a, b, c):
+        table.add(flow)
+
+    # The resync lists flows in a different order, drops b and brings in d
+    table.reset(conntrack.Snapshot([d, c, a]))
+
+    assert table.for_port(5667) == [a, c, d]
+    assert table.for_src(b.src) == []
+    assert len(table) == 3
+
+
+def test_drop_many_reports_the_flows_it_removed(monkeypatch):
+    a, b = conn('198.51.100.1', 40001), conn('198.51.100.2', 40002)
+    calls = []
+
+    class Result:
+        def __init__(self, returncode):
+            self.returncode = returncode
+
+    def run(args, **kwargs):
+        calls.append(args)
+        if '--load-file' in args:
+            return Result(1)
+        # a is already gone, b is deleted
+        return Result(1 if a.src in args else 0)
+
+    monkeypatch.setattr(conntrack.subprocess, 'run', run)
+    assert conntrack.drop_many([a, b]) == [b]
+    assert len(calls) == 3
+
+    monkeypatch.setattr(conntrack.subprocess, 'run', lambda args, **kwargs: Result(0))
+    assert conntrack.drop_many([a, b]) == [a, b]
+    assert conntrack.drop_many([]) == []
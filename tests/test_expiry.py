@@ -0,0 +1,77 @@
+import sqlite3
+import threading
+
+import pytest
+
+import expiry
+import migrations
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'zivpn.db')
+    migrations.migrate(path)
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    db.executemany("INSERT INTO users (username, password, status, expiry_date) VALUES (?, 'pw', ?, ?)", [
+        ('alice', 'active', '2030-01-01 00:00:00'),
+        ('bob', 'active', '2031-01-01 00:00:00'),
+    ])
+    db.commit()
+    yield db
+    db.close()
+
+
+def expiry_version(db):
+    return db.execute(expiry.VERSION_SQL).fetchone()[0]
+
+
+def test_only_status_and_expiry_edits_move_the_feed(db):
+    version = expiry_version(db)
+    db.execute("UPDATE users SET used_bytes = used_bytes + 100, active_clients = 2 WHERE username = 'alice'")
+    db.execute("UPDATE users SET expiry_date = expiry_date WHERE username = 'alice'")
+    assert expiry_version(db) == version
+
+    db.execute("UPDATE users SET expiry_date = '2032-01-01 00:00:00' WHERE username = 'alice'")
+    db.execute("UPDATE users SET status = 'suspended' WHERE username = 'bob'")
+    assert expiry_version(db) == version + 2
+    assert db.execute("SELECT expiry_version FROM users WHERE username = 'bob'").fetchone()[0] == version + 2
+
+
+def test_refresh_ignores_usage_churn(db):
+    scheduler = expiry.ExpiryScheduler()
+    scheduler.load(db)
+    assert scheduler.next_expiry() == '2030-01-01 00:00:00'
+
+    for _ in range(5):
+        db.execute("UPDATE users SET used_bytes = used_bytes + 1")
+    assert scheduler.refresh(db) == 0
+
+    db.execute("UPDATE users SET expiry_date = '2032-01-01 00:00:00' WHERE username = 'alice'")
+    db.execute("INSERT INTO users (username, password, expiry_date) VALUES ('carol', 'pw', '2029-01-01 00:00:00')")
+    assert scheduler.refresh(db) == 2
+    assert scheduler.next_expiry() == '2029-01-01 00:00:00'
+    assert scheduler.pop_due('2031-06-01 00:00:00') == ['carol', 'bob']
+    assert scheduler.next_expiry() == '2032-01-01 00:00:00'
+
+
+def test_notify_wakes_the_worker(tmp_path, monkeypatch):
+    path = str(tmp_path / 'expiry.sock')
+    monkeypatch.setattr(expiry, 'EXPIRY_SOCKET', path)
+    sock = expiry.listen()
+    try:
+        assert expiry.wait_for_change(sock, 0.05) is False
+        threading.Timer(0.05, expiry.notify).start()
+        assert expiry.wait_for_change(sock, 10) is True
+        # A burst of notifications is drained by the one wake-up
+        expiry.notify()
+        expiry.notify()
+        assert expiry.wait_for_change(sock, 10) is True
+        assert expiry.wait_for_change(sock, 0.05) is False
+    finally:
+        sock.close()
+
+
+def test_notify_without_a_worker_is_harmless(tmp_path, monkeypatch):
+    monkeypatch.setattr(expiry, 'EXPIRY_SOCKET', str(tmp_path / 'missing.sock'))
+    expiry.notify()
@@ -0,0 +1,59 @@
+import metrics
+
+
+def test_render_format(monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    monkeypatch.setattr(metrics, 'service_name', 'web')
+
+    requests = registry.register(metrics.Counter('t_requests_total', 'Requests.', ('route',)))
+    requests.inc('/a')
+    requests.inc('/a', amount=2)
+    registry.register(metrics.Gauge('t_users', 'Users.', fn=lambda: 7))
+    latency = registry.register(metrics.Histogram('t_seconds', 'Latency.', buckets=(0.1, 1)))
+    latency.observe(0.05)
+    latency.observe(0.5)
+    latency.observe(3)
+    registry.register(metrics.Metric('t_empty', 'Nothing recorded.'))
+
+    assert metrics.render() == '\n'.join([
+        '# HELP t_requests_total Requests.',
+        '# TYPE t_requests_total counter',
+        't_requests_total{service="web",route="/a"} 3',
+        '# HELP t_users Users.',
+        '# TYPE t_users gauge',
+        't_users{service="web"} 7',
+        '# HELP t_seconds Latency.',
+        '# TYPE t_seconds histogram',
+        't_seconds_bucket{service="web",le="0.1"} 1',
+        't_seconds_bucket{service="web",le="1.0"} 2',
+        't_seconds_bucket{service="web",le="+Inf"} 3',
+        't_seconds_sum{service="web"} 3.55',
+        't_seconds_count{service="web"} 3',
+    ]) + '\n'
+
+
+def test_label_values_are_escaped(monkeypatch):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    monkeypatch.setattr(metrics, 'service_name', '')
+
+    registry.register(metrics.Counter('t_odd_total', 'Odd labels.', ('v',))).inc('a"b\\c\nd')
+    assert 't_odd_total{v="a\\"b\\\\c\\nd"} 1\n' in metrics.render()
+
+
+def test_render_merges_fresh_service_files(monkeypatch, tmp_path):
+    registry = metrics.Registry()
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    monkeypatch.setattr(metrics, 'METRICS_DIR', str(tmp_path))
+    monkeypatch.setattr(metrics, 'service_name', 'web')
+    registry.register(metrics.Counter('t_syncs_total', 'Syncs.')).inc()
+
+    (tmp_path / 'sync.prom').write_text('# HELP t_syncs_total Syncs.\n# TYPE t_syncs_total counter\n'
+                                        't_syncs_total{service="sync"} 4\n')
+    (tmp_path / 'web.prom').write_text('# HELP t_stale Own file.\n# TYPE t_stale gauge\nt_stale 1\n')
+
+    text = metrics.render(include_files=True)
+    assert text.count('# TYPE t_syncs_total counter') == 1
+    assert 't_syncs_total{service="web"} 1\nt_syncs_total{service="sync"} 4\n' in text
+    assert 't_stale' not in text
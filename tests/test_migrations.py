@@ -0,0 +1,92 @@
+import sqlite3
+
+import migrations
+
+# users as the original udp.sh created it, before the Python services renamed its columns
+LEGACY_USERS = '''
+    CREATE TABLE users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        username TEXT UNIQUE NOT NULL,
+        password TEXT NOT NULL,
+        expires DATE,
+        port INTEGER,
+        status TEXT DEFAULT 'active',
+        bandwidth_limit INTEGER DEFAULT 0,
+        bandwidth_used INTEGER DEFAULT 0,
+        speed_limit_up INTEGER DEFAULT 0,
+        speed_limit_down INTEGER DEFAULT 0,
+        concurrent_conn INTEGER DEFAULT 1,
+        is_enabled INTEGER DEFAULT 1,
+        data_limit_gb REAL DEFAULT 0.0,
+        created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+def open_db(path):
+    db = sqlite3.connect(path)
+    db.row_factory = sqlite3.Row
+    return db
+
+
+def test_empty_database(tmp_path):
+    path = str(tmp_path / 'empty.db')
+    assert migrations.migrate(path) == migrations.SCHEMA_VERSION
+
+    db = open_db(path)
+    assert db.execute('PRAGMA user_version').fetchone()[0] == migrations.SCHEMA_VERSION
+    tables = {r[0] for r in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'users', 'billing', 'config_sync', 'change_counter', 'user_tombstones',
+            'traffic_daily', 'rollup_state', 'connection_drops'} <= tables
+    assert db.execute('SELECT version FROM change_counter').fetchone()[0] == 0
+    assert db.execute('SELECT requested_version FROM config_sync WHERE id = 1').fetchone()[0] == 0
+
+    db.execute("INSERT INTO users (username, password) VALUES ('alice', 'pw')")
+    db.execute("UPDATE users SET used_bytes = 10 WHERE username = 'alice'")
+    db.execute("DELETE FROM users WHERE username = 'alice'")
+    db.commit()
+    assert db.execute('SELECT version FROM change_counter').fetchone()[0] == 3
+    assert tuple(db.execute('SELECT username, row_version FROM user_tombstones').fetchone()) == ('alice', 3)
+    db.close()
+
+
+def test_baseline_database(tmp_path):
+    path = str(tmp_path / 'baseline.db')
+    db = open_db(path)
+    db.execute(LEGACY_USERS)
+    for ddl in migrations.BASE_TABLES[1:]:
+        db.execute(ddl)
+    db.execute("INSERT INTO users (username, password, expires, bandwidth_limit, bandwidth_used, concurrent_conn) "
+               "VALUES ('bob', 'pw', '2030-01-01 00:00:00', 1000, 250, 3)")
+    db.commit()
+    db.close()
+
+    assert migrations.migrate(path) == migrations.SCHEMA_VERSION
+
+    db = open_db(path)
+    columns = migrations._columns(db, 'users')
+    assert {'expiry_date', 'data_limit_bytes', 'used_bytes', 'max_clients', 'row_version'} <= columns
+    assert not columns & set(migrations.LEGACY_USER_COLUMNS)
+    row = db.execute('SELECT * FROM users WHERE username = ?', ('bob',)).fetchone()
+    assert (row['expiry_date'], row['data_limit_bytes'], row['used_bytes'], row['max_clients']) == \
+        ('2030-01-01 00:00:00', 1000, 250, 3)
+    # Existing rows are versioned 1..n so a since=0 fetch sees them
+    assert row['row_version'] == row['id']
+    assert db.execute('SELECT version FROM change_counter').fetchone()[0] == row['id']
+    db.close()
+
+
+def test_migrate_is_idempotent(tmp_path):
+    path = str(tmp_path / 'again.db')
+    migrations.migrate(path)
+    db = open_db(path)
+    db.execute("INSERT INTO users (username, password) VALUES ('carol', 'pw')")
+    db.commit()
+    db.close()
+
+    assert migrations.migrate(path) == migrations.SCHEMA_VERSION
+    db = open_db(path)
+    assert db.execute('SELECT COUNT(*) FROM users').fetchone()[0] == 1
+    assert db.execute('SELECT version FROM change_counter').fetchone()[0] == 1
+    db.close()
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+import rollups
+
+web = pytest.importorskip('web')
+
+# Each source's first batch is rolled up, leaving the mark part-way through 2026-04-01
+TRAFFIC = [
+    ('alice', 100, '2026-03-30 23:00:00'),
+    ('bob', 200, '2026-03-31 10:00:00'),
+    ('alice', 300, '2026-04-01 08:00:00'),
+]
+LATER_TRAFFIC = [
+    ('bob', 400, '2026-04-01 09:00:00'),
+    ('alice', 500, '2026-04-01 12:00:00'),
+    ('carol', 600, '2026-04-02 01:00:00'),
+]
+BILLING = [
+    ('alice', 'monthly', 5000, 'MMK', '2026-03-31 10:00:00'),
+    ('bob', 'monthly', 5000, 'MMK', '2026-04-01 09:00:00'),
+]
+LATER_BILLING = [
+    ('carol', 'monthly', 5000, 'MMK', '2026-04-01 12:00:00'),
+    ('dave', 'yearly', 50000, 'MMK', '2026-04-02 01:00:00'),
+]
+
+
+@pytest.fixture
+def db():
+    db = web.get_db()
+    for table in ('bandwidth_logs', 'billing', 'traffic_daily', 'traffic_monthly', 'revenue_daily', 'revenue_monthly'):
+        db.execute(f'DELETE FROM {table}')
+    db.execute('UPDATE rollup_state SET last_id = 0')
+    db.commit()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def client():
+    client = web.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['last_activity'] = time.time()
+    return client
+
+
+def insert(db, traffic, billing):
+    db.executemany('INSERT INTO bandwidth_logs (username, bytes_used, created_at) VALUES (?, ?, ?)', traffic)
+    db.executemany('INSERT INTO billing (username, plan_type, amount, currency, created_at, expires_at) '
+                   'VALUES (?, ?, ?, ?, ?, ?)', [row + (row[-1],) for row in billing])
+    db.commit()
+
+
+def reports(client):
+    query = '/api/reports?from=2026-03-01&to=2026-04-30'
+    return (
+        client.get(query + '&type=traffic').get_json(),
+        client.get(query + '&type=traffic&period=month').get_json(),
+        client.get(query + '&type=revenue&period=day').get_json(),
+        client.get(query + '&type=revenue').get_json(),
+    )
+
+
+def test_report_spanning_the_high_water_mark_is_continuous(db, client):
+    insert(db, TRAFFIC, BILLING)
+    insert(db, LATER_TRAFFIC, LATER_BILLING)
+    all_raw = reports(client)
+
+    db.execute('DELETE FROM bandwidth_logs')
+    db.execute('DELETE FROM billing')
+    db.commit()
+    insert(db, TRAFFIC, BILLING)
+    rollups.catch_up(db)
+    insert(db, LATER_TRAFFIC, LATER_BILLING)
+    assert db.execute("SELECT bytes_used FROM traffic_daily WHERE day = '2026-04-01'").fetchone()[0] == 300
+    split = reports(client)
+
+    rollups.catch_up(db)
+    all_rolled = reports(client)
+
+    assert all_raw == split == all_rolled
+    daily, monthly, revenue_daily, revenue = split
+    assert daily == [
+        {'date': '2026-03-30', 'total_bytes_used': 100},
+        {'date': '2026-03-31', 'total_bytes_used': 200},
+        {'date': '2026-04-01', 'total_bytes_used': 1200},
+        {'date': '2026-04-02', 'total_bytes_used': 600},
+    ]
+    assert monthly == [{'month': '2026-03', 'total_bytes_used': 300}, {'month': '2026-04', 'total_bytes_used': 1800}]
+    assert [(r['date'], r['plan_type'], r['total_revenue']) for r in revenue_daily] == [
+        ('2026-03-31', 'monthly', 5000), ('2026-04-01', 'monthly', 10000), ('2026-04-02', 'yearly', 50000),
+    ]
+    assert [(r['plan_type'], r['currency'], r['total_revenue']) for r in revenue] == [
+        ('monthly', 'MMK', 15000), ('yearly', 'MMK', 50000),
+    ]
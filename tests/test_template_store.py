@@ -0,0 +1,80 @@
+import json
+import time
+
+import pytest
+
+web = pytest.importorskip('web')
+
+PAGE = f'<p>{{{{ name }}}} v1</p>{web.LOGIN_BLOCK_START}<form>login v1</form>{web.LOGIN_BLOCK_END}'
+
+
+class FakeResponse:
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        pass
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    (tmp_path / 'index.html').write_text(PAGE, encoding='utf-8')
+    (tmp_path / 'index.meta.json').write_text(json.dumps({'etag': '"v1"', 'checked_at': time.time()}))
+    compiles = []
+    from_string = web.app.jinja_env.from_string
+
+    def counting_from_string(source):
+        compiles.append(source)
+        return from_string(source)
+
+    monkeypatch.setattr(web.app.jinja_env, 'from_string', counting_from_string)
+    store = web.TemplateStore('https://example.invalid/index.html', str(tmp_path), max_age=3600)
+    store.compiles = compiles
+    return store
+
+
+def render(template):
+    with web.app.app_context():
+        return template.render(name='panel')
+
+
+def test_compiled_templates_are_reused(store):
+    page = store.get()
+    assert store.get() is page
+    login = store.get(block='login')
+    assert store.get(block='login') is login
+    assert len(store.compiles) == 2
+    assert render(page).startswith('<p>panel v1</p>')
+    assert render(login) == '<form>login v1</form>'
+
+
+def test_changed_source_is_recompiled(store, monkeypatch):
+    page = store.get()
+    new = PAGE.replace('v1', 'v2')
+    monkeypatch.setattr(web.requests, 'get', lambda url, headers, timeout: FakeResponse(200, new, {'ETag': '"v2"'}))
+    store.revalidate()
+
+    assert store.get() is not page
+    assert render(store.get()).startswith('<p>panel v2</p>')
+    assert len(store.compiles) == 2
+    # The new copy and its validators are what a restart loads
+    with open(store.meta_path) as f:
+        assert json.load(f)['etag'] == '"v2"'
+    assert web.TemplateStore(store.url, store.cache_dir, 3600).source == new
+
+
+def test_unchanged_source_keeps_the_compiled_template(store, monkeypatch):
+    page = store.get()
+    seen = {}
+
+    def not_modified(url, headers, timeout):
+        seen.update(headers)
+        return FakeResponse(304)
+
+    monkeypatch.setattr(web.requests, 'get', not_modified)
+    store.revalidate()
+    assert seen['If-None-Match'] == '"v1"'
+    assert store.get() is page
+    assert len(store.compiles) == 1
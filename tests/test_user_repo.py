@@ -0,0 +1,99 @@
+import sqlite3
+
+import pytest
+
+import migrations
+import user_repo
+
+
+@pytest.fixture
+def db(tmp_path):
+    path = str(tmp_path / 'users.db')
+    migrations.migrate(path)
+    db = sqlite3.connect(path)
+    db.execute("INSERT INTO users (username, password) VALUES ('alice', 'a1'), ('bob', 'b1')")
+    db.commit()
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def cache():
+    loads = []
+
+    def loader(db, username):
+        loads.append(username)
+        return user_repo.get_user(db, username)
+
+    cache = user_repo.UserCache(loader, maxsize=10, ttl=60, negative_ttl=60, sync_seconds=0)
+    cache.loads = loads
+    return cache
+
+
+def test_hits_and_negative_hits(db, cache):
+    assert cache.get(db, 'alice').password == 'a1'
+    assert cache.get(db, 'alice').password == 'a1'
+    assert cache.get(db, 'nobody') is None
+    assert cache.get(db, 'nobody') is None
+    assert cache.loads == ['alice', 'nobody']
+    stats = cache.stats()
+    assert (stats['hits'], stats['negative_hits'], stats['misses']) == (1, 1, 2)
+
+
+def test_invalidate_one_and_all(db, cache):
+    cache.get(db, 'alice')
+    cache.get(db, 'bob')
+
+    cache.invalidate('alice')
+    cache.get(db, 'alice')
+    cache.get(db, 'bob')
+    assert cache.loads == ['alice', 'bob', 'alice']
+
+    cache.invalidate()
+    assert cache.stats()['size'] == 0
+    cache.get(db, 'bob')
+    assert cache.loads[-1] == 'bob'
+
+
+def test_sync_drops_users_changed_by_other_processes(db, cache):
+    cache.get(db, 'alice')
+    cache.get(db, 'bob')
+
+    # Another process changes alice behind the cache's back
+    db.execute("UPDATE users SET password = 'a2' WHERE username = 'alice'")
+    db.commit()
+
+    assert cache.get(db, 'alice').password == 'a2'
+    assert cache.get(db, 'bob').password == 'b1'
+    assert cache.loads == ['alice', 'bob', 'alice']
+
+
+def test_sync_drops_deleted_users(db, cache):
+    cache.get(db, 'bob')
+    db.execute("DELETE FROM users WHERE username = 'bob'")
+    db.commit()
+    assert cache.get(db, 'bob') is None
+
+
+def test_sync_drops_everything_after_a_restore(db, cache):
+    cache.get(db, 'alice')
+    cache.get(db, 'bob')
+    # A restored backup puts the change counter back
+    db.execute('UPDATE change_counter SET version = 0')
+    db.commit()
+    cache.get(db, 'alice')
+    assert cache.loads == ['alice', 'bob', 'alice']
+    assert cache.stats()['size'] == 1
+
+
+def test_load_racing_an_invalidate_is_not_stored(db):
+    cache = None
+
+    def loader(db, username):
+        # An invalidate lands while this load is still reading the old row
+        cache.invalidate(username)
+        return user_repo.get_user(db, username)
+
+    cache = user_repo.UserCache(loader, ttl=60, sync_seconds=60)
+    assert cache.get(db, 'alice').password == 'a1'
+    assert cache.stats()['size'] == 0
@@ -0,0 +1,78 @@
+import io
+import json
+import time
+
+import pytest
+
+web = pytest.importorskip('web')
+
+
+@pytest.fixture
+def client():
+    db = web.get_db()
+    db.execute('DELETE FROM users')
+    db.commit()
+    db.close()
+    client = web.app.test_client()
+    with client.session_transaction() as session:
+        session['logged_in'] = True
+        session['last_activity'] = time.time()
+    return client
+
+
+def counts():
+    db = web.get_db()
+    try:
+        users = db.execute('SELECT COUNT(*) FROM users').fetchone()[0]
+        requested = db.execute('SELECT requested_version FROM config_sync WHERE id = 1').fetchone()[0]
+    finally:
+        db.close()
+    return users, requested
+
+
+def upload(client, body, query=''):
+    return client.post(f'/api/users/import?format=jsonl{query}', data=body)
+
+
+def rows(start, stop):
+    return ''.join(json.dumps({'username': f'user{i:05d}', 'password': 'pw'}) + '\n'
+                   for i in range(start, stop)).encode()
+
+
+def test_import_inserts_updates_and_reports_bad_rows(client):
+    _, requested = counts()
+    body = rows(0, 3) + b'not json\n' + json.dumps({'username': 'user00000', 'password': 'new'}).encode() + b'\n'
+    response = upload(client, body)
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['summary'] == {'rows': 5, 'inserted': 3, 'updated': 1, 'failed': 1}
+    assert data['errors'] == [{'line': 4, 'username': None, 'message': 'Invalid JSON.'}]
+    assert counts() == (3, requested + 1)
+
+
+def test_dry_run_writes_nothing(client):
+    before = counts()
+    response = upload(client, rows(0, 10), '&dry_run=1')
+    assert response.get_json()['summary']['inserted'] == 10
+    assert counts() == before
+
+
+def test_partial_failure_syncs_and_reports_committed_rows(client):
+    _, requested = counts()
+    # Undecodable bytes well past the first few batches
+    body = rows(0, 3 * web.IMPORT_BATCH_ROWS) + b'\xff\xfe\n' + rows(3 * web.IMPORT_BATCH_ROWS, 3 * web.IMPORT_BATCH_ROWS + 10)
+    response = upload(client, body)
+    assert response.status_code == 400
+    data = response.get_json()
+    assert data['ok'] is False
+    users, requested_after = counts()
+    assert 0 < data['committed'] == users < 3 * web.IMPORT_BATCH_ROWS
+    assert data['committed'] % web.IMPORT_BATCH_ROWS == 0
+    assert f"({data['committed']} already committed)" in data['message']
+    # The committed batches still reach the generated config
+    assert requested_after == requested + 1
+
+
+def test_import_requires_login():
+    response = web.app.test_client().post('/api/users/import?format=jsonl', data=io.BytesIO(b''))
+    assert response.status_code == 401
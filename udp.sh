@@ -49,7 +49,10 @@ systemctl stop zivpn-api.service 2>/dev/null || true
 systemctl stop zivpn-bot.service 2>/dev/null || true
 systemctl stop zivpn-cleanup.timer 2>/dev/null || true
 systemctl stop zivpn-backup.timer 2>/dev/null || true
+systemctl stop zivpn-stats.timer 2>/dev/null || true
 systemctl stop zivpn-connection.service 2>/dev/null || true
+systemctl stop zivpn-sync.service 2>/dev/null || true
+systemctl stop zivpn-expiry.service 2>/dev/null || true
 
 # ===== Enhanced Packages =====
 say "${Y}📦 Enhanced Packages တင်နေပါတယ်...${Z}"
@@ -62,7 +65,7 @@ apt-get install -y curl ufw jq python3 python3-flask python3-pip python3-venv ip
 }
 
 # Additional Python packages
-pip3 install requests python-dateutil python-dotenv python-telegram-bot >/dev/null 2>&1 || true
+pip3 install requests python-dateutil python-dotenv "python-telegram-bot>=20" >/dev/null 2>&1 || true
 apt_guard_end
 
 # ===== Paths =====
@@ -93,14 +96,15 @@ CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     username TEXT UNIQUE NOT NULL,
     password TEXT NOT NULL,
-    expires DATE,
+    expiry_date DATETIME,
     port INTEGER,
     status TEXT DEFAULT 'active',
-    bandwidth_limit INTEGER DEFAULT 0,
-    bandwidth_used INTEGER DEFAULT 0,
+    data_limit_bytes INTEGER DEFAULT 0,
+    used_bytes INTEGER DEFAULT 0,
     speed_limit_up INTEGER DEFAULT 0,
     speed_limit_down INTEGER DEFAULT 0,
-    concurrent_conn INTEGER DEFAULT 1,
+    max_clients INTEGER DEFAULT 1,
+    active_clients INTEGER DEFAULT 0,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
@@ -239,6 +243,18 @@ fi
 [ -f "$USERS" ] || echo "[]" > "$USERS"
 chmod 644 "$CFG" "$USERS"
 
+# ===== Download Shared Python Modules from GitHub =====
+say "${Y}📚 Shared Python Modules ဒေါင်းလုပ်ဆွဲနေပါတယ်...${Z}"
+COMMON_MODULES="migrations dbpool metrics config_sync stats_cache rollups conntrack expiry user_repo"
+for mod in $COMMON_MODULES; do
+  curl -fsSL -o "/etc/zivpn/${mod}.py" "https://raw.githubusercontent.com/BaeGyee9/web-bot/main/common/${mod}.py" || \
+    echo -e "${R}❌ ${mod}.py ဒေါင်းလုပ်ဆွဲ၍မရပါ${Z}"
+done
+
+# Apply versioned schema migrations (renames legacy columns of older installs, adds indexes)
+say "${Y}🔧 Database migrations လုပ်ဆောင်နေပါတယ်...${Z}"
+DATABASE_PATH="$DB" python3 /etc/zivpn/migrations.py || echo -e "${R}❌ Database migration မအောင်မြင်ပါ${Z}"
+
 # ===== Download Web Panel from GitHub (MODIFIED DOWNLOADS) =====
 say "${Y}🌐 GitHub မှ Web Panel ဒေါင်းလုပ်ဆွဲနေပါတယ်... (MODIFIED: Bandwidth/Status Control)${Z}"
 # 🚨🚨 အရေးကြီး: ဤ URL ကို ညီလေး ပြင်ဆင်ထားသော web.py ၏ Link ဖြင့် အစားထိုးပါ 🚨🚨
@@ -272,16 +288,160 @@ say "${Y}🔌 API Service ထည့်သွင်းနေပါတယ်...${Z
 cat >/etc/zivpn/api.py <<'PY'
 from flask import Flask, jsonify, request
 import sqlite3, datetime
-from datetime import timedelta
 import os
+import sys
+import time
+import atexit
+import signal
+import threading
+import dbpool
+import metrics
+import migrations
+import rollups
+import user_repo
 
 app = Flask(__name__)
+metrics.instrument_flask(app, 'api')
 DATABASE_PATH = os.environ.get("DATABASE_PATH", "/etc/zivpn/zivpn.db")
 
 def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return dbpool.get_db(DATABASE_PATH)
+
+def load_user(db, username):
+    user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    return dict(user) if user else None
+
+# /api/v1/user/<username> returns every column, so it keeps its own cache of plain rows;
+# changes made by the other services arrive through the change counter (see user_repo.py)
+user_cache = user_repo.UserCache(load_user)
+
+# --- Bandwidth accumulator ---
+# Reporters post increments every few seconds; merging them per user in memory and writing
+# one executemany transaction per flush keeps the API from being commit-bound.
+BANDWIDTH_FLUSH_SECONDS = float(os.environ.get("BANDWIDTH_FLUSH_SECONDS", "2"))
+BANDWIDTH_FLUSH_USERS = int(os.environ.get("BANDWIDTH_FLUSH_USERS", "5000"))
+BANDWIDTH_BATCH_MAX = 10000
+FLUSH_SECONDS = metrics.histogram('zivpn_bandwidth_flush_seconds', 'Time to write one batch of bandwidth increments.')
+
+class BandwidthAccumulator:
+    def __init__(self, flush_seconds, flush_users):
+        self.flush_seconds = flush_seconds
+        self.flush_users = flush_users
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.flush_lock = threading.Lock()
+        self.pending = {}
+        self.stopped = False
+        self.metrics = {
+            'records_received': 0, 'flushes': 0, 'rows_flushed': 0, 'flush_errors': 0,
+            'last_flush_seconds': 0.0, 'max_flush_seconds': 0.0, 'last_flush_at': None,
+        }
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, records):
+        """Merge (username, bytes) increments; wakes the flusher once enough users are queued."""
+        with self.lock:
+            for username, bytes_used in records:
+                self.pending[username] = self.pending.get(username, 0) + bytes_used
+            self.metrics['records_received'] += len(records)
+            full = len(self.pending) >= self.flush_users
+        if full:
+            self.wake.set()
+
+    def flush(self):
+        # One flush at a time, so a failed batch is merged back before the next swap
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return 0
+            started = time.monotonic()
+            db = get_db()
+            try:
+                rows = [(bytes_used, username) for username, bytes_used in batch.items()]
+                db.executemany('UPDATE users SET used_bytes = used_bytes + ?, updated_at = CURRENT_TIMESTAMP WHERE username = ?', rows)
+                db.executemany('INSERT INTO bandwidth_logs (username, bytes_used) VALUES (?, ?)', list(batch.items()))
+                db.commit()
+                user_cache.invalidate_many(batch)
+            except sqlite3.Error as e:
+                db.rollback()
+                # Keep the increments for the next attempt instead of losing them
+                with self.lock:
+                    for username, bytes_used in batch.items():
+                        self.pending[username] = self.pending.get(username, 0) + bytes_used
+                    self.metrics['flush_errors'] += 1
+                print(f"Bandwidth flush failed, {len(batch)} users kept for retry: {e}")
+                return 0
+            finally:
+                db.close()
+            elapsed = time.monotonic() - started
+            FLUSH_SECONDS.observe(elapsed)
+            with self.lock:
+                m = self.metrics
+                m['flushes'] += 1
+                m['rows_flushed'] += len(batch)
+                m['last_flush_seconds'] = round(elapsed, 6)
+                m['max_flush_seconds'] = max(m['max_flush_seconds'], m['last_flush_seconds'])
+                m['last_flush_at'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            return len(batch)
+
+    def run(self):
+        while not self.stopped:
+            self.wake.wait(self.flush_seconds)
+            self.wake.clear()
+            self.flush()
+
+    def stop(self):
+        """Final flush on shutdown (atexit / SIGTERM)."""
+        self.stopped = True
+        self.wake.set()
+        self.flush()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.metrics)
+            stats['queue_users'] = len(self.pending)
+            stats['queue_bytes'] = sum(self.pending.values())
+        return stats
+
+bandwidth = BandwidthAccumulator(BANDWIDTH_FLUSH_SECONDS, BANDWIDTH_FLUSH_USERS)
+atexit.register(bandwidth.stop)
+
+# --- Report rollups ---
+# Reports read the rows above the rollup high-water mark raw; folding them in every few
+# minutes keeps that tail short instead of letting it grow until the daily cleanup.
+ROLLUP_INTERVAL_SECONDS = float(os.environ.get("ROLLUP_INTERVAL_SECONDS", "300"))
+
+def run_rollups():
+    while True:
+        time.sleep(ROLLUP_INTERVAL_SECONDS)
+        try:
+            rollups.catch_up()
+        except sqlite3.Error as e:
+            print(f"Rollup catch-up failed: {e}")
+
+threading.Thread(target=run_rollups, daemon=True).start()
+# systemd stops the service with SIGTERM, which would skip atexit handlers by default
+signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+@app.teardown_request
+def release_db(exc):
+    dbpool.release_thread(DATABASE_PATH)
+
+@app.route('/api/v1/db/stats', methods=['GET'])
+def get_db_stats():
+    return jsonify(dbpool.pool_stats(DATABASE_PATH))
+
+@app.route('/api/v1/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(user_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.authorized(request.headers.get('Authorization')):
+        return "Unauthorized\n", 401, {'Content-Type': 'text/plain'}
+    return metrics.render(), 200, {'Content-Type': metrics.CONTENT_TYPE}
 
 @app.route('/api/v1/stats', methods=['GET'])
 def get_stats():
@@ -289,8 +449,8 @@ def get_stats():
     stats = db.execute('''
         SELECT 
             COUNT(*) as total_users,
-            SUM(CASE WHEN status = "active" AND (expires IS NULL OR expires >= CURRENT_DATE) THEN 1 ELSE 0 END) as active_users,
-            SUM(bandwidth_used) as total_bandwidth
+            SUM(CASE WHEN status = 'active' AND (expiry_date IS NULL OR expiry_date >= datetime('now', 'localtime')) THEN 1 ELSE 0 END) as active_users,
+            SUM(used_bytes) as total_bandwidth
         FROM users
     ''').fetchone()
     db.close()
@@ -303,63 +463,91 @@ def get_stats():
 @app.route('/api/v1/users', methods=['GET'])
 def get_users():
     db = get_db()
-    users = db.execute('SELECT username, status, expires, bandwidth_used, concurrent_conn FROM users').fetchall()
+    users = db.execute('SELECT username, status, expiry_date, used_bytes, max_clients, active_clients FROM users').fetchall()
     db.close()
     return jsonify([dict(u) for u in users])
 
 @app.route('/api/v1/user/<username>', methods=['GET'])
 def get_user(username):
     db = get_db()
-    user = db.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
+    user = user_cache.get(db, username)
     db.close()
     if user:
-        return jsonify(dict(user))
+        return jsonify(user)
     return jsonify({"error": "User not found"}), 404
 
+def parse_bandwidth_record(record):
+    """(username, bytes_used) from one reported record, or None if it is malformed."""
+    username = record.get('username') if isinstance(record, dict) else None
+    bytes_used = record.get('bytes_used') if isinstance(record, dict) else None
+    if not isinstance(username, str) or not username or not isinstance(bytes_used, int) or bytes_used < 0:
+        return None
+    return username, bytes_used
+
+@app.route('/api/v1/bandwidth/batch', methods=['POST'])
+def update_bandwidth_batch():
+    """Body: {"records": [{"username": ..., "bytes_used": ...}, ...]} (or the bare list)."""
+    data = request.get_json(silent=True)
+    records = data.get('records') if isinstance(data, dict) else data
+    if not isinstance(records, list):
+        return jsonify({"error": "Expected a list of records"}), 400
+    if len(records) > BANDWIDTH_BATCH_MAX:
+        return jsonify({"error": f"At most {BANDWIDTH_BATCH_MAX} records per request"}), 400
+
+    accepted, rejected = [], []
+    for i, record in enumerate(records):
+        parsed = parse_bandwidth_record(record)
+        if parsed is None:
+            rejected.append({"index": i, "error": "username (string) and bytes_used (non-negative integer) required"})
+            continue
+        if parsed[1]:
+            accepted.append(parsed)
+    bandwidth.add(accepted)
+    return jsonify({"accepted": len(records) - len(rejected), "rejected": rejected}), 202
+
+@app.route('/api/v1/bandwidth/metrics', methods=['GET'])
+def get_bandwidth_metrics():
+    return jsonify(bandwidth.stats())
+
 @app.route('/api/v1/bandwidth/<username>', methods=['POST'])
 def update_bandwidth(username):
-    data = request.get_json()
-    bytes_used = data.get('bytes_used', 0)
-    
-    db = get_db()
-    # 1. Update total usage
-    db.execute('''
-        UPDATE users 
-        SET bandwidth_used = bandwidth_used + ?, updated_at = CURRENT_TIMESTAMP 
-        WHERE username = ?
-    ''', (bytes_used, username))
-    
-    # 2. Log bandwidth usage
-    db.execute('''
-        INSERT INTO bandwidth_logs (username, bytes_used) 
-        VALUES (?, ?)
-    ''', (username, bytes_used))
-    
-    db.commit()
-    db.close()
+    data = request.get_json(silent=True)
+    parsed = parse_bandwidth_record({'username': username, 'bytes_used': data.get('bytes_used', 0)}
+                                    if isinstance(data, dict) else None)
+    if parsed is None:
+        return jsonify({"error": "bytes_used (non-negative integer) required"}), 400
+
+    # Goes through the same accumulator as the batch endpoint; written within BANDWIDTH_FLUSH_SECONDS
+    if parsed[1]:
+        bandwidth.add([parsed])
     return jsonify({"message": "Bandwidth updated"})
 
 if __name__ == '__main__':
+    migrations.migrate(DATABASE_PATH)
     app.run(host='0.0.0.0', port=8081)
 PY
 
 # ===== Daily Cleanup Script (ORIGINAL CODE) =====
 say "${Y}🧹 Daily Cleanup Service ထည့်သွင်းနေပါတယ်...${Z}"
 cat >/etc/zivpn/cleanup.py <<'PY'
-import sqlite3
 import datetime
 import os
-import subprocess
 import json
+import sys
 import tempfile
+import config_sync
+import dbpool
+import expiry
+import migrations
+import rollups
+import stats_cache
 
 DATABASE_PATH = "/etc/zivpn/zivpn.db"
 CONFIG_FILE = "/etc/zivpn/config.json"
+CONNECTION_DROP_RETENTION_DAYS = 30
 
 def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return dbpool.get_db(DATABASE_PATH)
 
 def read_json(path, default):
     try:
@@ -378,49 +566,40 @@ def write_json_atomic(path, data):
         except: pass
 
 def sync_config_passwords():
-    # Only sync passwords for non-suspended/non-expired users
-    db = get_db()
-    active_users = db.execute('''
-        SELECT password FROM users 
-        WHERE status = "active" AND password IS NOT NULL AND password != "" 
-              AND (expires IS NULL OR expires >= CURRENT_DATE)
-    ''').fetchall()
-    db.close()
-    
-    users_pw = sorted({str(u["password"]) for u in active_users})
-    
-    cfg=read_json(CONFIG_FILE,{})
-    if not isinstance(cfg.get("auth"),dict): cfg["auth"]={}
-    cfg["auth"]["mode"]="passwords"
-    cfg["auth"]["config"]=users_pw
-    
-    write_json_atomic(CONFIG_FILE,cfg)
-    subprocess.run("systemctl restart zivpn.service", shell=True)
+    # Queue a coalesced sync; zivpn-sync.service rebuilds config.json and restarts zivpn once
+    config_sync.request_sync()
 
 def daily_cleanup():
     db = get_db()
-    today = datetime.datetime.now().date().strftime("%Y-%m-%d")
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     suspended_count = 0
     
     try:
-        # 1. Auto-suspend expired users
-        expired_users = db.execute('''
-            SELECT username, expires, status FROM users
-            WHERE status = 'active' AND expires < ?
-        ''', (today,)).fetchall()
-        
-        for user in expired_users:
-            db.execute('UPDATE users SET status = "suspended" WHERE username = ?', (user['username'],))
-            suspended_count += 1
-            print(f"User {user['username']} expired on {user['expires']} and was suspended.")
-            
-        db.commit()
+        # 1. Auto-suspend expired users (zivpn-expiry.service does this on time; this catches
+        #    anything it missed while stopped), one set-based UPDATE
+        expired_users = expiry.suspend_expired(db, now)
+        suspended_count = len(expired_users)
+        for username in expired_users:
+            print(f"User {username} expired and was suspended.")
 
         # 2. Re-sync passwords to exclude the newly suspended users
         if suspended_count > 0:
-            print(f"Total {suspended_count} users suspended. Restarting ZIVPN service...")
+            print(f"Total {suspended_count} users suspended. Queueing ZIVPN config sync...")
             sync_config_passwords()
         
+        # 3. Fold any bandwidth/billing rows zivpn-api.service hasn't yet into the report rollups
+        for source, count in rollups.catch_up(db).items():
+            print(f"Rolled up {count} {source} row(s).")
+
+        # 4. Forget old connection drops (see connection_manager.py)
+        pruned = db.execute(
+            "DELETE FROM connection_drops WHERE dropped_at < datetime('now', ?)",
+            (f'-{CONNECTION_DROP_RETENTION_DAYS} days',)
+        ).rowcount
+        db.commit()
+        if pruned:
+            print(f"Pruned {pruned} connection drop record(s).")
+
         print(f"Cleanup finished. {suspended_count} users suspended today.")
         
     except Exception as e:
@@ -429,157 +608,538 @@ def daily_cleanup():
     finally:
         db.close()
 
+def record_stats_snapshot():
+    # zivpn-stats.timer: one server_stats row for the history charts, outside any request
+    db = get_db()
+    try:
+        stats_cache.record_snapshot(db)
+    finally:
+        db.close()
+
 if __name__ == '__main__':
-    daily_cleanup()
+    migrations.migrate(DATABASE_PATH)
+    if len(sys.argv) > 1 and sys.argv[1] == 'snapshot':
+        record_stats_snapshot()
+    else:
+        daily_cleanup()
 PY
 
 # ===== Backup Script (ORIGINAL CODE) =====
 say "${Y}💾 Backup System ထည့်သွင်းနေပါတယ်...${Z}"
 cat >/etc/zivpn/backup.py <<'PY'
-import sqlite3, shutil, datetime, os, gzip
+"""
+ZIVPN Backup - consistent, compressed, deduplicated snapshots of zivpn.db
+
+  backup.py                 take a snapshot (what zivpn-backup.timer runs)
+  backup.py list            list snapshots
+  backup.py verify [FILE]   decompress and integrity-check a snapshot (default: newest)
+  backup.py restore FILE    verify, then copy a snapshot into the live database
+"""
+import sqlite3, datetime, os, gzip, hashlib, json, sys, tempfile, time, subprocess
+import config_sync
 
 BACKUP_DIR = "/etc/zivpn/backups"
 DATABASE_PATH = "/etc/zivpn/zivpn.db"
+MANIFEST = os.path.join(BACKUP_DIR, "manifest.json")
+BACKUP_KEEP_DAYS = 7
+# Pages copied per backup step outside WAL mode, where each step holds a lock writers wait on
+BACKUP_PAGES_PER_STEP = 1024
+BACKUP_STEP_SLEEP = 0.01
+CHUNK_SIZE = 1024 * 1024
+
+def read_manifest():
+    try:
+        with open(MANIFEST, "r") as f: return json.load(f)
+    except Exception:
+        return {"last": None, "files": {}}
+
+def write_manifest(manifest):
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=BACKUP_DIR)
+    with os.fdopen(fd, "w") as f: json.dump(manifest, f, indent=2)
+    os.replace(tmp, MANIFEST)
+
+def db_fingerprint():
+    """Size and mtime of the database and its WAL; unchanged means no write since"""
+    parts = []
+    for path in (DATABASE_PATH, DATABASE_PATH + "-wal"):
+        try:
+            st = os.stat(path)
+            parts.append([st.st_size, st.st_mtime_ns])
+        except OSError:
+            parts.append(None)
+    return parts
+
+def copy_database(dest):
+    """Online copy through the backup API; readers in WAL mode never block writers"""
+    src = sqlite3.connect(DATABASE_PATH, timeout=30)
+    dst = sqlite3.connect(dest)
+    try:
+        wal = src.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+        if wal:
+            # One step copies from a single read snapshot; stepping would restart on every write
+            src.backup(dst)
+        else:
+            src.backup(dst, pages=BACKUP_PAGES_PER_STEP, sleep=BACKUP_STEP_SLEEP)
+    finally:
+        dst.close()
+        src.close()
+
+def compress(src_path, dest_path):
+    """Stream a file into gzip in chunks; returns the sha256 of the uncompressed bytes"""
+    digest = hashlib.sha256()
+    with open(src_path, "rb") as f_in, gzip.open(dest_path, "wb", compresslevel=6) as f_out:
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            f_out.write(chunk)
+    return digest.hexdigest()
+
+def decompress(src_path, dest_path):
+    digest = hashlib.sha256()
+    with gzip.open(src_path, "rb") as f_in, open(dest_path, "wb") as f_out:
+        for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            f_out.write(chunk)
+    return digest.hexdigest()
+
+def prune(manifest):
+    # Keep the newest snapshot whatever its age; mtime, not ctime, is the snapshot's age
+    cutoff = time.time() - BACKUP_KEEP_DAYS * 86400
+    for file in os.listdir(BACKUP_DIR):
+        if not (file.startswith("zivpn_backup_") and file.endswith(".db.gz")) or file == manifest.get("last"):
+            continue
+        file_path = os.path.join(BACKUP_DIR, file)
+        if os.path.getmtime(file_path) < cutoff:
+            os.remove(file_path)
+            manifest["files"].pop(file, None)
 
 def backup_database():
     if not os.path.exists(BACKUP_DIR):
         os.makedirs(BACKUP_DIR)
-    
+    manifest = read_manifest()
+    last = manifest["files"].get(manifest.get("last") or "")
+    last_exists = last is not None and os.path.exists(os.path.join(BACKUP_DIR, manifest["last"]))
+
+    fingerprint = db_fingerprint()
+    if last_exists and last.get("fingerprint") == fingerprint:
+        print(f"Database unchanged since {manifest['last']}, backup skipped.")
+        return None
+
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_file = os.path.join(BACKUP_DIR, f"zivpn_backup_{timestamp}.db.gz")
-    
-    # Backup database
-    with open(DATABASE_PATH, 'rb') as f_in:
-        with gzip.open(backup_file, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
-    
-    # Cleanup old backups (keep last 7 days)
-    for file in os.listdir(BACKUP_DIR):
-        file_path = os.path.join(BACKUP_DIR, file)
-        if os.path.isfile(file_path):
-            file_time = datetime.datetime.fromtimestamp(os.path.getctime(file_path))
-            if (datetime.datetime.now() - file_time).days > 7:
-                os.remove(file_path)
-    
+    fd, tmp_db = tempfile.mkstemp(prefix=".tmp-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    tmp_gz = backup_file + ".part"
+    try:
+        copy_database(tmp_db)
+        sha256 = compress(tmp_db, tmp_gz)
+        if last_exists and last.get("sha256") == sha256:
+            # Written to but identical again (e.g. a checkpoint); just remember the new fingerprint
+            last["fingerprint"] = fingerprint
+            write_manifest(manifest)
+            print(f"Database content unchanged since {manifest['last']}, backup skipped.")
+            return None
+        os.replace(tmp_gz, backup_file)
+    finally:
+        for path in (tmp_db, tmp_gz):
+            if os.path.exists(path): os.remove(path)
+
+    name = os.path.basename(backup_file)
+    manifest["files"][name] = {"sha256": sha256, "fingerprint": fingerprint,
+                               "size": os.path.getsize(backup_file), "created_at": timestamp}
+    manifest["last"] = name
+    prune(manifest)
+    write_manifest(manifest)
     print(f"Backup created: {backup_file}")
+    return backup_file
+
+def resolve(name=None):
+    manifest = read_manifest()
+    name = name or manifest.get("last")
+    if not name:
+        raise SystemExit("No backups found.")
+    path = name if os.path.isabs(name) or os.path.exists(name) else os.path.join(BACKUP_DIR, name)
+    return path, manifest["files"].get(os.path.basename(path), {})
+
+def verify_backup(name=None, keep=False):
+    """Decompress to a temp file, check the checksum and PRAGMA integrity_check; returns the temp path if keep"""
+    path, entry = resolve(name)
+    fd, tmp_db = tempfile.mkstemp(prefix=".verify-", suffix=".db", dir=BACKUP_DIR)
+    os.close(fd)
+    try:
+        sha256 = decompress(path, tmp_db)
+        if entry.get("sha256") and entry["sha256"] != sha256:
+            raise SystemExit(f"{path}: checksum mismatch")
+        db = sqlite3.connect(tmp_db)
+        try:
+            result = db.execute("PRAGMA integrity_check").fetchone()[0]
+            users = db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        finally:
+            db.close()
+        if result != "ok":
+            raise SystemExit(f"{path}: integrity check failed: {result}")
+        print(f"{path}: ok ({users} users)")
+        if keep:
+            return tmp_db
+    except BaseException:
+        os.remove(tmp_db)
+        raise
+    os.remove(tmp_db)
+    return None
+
+RESTART_AFTER_RESTORE = ("zivpn-expiry.service", "zivpn-connection.service")
+
+def restore_backup(name):
+    """Copy a verified snapshot into the live database through the backup API"""
+    tmp_db = verify_backup(name, keep=True)
+    try:
+        src = sqlite3.connect(tmp_db)
+        dst = sqlite3.connect(DATABASE_PATH, timeout=30)
+        try:
+            src.backup(dst)
+        finally:
+            dst.close()
+            src.close()
+    finally:
+        os.remove(tmp_db)
+    # users.json / config.json follow the restored users table
+    config_sync.request_sync()
+    # The change counter went backwards; these workers hold state keyed on it, so start them fresh
+    for service in RESTART_AFTER_RESTORE:
+        subprocess.run(["systemctl", "restart", service], check=False)
+    print(f"Restored {DATABASE_PATH} from {name}; restarted {', '.join(RESTART_AFTER_RESTORE)}. "
+          f"Restart zivpn-web, zivpn-api and zivpn-bot to drop cached state.")
+
+def list_backups():
+    manifest = read_manifest()
+    for file in sorted(os.listdir(BACKUP_DIR)):
+        if file.startswith("zivpn_backup_") and file.endswith(".db.gz"):
+            entry = manifest["files"].get(file, {})
+            size = os.path.getsize(os.path.join(BACKUP_DIR, file))
+            print(f"{file}  {size} bytes  {entry.get('sha256', '-')[:12]}{'  (latest)' if file == manifest.get('last') else ''}")
 
 if __name__ == '__main__':
-    backup_database()
+    command = sys.argv[1] if len(sys.argv) > 1 else "backup"
+    if command == "backup":
+        backup_database()
+    elif command == "list":
+        list_backups()
+    elif command == "verify":
+        verify_backup(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif command == "restore" and len(sys.argv) > 2:
+        restore_backup(sys.argv[2])
+    else:
+        raise SystemExit(__doc__)
 PY
 
 # ===== Connection Manager (ORIGINAL CODE) =====
 say "${Y}🔗 Connection Manager ထည့်သွင်းနေပါတယ်...${Z}"
 cat >/etc/zivpn/connection_manager.py <<'PY'
 import sqlite3
-import subprocess
+import sys
 import time
 import threading
-from datetime import datetime
 import os
+import conntrack
+import dbpool
+import metrics
+import migrations
 
 DATABASE_PATH = "/etc/zivpn/zivpn.db"
+# event: follow `conntrack -E` and enforce on each new flow; poll: full scan every POLL_SECONDS
+CONNECTION_MODE = os.environ.get("CONNECTION_MODE", "event")
+POLL_SECONDS = 10
+# Event mode: full snapshot to correct drift (missed events, expired flows), and active_clients write-back
+RESYNC_SECONDS = 60
+ACTIVE_FLUSH_SECONDS = 2
+
+LOOP_SECONDS = metrics.histogram('zivpn_conntrack_loop_seconds', 'Connection manager work by phase.', ('phase',))
+EVENTS = metrics.counter('zivpn_conntrack_events_total', 'Conntrack events applied to the live table.', ('event',))
+DROPS = metrics.counter('zivpn_connections_dropped_total', 'Flows dropped for exceeding max_clients.')
+DROP_ERRORS = metrics.counter('zivpn_connection_drop_errors_total', 'Batches conntrack failed to drop.')
+
+def dedicated_port(port):
+    """A user's own port, or None for users on the shared default port.
+
+    Every user without a port connects to ZIVPN_PORT, so flows there can't be told
+    apart by user and no per-user limit can be enforced on them.
+    """
+    port = int(port or 0)
+    return port if port and port != conntrack.ZIVPN_PORT else None
 
 class ConnectionManager:
-    def __init__(self):
+    def __init__(self, dry_run=False):
         self.connection_tracker = {}
         self.lock = threading.Lock()
+        self.dry_run = dry_run
+        # Event mode state, all guarded by self.lock
+        self.live = conntrack.LiveTable()
+        self.port_limits = {}   # dedicated port -> (max_clients, username) of the strictest active user on it
+        self.port_users = {}    # dedicated port -> usernames whose active_clients it feeds
+        self.limits_version = None
+        self.dirty_ports = set()
+        self.written = {}       # username -> active_clients last written
         
     def get_db(self):
-        conn = sqlite3.connect(DATABASE_PATH)
-        conn.row_factory = sqlite3.Row
-        return conn
+        return dbpool.get_db(DATABASE_PATH)
         
     def get_active_connections(self):
-        """Get active connections using conntrack"""
+        """Parsed conntrack snapshot of ZIVPN connections, indexed by dport and source IP"""
         try:
-            result = subprocess.run(
-                "conntrack -L -p udp 2>/dev/null | grep -E 'dport=(5667|[6-9][0-9]{3}|[1-9][0-9]{4})' | awk '{print $7,$8}'",
-                shell=True, capture_output=True, text=True
-            )
-            
-            connections = {}
-            for line in result.stdout.split('\n'):
-                if 'src=' in line and 'dport=' in line:
-                    try:
-                        parts = line.split()
-                        src_ip = None
-                        dport = None
-                        
-                        for part in parts:
-                            if part.startswith('src='):
-                                src_ip = part.split('=')[1]
-                            elif part.startswith('dport='):
-                                dport = part.split('=')[1]
-                        
-                        if src_ip and dport:
-                            connections[f"{src_ip}:{dport}"] = True
-                    except:
-                        continue
-            return connections
-        except:
-            return {}
+            return conntrack.snapshot(taken_at=time.time())
+        except Exception as e:
+            print(f"Error reading conntrack table: {e}")
+            return conntrack.Snapshot([])
             
+    def first_seen(self, snapshot):
+        """Record when each flow was first seen by a poll; forget flows that are gone"""
+        now = snapshot.taken_at or time.time()
+        seen = {}
+        for conns in snapshot.by_dport.values():
+            for conn in conns:
+                key = conntrack.connection_key(conn)
+                seen[key] = self.connection_tracker.get(key, now)
+        self.connection_tracker = seen
+        return seen
+        
     def enforce_connection_limits(self):
         """Enforce connection limits for all users"""
         db = self.get_db()
         try:
             # Get all active users with their connection limits
             users = db.execute('''
-                SELECT username, concurrent_conn, port 
+                SELECT username, max_clients, port 
                 FROM users 
-                WHERE status = "active" AND (expires IS NULL OR expires >= CURRENT_DATE)
+                WHERE status = 'active' AND (expiry_date IS NULL OR expiry_date >= datetime('now', 'localtime'))
             ''').fetchall()
             
             active_connections = self.get_active_connections()
+            seen = self.first_seen(active_connections)
+            victims = {}
             
             for user in users:
                 username = user['username']
-                max_connections = user['concurrent_conn']
-                user_port = str(user['port'] or '5667')
+                max_connections = user['max_clients']
+                user_port = dedicated_port(user['port'])
+                if user_port is None:
+                    continue
                 
-                # Count connections for this user (by port)
-                user_conn_count = 0
-                user_connections = []
+                # Connections for this user (by port): one index lookup
+                user_connections = active_connections.for_port(user_port)
+                user_conn_count = len(user_connections)
                 
-                for conn_key in active_connections:
-                    if conn_key.endswith(f":{user_port}"):
-                        user_conn_count += 1
-                        user_connections.append(conn_key)
-                
-                # If over limit, drop oldest connections
+                # If over limit, drop oldest connections (first seen; least time left breaks ties)
                 if user_conn_count > max_connections:
                     print(f"User {username} has {user_conn_count} connections (limit: {max_connections})")
-                    
-                    # Drop excess connections (FIFO - we'll drop the first ones we find)
-                    excess = user_conn_count - max_connections
-                    for i in range(excess):
-                        if i < len(user_connections):
-                            conn_to_drop = user_connections[i]
-                            self.drop_connection(conn_to_drop)
-                            
+                    oldest = sorted(user_connections,
+                                    key=lambda c: (seen[conntrack.connection_key(c)], c.timeout or 0))
+                    for conn in oldest[:user_conn_count - max_connections]:
+                        victims.setdefault(conntrack.connection_key(conn),
+                                           (username, conn, user_conn_count, max_connections))
+                        
+            # One conntrack call and one insert for the whole pass
+            self.drop_connections(list(victims.values()), db)
         finally:
             db.close()
             
-    def drop_connection(self, connection_key):
-        """Drop a specific connection using conntrack"""
+    def drop_connections(self, victims, db=None):
+        """Drop flows in one batch and record them per user; victims are (username, conn, count, limit)"""
+        if not victims:
+            return
+        for username, conn, count, limit in victims:
+            print(f"{'Would drop' if self.dry_run else 'Dropping'} connection of {username}: "
+                  f"{conn.src}:{conn.sport} -> {conn.dport} ({count}/{limit})")
+        if self.dry_run:
+            return
         try:
-            # connection_key format: "IP:PORT"
-            ip, port = connection_key.split(':')
-            subprocess.run(
-                f"conntrack -D -p udp --dport {port} --src {ip}",
-                shell=True, capture_output=True
-            )
-            print(f"Dropped connection: {connection_key}")
+            with LOOP_SECONDS.time('drop'):
+                dropped = conntrack.drop_many([conn for _, conn, _, _ in victims])
         except Exception as e:
-            print(f"Error dropping connection {connection_key}: {e}")
+            print(f"Error dropping {len(victims)} connection(s): {e}")
+            DROP_ERRORS.inc()
+            return
+        if len(dropped) < len(victims):
+            print(f"conntrack dropped {len(dropped)} of {len(victims)} connection(s)")
+            DROP_ERRORS.inc()
+            # Only flows that are really gone count as drops
+            removed = {conntrack.connection_key(conn) for conn in dropped}
+            victims = [v for v in victims if conntrack.connection_key(v[1]) in removed]
+            if not victims:
+                return
+        DROPS.inc(amount=len(victims))
+        own = db is None
+        if own:
+            db = self.get_db()
+        try:
+            db.executemany(
+                'INSERT INTO connection_drops (username, src, dport, connections, max_clients) VALUES (?, ?, ?, ?, ?)',
+                [(username, conn.src, conn.dport, count, limit) for username, conn, count, limit in victims]
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            print(f"Error recording connection drops: {e}")
+        finally:
+            if own:
+                db.close()
+            
+    # --- Event mode ---
+    def load_limits(self, db, force=False):
+        """Reload per-port limits when the users table changed (or on every resync, for expiries)"""
+        version = db.execute('SELECT version FROM change_counter WHERE id = 1').fetchone()[0]
+        if not force and version == self.limits_version:
+            return
+        users = db.execute('''
+            SELECT username, max_clients, port 
+            FROM users 
+            WHERE status = 'active' AND (expiry_date IS NULL OR expiry_date >= datetime('now', 'localtime'))
+        ''').fetchall()
+        port_limits, port_users = {}, {}
+        for user in users:
+            # Flows on the shared default port can't be told apart: no limit and no per-user count there
+            user_port = dedicated_port(user['port'])
+            if user_port is None:
+                continue
+            # Users given the same port share its flows, as in the polling pass: the lowest limit wins
+            if user_port not in port_limits or user['max_clients'] < port_limits[user_port][0]:
+                port_limits[user_port] = (user['max_clients'], user['username'])
+            port_users.setdefault(user_port, []).append(user['username'])
+        with self.lock:
+            if self.limits_version is None:
+                # Start from what is stored, so values left by an earlier run get corrected
+                self.written = dict(db.execute(
+                    'SELECT username, active_clients FROM users WHERE active_clients > 0'
+                ).fetchall())
+            self.port_limits, self.port_users = port_limits, port_users
+            self.limits_version = version
+            self.dirty_ports.update(port_users)
+            
+    def over_limit(self, port):
+        """Take the oldest flows over a port's limit out of the live table; returns drop victims"""
+        with self.lock:
+            limit, username = self.port_limits.get(port, (None, None))
+            conns = self.live.for_port(port)
+            if limit is None or len(conns) <= limit:
+                return []
+            # for_port() is in first-seen order, so these are the oldest flows
+            victims = [(username, conn, len(conns), limit) for conn in conns[:len(conns) - limit]]
+            for _, conn, _, _ in victims:
+                self.live.remove(conn)
+            self.dirty_ports.add(port)
+        return victims
+        
+    def handle_event(self, event, conn):
+        """Apply one NEW/DESTROY event; a new flow is checked against its limit straight away"""
+        with self.lock:
+            changed = self.live.apply(event, conn)
+            if changed:
+                self.dirty_ports.add(conn.dport)
+        EVENTS.inc(event)
+        if changed and event == 'NEW':
+            self.drop_connections(self.over_limit(conn.dport))
+            
+    def resync(self, db):
+        """Replace the live table with a full snapshot and re-check every port"""
+        snap = self.get_active_connections()
+        with self.lock:
+            self.dirty_ports.update(self.live.by_dport)
+            self.live.reset(snap)
+            self.dirty_ports.update(self.live.by_dport)
+        self.load_limits(db, force=True)
+        victims = []
+        for port in list(self.port_limits):
+            victims.extend(self.over_limit(port))
+        self.drop_connections(victims, db)
             
-    def start_monitoring(self):
-        """Start the connection monitoring loop"""
+    def flush_active_clients(self, db):
+        """Write changed active_clients values in one batch"""
+        with self.lock:
+            ports, self.dirty_ports = self.dirty_ports, set()
+            wanted = {}
+            for port in ports:
+                count = len(self.live.for_port(port))
+                for username in self.port_users.get(port, ()):
+                    wanted[username] = count
+            # Users who lost their dedicated port (or went inactive) drop back to 0
+            assigned = {u for users in self.port_users.values() for u in users}
+            for username in self.written:
+                if username not in assigned:
+                    wanted[username] = 0
+        updates = [(count, username) for username, count in wanted.items() if self.written.get(username, 0) != count]
+        if not updates or self.dry_run:
+            return 0
+        try:
+            db.executemany('UPDATE users SET active_clients = ? WHERE username = ?', updates)
+            db.commit()
+        except sqlite3.Error as e:
+            db.rollback()
+            print(f"Error writing active clients: {e}")
+            with self.lock:
+                self.dirty_ports.update(ports)
+            return 0
+        for count, username in updates:
+            if count:
+                self.written[username] = count
+            else:
+                self.written.pop(username, None)
+        return len(updates)
+        
+    def follow_events(self, lines):
+        """Feed conntrack event lines (the live stream or a recorded file) through handle_event"""
+        for event, conn in conntrack.iter_events(lines):
+            self.handle_event(event, conn)
+            
+    def start_event_monitoring(self):
+        """Follow the conntrack event stream, with periodic resync and active_clients write-back"""
+        db = self.get_db()
+        try:
+            self.resync(db)
+            self.flush_active_clients(db)
+        finally:
+            db.close()
+            
+        def event_loop():
+            while True:
+                try:
+                    self.follow_events(conntrack.event_stream())
+                    print("Conntrack event stream ended, restarting")
+                except FileNotFoundError:
+                    print("conntrack tool not found, falling back to polling")
+                    self.start_polling()
+                    return
+                except Exception as e:
+                    print(f"Event stream error: {e}")
+                time.sleep(5)
+                
+        def maintenance_loop():
+            last_resync = time.time()
+            while True:
+                time.sleep(ACTIVE_FLUSH_SECONDS)
+                db = self.get_db()
+                try:
+                    if time.time() - last_resync >= RESYNC_SECONDS:
+                        with LOOP_SECONDS.time('resync'):
+                            self.resync(db)
+                        last_resync = time.time()
+                    else:
+                        self.load_limits(db)
+                    with LOOP_SECONDS.time('flush'):
+                        self.flush_active_clients(db)
+                except Exception as e:
+                    print(f"Monitoring error: {e}")
+                finally:
+                    db.close()
+                    
+        threading.Thread(target=event_loop, daemon=True).start()
+        threading.Thread(target=maintenance_loop, daemon=True).start()
+        
+    def start_polling(self):
+        """Start the connection polling loop"""
         def monitor_loop():
             while True:
                 try:
-                    self.enforce_connection_limits()
-                    time.sleep(10)  # Check every 10 seconds
+                    with LOOP_SECONDS.time('poll'):
+                        self.enforce_connection_limits()
+                    time.sleep(POLL_SECONDS)
                 except Exception as e:
                     print(f"Monitoring error: {e}")
                     time.sleep(30)
@@ -587,11 +1147,35 @@ class ConnectionManager:
         monitor_thread = threading.Thread(target=monitor_loop, daemon=True)
         monitor_thread.start()
         
+    def start_monitoring(self, mode=CONNECTION_MODE):
+        """Start connection monitoring in event mode (default) or poll mode"""
+        if mode == 'event':
+            self.start_event_monitoring()
+        else:
+            self.start_polling()
+        
+    def replay(self, path):
+        """Dry run against a recorded `conntrack -E` file: report drops, write nothing"""
+        db = self.get_db()
+        try:
+            self.load_limits(db, force=True)
+        finally:
+            db.close()
+        with open(path, 'r') as f:
+            self.follow_events(f)
+        for port, conns in sorted(self.live.by_dport.items()):
+            print(f"  dport {port}: {len(conns)} (limit: {self.port_limits.get(port, ('-',))[0]})")
+        
 # Global instance
 connection_manager = ConnectionManager()
 
 if __name__ == "__main__":
+    migrations.migrate(DATABASE_PATH)
+    if len(sys.argv) == 3 and sys.argv[1] == '--replay':
+        ConnectionManager(dry_run=True).replay(sys.argv[2])
+        sys.exit(0)
     print("Starting Connection Manager...")
+    metrics.start_textfile_writer('connections')
     connection_manager.start_monitoring()
     try:
         while True:
@@ -698,6 +1282,44 @@ RestartSec=5
 WantedBy=multi-user.target
 EOF
 
+# Config Sync Service (coalesces users.json/config.json writes and zivpn restarts)
+cat >/etc/systemd/system/zivpn-sync.service <<'EOF'
+[Unit]
+Description=ZIVPN Config Sync Worker
+After=network.target
+
+[Service]
+Type=simple
+User=root
+EnvironmentFile=-/etc/zivpn/web.env
+WorkingDirectory=/etc/zivpn
+ExecStart=/usr/bin/python3 /etc/zivpn/config_sync.py
+Restart=always
+RestartSec=3
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
+# Expiry Scheduler Service (suspends users at their expiry time)
+cat >/etc/systemd/system/zivpn-expiry.service <<'EOF'
+[Unit]
+Description=ZIVPN Expiry Scheduler
+After=network.target zivpn-sync.service
+
+[Service]
+Type=simple
+User=root
+EnvironmentFile=-/etc/zivpn/web.env
+WorkingDirectory=/etc/zivpn
+ExecStart=/usr/bin/python3 /etc/zivpn/expiry.py
+Restart=always
+RestartSec=3
+
+[Install]
+WantedBy=multi-user.target
+EOF
+
 # Backup Service
 cat >/etc/systemd/system/zivpn-backup.service <<'EOF'
 [Unit]
@@ -756,6 +1378,32 @@ Persistent=true
 WantedBy=timers.target
 EOF
 
+# Stats Snapshot (server_stats history, every 5 minutes)
+cat >/etc/systemd/system/zivpn-stats.service <<'EOF'
+[Unit]
+Description=ZIVPN Stats Snapshot
+After=network.target
+
+[Service]
+Type=oneshot
+User=root
+WorkingDirectory=/etc/zivpn
+ExecStart=/usr/bin/python3 /etc/zivpn/cleanup.py snapshot
+EOF
+
+cat >/etc/systemd/system/zivpn-stats.timer <<'EOF'
+[Unit]
+Description=ZIVPN Stats Snapshot Timer
+Requires=zivpn-stats.service
+
+[Timer]
+OnBootSec=5min
+OnUnitActiveSec=5min
+
+[Install]
+WantedBy=timers.target
+EOF
+
 # ===== Networking Setup (ORIGINAL CODE) =====
 echo -e "${Y}🌐 Network Configuration ပြုလုပ်နေပါတယ်...${Z}"
 sysctl -w net.ipv4.ip_forward=1 >/dev/null
@@ -790,8 +1438,11 @@ systemctl enable --now zivpn-web.service
 systemctl enable --now zivpn-api.service
 systemctl enable --now zivpn-bot.service
 systemctl enable --now zivpn-connection.service
+systemctl enable --now zivpn-sync.service
+systemctl enable --now zivpn-expiry.service
 systemctl enable --now zivpn-backup.timer
 systemctl enable --now zivpn-cleanup.timer
+systemctl enable --now zivpn-stats.timer
 
 # Initial setup
 python3 /etc/zivpn/backup.py
@@ -810,4 +1461,6 @@ echo -e "\n${M}📊 SERVICES STATUS:${Z}"
 echo -e "  ${Y}systemctl status zivpn-web${Z}      - Web Panel"
 echo -e "  ${Y}systemctl status zivpn-bot${Z}      - Telegram Bot"
 echo -e "  ${Y}systemctl status zivpn-connection${Z} - Connection Manager"
+echo -e "  ${Y}systemctl status zivpn-sync${Z}       - Config Sync Worker"
+echo -e "  ${Y}systemctl status zivpn-expiry${Z}     - Expiry Scheduler"
 echo -e "$LINE"